@@ -0,0 +1,39 @@
+from logging.config import fileConfig
+
+from alembic import context
+
+from database import engine
+import models
+
+config = context.config
+
+# only the alembic command line sets up logging, the app keeps uvicorn's
+if config.config_file_name is not None and config.cmd_opts is not None:
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+
+def run_migrations_offline() -> None:
+    """Print the SQL instead of running it (alembic upgrade --sql)"""
+    context.configure(
+        url=engine.url,
+        target_metadata=target_metadata,
+        literal_binds=True,
+        dialect_opts={"paramstyle": "named"},
+    )
+    with context.begin_transaction():
+        context.run_migrations()
+
+
+def run_migrations_online() -> None:
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata)
+        with context.begin_transaction():
+            context.run_migrations()
+
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
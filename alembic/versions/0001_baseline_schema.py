@@ -0,0 +1,199 @@
+"""baseline schema
+
+The tables as models.Base.metadata.create_all made them before the migrations existed,
+databases created that way are stamped with this revision on startup (see database.migrate).
+Columns added since then come in their own revisions.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 19:11:37.200209
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0001'
+down_revision: Union[str, Sequence[str], None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('decorations',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('allowed_position', sa.Integer(), nullable=False),
+    sa.Column('cost', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('flowers',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('color_id', sa.String(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_flowers_id'), 'flowers', ['id'], unique=False)
+    op.create_table('players',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('player_id', sa.UUID(), nullable=False),
+    sa.Column('name', sa.String(), nullable=True),
+    sa.Column('profile_picture', sa.Integer(), nullable=True),
+    sa.Column('money', sa.Integer(), nullable=True),
+    sa.Column('customer_id', sa.Integer(), nullable=True),
+    sa.Column('session_id', sa.UUID(), nullable=True),
+    sa.Column('assigned_flower', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_players_id'), 'players', ['id'], unique=False)
+    op.create_index(op.f('ix_players_player_id'), 'players', ['player_id'], unique=True)
+    op.create_table('recipes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_recipes_id'), 'recipes', ['id'], unique=False)
+    op.create_table('sessions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('session_id', sa.UUID(), nullable=False),
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.Integer(), nullable=True),
+    sa.Column('code', sa.String(length=5), nullable=False),
+    sa.Column('flowers_available', sa.JSON(), nullable=True),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('initial_lat', sa.Float(), nullable=True),
+    sa.Column('initial_lng', sa.Float(), nullable=True),
+    sa.Column('initial_player', sa.UUID(), nullable=False),
+    sa.ForeignKeyConstraint(['initial_player'], ['players.player_id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('code')
+    )
+    op.create_index(op.f('ix_sessions_session_id'), 'sessions', ['session_id'], unique=True)
+    # players and sessions point at each other, this side is added once both exist
+    # (batch mode, sqlite can only add it by rebuilding the table)
+    with op.batch_alter_table('players') as batch_op:
+        batch_op.create_foreign_key('players_session_id_fkey', 'sessions', ['session_id'], ['session_id'],
+                                    ondelete='SET NULL')
+    op.create_table('decoraion_player',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('player_id', sa.UUID(), nullable=False),
+    sa.Column('decoration_id', sa.Integer(), nullable=False),
+    sa.Column('used', sa.Boolean(), nullable=True),
+    sa.Column('position', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['decoration_id'], ['decorations.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['player_id'], ['players.player_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('grimoires',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('player_id', sa.UUID(), nullable=True),
+    sa.ForeignKeyConstraint(['player_id'], ['players.player_id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('player_id')
+    )
+    op.create_index(op.f('ix_grimoires_id'), 'grimoires', ['id'], unique=False)
+    op.create_table('inventory_items',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('player_id', sa.UUID(), nullable=False),
+    sa.Column('potion_id', sa.Integer(), nullable=False),
+    sa.Column('amount', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['player_id'], ['players.player_id'], ),
+    sa.ForeignKeyConstraint(['potion_id'], ['recipes.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_inventory_items_id'), 'inventory_items', ['id'], unique=False)
+    op.create_table('player_friendships',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('player1_id', sa.UUID(), nullable=False),
+    sa.Column('player2_id', sa.UUID(), nullable=False),
+    sa.Column('potions_together', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['player1_id'], ['players.player_id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['player2_id'], ['players.player_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table('playeraccounts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_name', sa.String(), nullable=False),
+    sa.Column('password_hash', sa.String(), nullable=False),
+    sa.Column('player_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['player_id'], ['players.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('player_id')
+    )
+    op.create_index(op.f('ix_playeraccounts_id'), 'playeraccounts', ['id'], unique=False)
+    op.create_index(op.f('ix_playeraccounts_user_name'), 'playeraccounts', ['user_name'], unique=True)
+    op.create_table('recipe_flowers',
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.Column('flower_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['flower_id'], ['flowers.id'], ),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ),
+    sa.PrimaryKeyConstraint('recipe_id', 'flower_id')
+    )
+    op.create_table('recipe_potions',
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.Column('potion_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['potion_id'], ['recipes.id'], ),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ),
+    sa.PrimaryKeyConstraint('recipe_id', 'potion_id')
+    )
+    op.create_table('session_flower_association',
+    sa.Column('session_id', sa.UUID(), nullable=False),
+    sa.Column('flower_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['flower_id'], ['flowers.id'], ),
+    sa.ForeignKeyConstraint(['session_id'], ['sessions.session_id'], ),
+    sa.PrimaryKeyConstraint('session_id', 'flower_id')
+    )
+    op.create_table('trades',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('seller_id', sa.UUID(), nullable=False),
+    sa.Column('item_id', sa.Integer(), nullable=False),
+    sa.Column('item_amount', sa.Integer(), nullable=False),
+    sa.Column('price', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['item_id'], ['recipes.id'], ),
+    sa.ForeignKeyConstraint(['seller_id'], ['players.player_id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_trades_id'), 'trades', ['id'], unique=False)
+    op.create_table('grimoire_recipes',
+    sa.Column('grimoire_id', sa.Integer(), nullable=False),
+    sa.Column('recipe_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['grimoire_id'], ['grimoires.id'], ),
+    sa.ForeignKeyConstraint(['recipe_id'], ['recipes.id'], ),
+    sa.PrimaryKeyConstraint('grimoire_id', 'recipe_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('grimoire_recipes')
+    op.drop_index(op.f('ix_trades_id'), table_name='trades')
+    op.drop_table('trades')
+    op.drop_table('session_flower_association')
+    op.drop_table('recipe_potions')
+    op.drop_table('recipe_flowers')
+    op.drop_index(op.f('ix_playeraccounts_user_name'), table_name='playeraccounts')
+    op.drop_index(op.f('ix_playeraccounts_id'), table_name='playeraccounts')
+    op.drop_table('playeraccounts')
+    op.drop_table('player_friendships')
+    op.drop_index(op.f('ix_inventory_items_id'), table_name='inventory_items')
+    op.drop_table('inventory_items')
+    op.drop_index(op.f('ix_grimoires_id'), table_name='grimoires')
+    op.drop_table('grimoires')
+    op.drop_table('decoraion_player')
+    with op.batch_alter_table('players') as batch_op:
+        batch_op.drop_constraint('players_session_id_fkey', type_='foreignkey')
+    op.drop_index(op.f('ix_sessions_session_id'), table_name='sessions')
+    op.drop_table('sessions')
+    op.drop_index(op.f('ix_recipes_id'), table_name='recipes')
+    op.drop_table('recipes')
+    op.drop_index(op.f('ix_players_player_id'), table_name='players')
+    op.drop_index(op.f('ix_players_id'), table_name='players')
+    op.drop_table('players')
+    op.drop_index(op.f('ix_flowers_id'), table_name='flowers')
+    op.drop_table('flowers')
+    op.drop_table('decorations')
@@ -0,0 +1,64 @@
+"""hot path indexes
+
+Indexes for the lookups the endpoints do on every request: inventory and decoration
+rows by (player, item), placed decorations by position, friendships from either side,
+the trading board by status, trades by seller, sessions by initial player and players
+by session. The (player, item) pairs and friendships become unique, duplicates left by
+racing requests are merged first.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 19:24:02.481113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0002'
+down_revision: Union[str, Sequence[str], None] = '0001'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def _merge_duplicates(table: str, key: str, total: str = None) -> None:
+    """Keep the oldest row of every key, adding the others' total column to it"""
+    match = " AND ".join(f"d.{c} = {table}.{c}" for c in key.split(", "))
+    if total:
+        op.execute(f"""
+            UPDATE {table} SET {total} = (SELECT SUM(d.{total}) FROM {table} d WHERE {match})
+            WHERE id IN (SELECT MIN(id) FROM {table} GROUP BY {key} HAVING COUNT(*) > 1)
+        """)
+    op.execute(f"DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {key})")
+
+
+def upgrade() -> None:
+    _merge_duplicates('inventory_items', 'player_id, potion_id', 'amount')
+    _merge_duplicates('player_friendships', 'player1_id, player2_id', 'potions_together')
+    _merge_duplicates('decoraion_player', 'player_id, decoration_id')
+
+    op.create_index('ix_inventory_items_player_potion', 'inventory_items', ['player_id', 'potion_id'], unique=True)
+    op.create_index('ix_player_friendships_pair', 'player_friendships', ['player1_id', 'player2_id'], unique=True)
+    op.create_index('ix_player_friendships_player2_id', 'player_friendships', ['player2_id', 'player1_id'], unique=False)
+    op.create_index('ix_decoraion_player_decoration', 'decoraion_player', ['player_id', 'decoration_id'], unique=True)
+    op.create_index('ix_decoraion_player_placed', 'decoraion_player', ['player_id', 'position'], unique=False,
+                    postgresql_where=sa.text('used = true'), sqlite_where=sa.text('used = 1'))
+    op.create_index('ix_trades_status_created_at', 'trades', ['status', 'created_at', 'id'], unique=False)
+    op.create_index(op.f('ix_trades_seller_id'), 'trades', ['seller_id'], unique=False)
+    op.create_index(op.f('ix_sessions_initial_player'), 'sessions', ['initial_player'], unique=False)
+    op.create_index(op.f('ix_players_session_id'), 'players', ['session_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_players_session_id'), table_name='players')
+    op.drop_index(op.f('ix_sessions_initial_player'), table_name='sessions')
+    op.drop_index(op.f('ix_trades_seller_id'), table_name='trades')
+    op.drop_index('ix_trades_status_created_at', table_name='trades')
+    op.drop_index('ix_decoraion_player_placed', table_name='decoraion_player')
+    op.drop_index('ix_decoraion_player_decoration', table_name='decoraion_player')
+    op.drop_index('ix_player_friendships_player2_id', table_name='player_friendships')
+    op.drop_index('ix_player_friendships_pair', table_name='player_friendships')
+    op.drop_index('ix_inventory_items_player_potion', table_name='inventory_items')
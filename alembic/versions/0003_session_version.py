@@ -0,0 +1,34 @@
+"""session version
+
+sessions.version, bumped on every change to a session and used by the session_info
+long-poll. Existing rows start at 0. Databases that were made by create_all after the
+column was added to the model already have it and are left alone.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 21:02:45.118342
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0003'
+down_revision: Union[str, Sequence[str], None] = '0002'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('sessions')}
+    if 'version' not in columns:
+        op.add_column('sessions', sa.Column('version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade() -> None:
+    # batch mode, sqlite can only drop a column by rebuilding the table
+    with op.batch_alter_table('sessions') as batch_op:
+        batch_op.drop_column('version')
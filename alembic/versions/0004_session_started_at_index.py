@@ -0,0 +1,29 @@
+"""session started_at index
+
+Index on sessions.started_at for the session reaper, which looks up sessions older than
+SESSION_MAX_AGE_HOURS on every run.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 10:12:37.604219
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '0004'
+down_revision: Union[str, Sequence[str], None] = '0003'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f('ix_sessions_started_at'), 'sessions', ['started_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_sessions_started_at'), table_name='sessions')
@@ -0,0 +1,228 @@
+"""
+Prometheus metrics, served in the text format by /metrics.
+Counters and histograms keep one shard per thread: a thread only ever writes its own shard, so
+observing takes no lock (request handlers, the threadpool and background threads can all observe),
+and a scrape adds the shards up. Values read by a scrape can be one observation behind, which
+Prometheus does not mind.
+Gauges that are cheaper to look up than to keep current (sessions by status, pool usage) are set
+right before a scrape.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy.engine import Engine
+
+ENABLED = os.getenv("METRICS", "1") != "0"
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+VISION_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60)
+
+LabelValues = Tuple[str, ...]
+
+
+class _Sharded:
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._local = threading.local()
+        self._shards: List[dict] = []
+        self._shards_lock = threading.Lock()  # only taken the first time a thread observes
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _items(self) -> Iterable[Tuple[LabelValues, object]]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        for shard in shards:
+            yield from list(shard.items())
+
+
+class Counter(_Sharded):
+    kind = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        shard = self._shard()
+        shard[label_values] = shard.get(label_values, 0) + amount
+
+    def samples(self):
+        totals: Dict[LabelValues, float] = {}
+        for label_values, value in self._items():
+            totals[label_values] = totals.get(label_values, 0) + value
+        for label_values, value in sorted(totals.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+class Gauge(Counter):
+    """Counter that can go down, increments and decrements may come from different threads"""
+    kind = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(_Sharded):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets=REQUEST_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values: str):
+        shard = self._shard()
+        counts = shard.get(label_values)
+        if counts is None:
+            # one count per bucket, +Inf, then the sum
+            counts = shard[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        totals: Dict[LabelValues, list] = {}
+        for label_values, counts in self._items():
+            total = totals.get(label_values)
+            if total is None:
+                totals[label_values] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    total[i] += count
+        for label_values, counts in sorted(totals.items()):
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+
+
+class SnapshotGauge:
+    """Gauge whose values are replaced as a whole before each scrape"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, values: Dict[LabelValues, float]):
+        self._values = dict(values)
+
+    def samples(self):
+        for label_values, value in sorted(self._values.items()):
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metrics:
+    def __init__(self, enabled: bool = ENABLED):
+        self.enabled = enabled
+        self.requests = Histogram("grimoire_http_request_duration_seconds",
+                                  "Time until the response headers are sent, per route template",
+                                  ("method", "route", "status"))
+        self.in_flight = Gauge("grimoire_http_requests_in_flight", "Requests being handled right now")
+        self.pool_checkout = Histogram("grimoire_db_pool_checkout_seconds",
+                                       "Time to get a connection from the pool, waiting for a free one included",
+                                       ("pool",), CHECKOUT_BUCKETS)
+        self.pool_in_use = SnapshotGauge("grimoire_db_pool_connections_in_use", "Connections checked out of the pool",
+                                         ("pool",))
+        self.vision_calls = Histogram("grimoire_vision_call_duration_seconds",
+                                      "Vision calls including the wait for a free slot, failed ones too",
+                                      ("provider",), VISION_BUCKETS)
+        self.vision_errors = Counter("grimoire_vision_call_errors_total",
+                                     "Failed vision calls by kind: error, timeout or unavailable (breaker open)",
+                                     ("provider", "kind"))
+        self.sessions = SnapshotGauge("grimoire_sessions", "Sessions by status", ("status",))
+        self._metrics = [self.requests, self.in_flight, self.pool_checkout, self.pool_in_use,
+                         self.vision_calls, self.vision_errors, self.sessions]
+
+    def time_checkouts(self, engine: Engine, name: str):
+        """Observe how long connections take to come out of the engine's pool, for an AsyncEngine pass its sync_engine"""
+        if not self.enabled:
+            return
+        pool = engine.pool
+        connect = pool.connect
+
+        def timed_connect():
+            started = time.perf_counter()
+            try:
+                return connect()
+            finally:
+                self.pool_checkout.observe(time.perf_counter() - started, name)
+
+        # engine.dispose() makes a new pool, which is not timed anymore
+        pool.connect = timed_connect
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += "{" + ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items()) + "}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class RequestMetrics:
+    """ASGI middleware observing the latency per route template and the requests in flight"""
+
+    def __init__(self, app, metrics: Metrics = metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.metrics.enabled:
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        observed = False
+
+        def observe(status: int):
+            # the template, not the path, so every player's requests land in the same series
+            route = scope.get("route")
+            self.metrics.requests.observe(time.perf_counter() - started, scope["method"],
+                                          route.path if route else "unmatched", str(status))
+
+        async def send_observed(message):
+            nonlocal observed
+            if message["type"] == "http.response.start":
+                # streamed responses (SSE, NDJSON) are timed until their headers, not until they end
+                observe(message["status"])
+                observed = True
+            await send(message)
+
+        self.metrics.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_observed)
+        finally:
+            self.metrics.in_flight.dec()
+            if not observed:
+                observe(500)
@@ -0,0 +1,68 @@
+"""
+Join code allocator.
+New codes come from walking a random permutation of all 26^5 five-letter codes, so getting a
+free code is one step of a counter instead of generate_code + a db query until it is unused.
+Codes of deleted sessions are not handed out again until the walk has gone through every other
+code and starts over, so a stale code does not lead to somebody else's new lobby.
+Knows the codes in the sessions table as of startup or the last /debug/reload, plus the ones it handed out.
+"""
+import math
+import random
+import string
+import threading
+from typing import Iterable
+
+from fastapi import HTTPException
+
+ALPHABET = string.ascii_uppercase
+
+
+class CodeAllocator:
+    def __init__(self, length: int = 5, seed=None):
+        self.length = length
+        self.size = len(ALPHABET) ** length
+        rng = random.Random(seed)
+        # any step coprime with size visits every code exactly once
+        self._step = rng.randrange(1, self.size)
+        while math.gcd(self._step, self.size) != 1:
+            self._step = rng.randrange(1, self.size)
+        self._offset = rng.randrange(self.size)
+        self._position = 0
+        self._in_use = set()
+        self._lock = threading.Lock()
+
+    def load(self, codes: Iterable[str]):
+        """Mark codes of existing sessions as taken, call on startup.
+        The walk goes on where it was, codes given back in the meantime stay behind it"""
+        with self._lock:
+            self._in_use = set(codes)
+
+    def allocate(self) -> str:
+        with self._lock:
+            # once around at most: until the first wrap only loaded codes are skipped, after it the
+            # codes of sessions that still exist
+            for _ in range(self.size):
+                code = self._code_at((self._offset + self._step * self._position) % self.size)
+                self._position = (self._position + 1) % self.size
+                if code not in self._in_use:
+                    self._in_use.add(code)
+                    return code
+        raise HTTPException(status_code=503, detail="No free join codes")
+
+    def release(self, code: str):
+        """Give back the code of a deleted session, it comes around again on the next pass of the walk"""
+        with self._lock:
+            self._in_use.discard(code)
+
+    def in_use(self) -> int:
+        return len(self._in_use)
+
+    def _code_at(self, index: int) -> str:
+        letters = []
+        for _ in range(self.length):
+            index, letter = divmod(index, len(ALPHABET))
+            letters.append(ALPHABET[letter])
+        return "".join(letters)
+
+
+allocator = CodeAllocator()
@@ -0,0 +1,125 @@
+"""
+Background jobs for collect_flower.
+With background=true the upload is queued and answered with 202 and a job id right away. A small
+pool of workers on the app's event loop identifies the flower and applies it to the session, the
+request handler never waits for the vision model. Finished jobs are kept for COLLECT_JOB_TTL
+seconds so clients can fetch the outcome.
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException
+
+WORKERS = int(os.getenv("COLLECT_JOB_WORKERS", "4"))  # 0 turns background collecting off
+MAX_QUEUED = int(os.getenv("COLLECT_JOB_QUEUE", "100"))
+JOB_TTL = float(os.getenv("COLLECT_JOB_TTL", "600"))  # seconds
+
+
+class CollectJob:
+    __slots__ = ("job_id", "player_id", "status", "result", "error", "status_code", "created_at", "finished_at", "run")
+
+    def __init__(self, player_id: uuid.UUID, run: Callable[[], Awaitable]):
+        self.job_id = uuid.uuid4()
+        self.player_id = player_id
+        self.status = "queued"  # queued, running, done or failed
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+        self.run = run
+
+
+class CollectJobs:
+    def __init__(self, workers: int = WORKERS, max_queued: int = MAX_QUEUED, ttl: float = JOB_TTL):
+        self.workers = workers
+        self.ttl = ttl
+        self._queue = asyncio.Queue(maxsize=max_queued)
+        self._jobs = OrderedDict()  # job_id -> job, oldest first
+        self._tasks = []
+        self.submitted = 0
+        self.done = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    def submit(self, player_id: uuid.UUID, run: Callable[[], Awaitable]) -> CollectJob:
+        """Queue run (a coroutine function) for player_id"""
+        if not self.enabled:
+            raise HTTPException(status_code=400, detail="Background collecting is turned off")
+        self._prune()
+        job = CollectJob(player_id, run)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Too many flowers waiting to be identified, try again")
+        self._jobs[job.job_id] = job
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: uuid.UUID) -> Optional[CollectJob]:
+        return self._jobs.get(job_id)
+
+    def start(self):
+        if self.enabled and not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+
+    def stats(self) -> dict:
+        finished = self.done + self.failed
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize(),
+            "submitted": self.submitted,
+            "done": self.done,
+            "failed": self.failed,
+            "average_seconds": self.total_seconds / finished if finished else 0.0,
+        }
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._jobs:
+            job = next(iter(self._jobs.values()))
+            if job.finished_at is None or now - job.finished_at < self.ttl:
+                break
+            self._jobs.popitem(last=False)
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            job.status = "running"
+            try:
+                job.result = await job.run()
+                job.status = "done"
+                self.done += 1
+            except HTTPException as e:
+                job.status, job.status_code, job.error = "failed", e.status_code, e.detail
+                self.failed += 1
+            except Exception as e:
+                job.status, job.status_code, job.error = "failed", 500, f"Error collecting flower: {e}"
+                self.failed += 1
+                print(f"Collect job {job.job_id} failed: {e}")
+            finally:
+                job.finished_at = time.monotonic()
+                job.run = None
+                self.total_seconds += job.finished_at - job.created_at
+                self._queue.task_done()
+
+
+jobs = CollectJobs()
@@ -0,0 +1,151 @@
+"""
+Local flower color classifier, a fast path ahead of the vision model.
+The center of the prepared photo is turned into an HSV histogram (hue and saturation bins for
+colored pixels, plus dark, gray and light bins) and scored against a prototype per flower color.
+Only clear-cut photos of a colored flower are answered here. Black and white flowers, mostly
+colorless photos and flat frames (a covered lens, a plain wall) still go to the model, which is the
+one that can tell there is no flower at all. Off unless FLOWER_CLASSIFIER=1.
+"""
+import os
+from collections import deque
+from typing import Iterable, Optional
+
+import numpy as np
+from PIL import Image
+
+from image_processing import center_crop
+
+ENABLED = os.getenv("FLOWER_CLASSIFIER", "0") == "1"
+CONFIDENCE = float(os.getenv("FLOWER_CLASSIFIER_CONFIDENCE", "0.75"))  # best / (best + runner-up)
+MIN_COVERAGE = float(os.getenv("FLOWER_CLASSIFIER_MIN_COVERAGE", "0.2"))  # share of center pixels
+MIN_DETAIL = 0.015  # standard deviation of the center's brightness, below it the frame is flat
+CENTER = 0.5  # part of each side of the prepared image that is looked at
+SAMPLE_EDGE = 96  # the center is downscaled to this before building the histogram
+
+HUE_BINS = 24
+HUE_BIN_DEGREES = 360 / HUE_BINS
+SATURATION_SPLIT = 0.6  # pale / vivid
+MIN_SATURATION = 0.25  # below this a pixel counts as dark, gray or light
+MIN_VALUE = 0.2
+LIGHT_VALUE = 0.7
+DARK, GRAY, LIGHT = 2 * HUE_BINS, 2 * HUE_BINS + 1, 2 * HUE_BINS + 2
+BIN_COUNT = 2 * HUE_BINS + 3
+
+# color -> (hue in degrees, hue spread, weight of pale pixels, weight of vivid pixels)
+HUE_PROTOTYPES = {
+    "red": (0, 10, 0.3, 1.0),
+    "coral": (12, 8, 1.0, 0.4),
+    "orange": (30, 9, 0.5, 1.0),
+    "yellow": (55, 10, 1.0, 1.0),
+    "blue": (215, 25, 1.0, 1.0),
+    "lilac": (275, 20, 1.0, 0.4),
+    "pink": (330, 15, 1.0, 0.6),
+}
+# never an answer, it competes with the colors so that a mostly colorless photo (a white flower
+# with a yellow center) is not decided by its few colored pixels
+ACHROMATIC = "achromatic"
+
+
+def _build_prototypes() -> dict:
+    centers = (np.arange(HUE_BINS) + 0.5) * HUE_BIN_DEGREES
+    prototypes = {}
+    for color_id, (hue, spread, pale, vivid) in HUE_PROTOTYPES.items():
+        distance = np.abs((centers - hue + 180) % 360 - 180)
+        weights = np.exp(-0.5 * (distance / spread) ** 2)
+        prototype = np.zeros(BIN_COUNT)
+        prototype[:HUE_BINS] = weights * pale
+        prototype[HUE_BINS:2 * HUE_BINS] = weights * vivid
+        prototypes[color_id] = prototype
+    prototype = np.zeros(BIN_COUNT)
+    prototype[[DARK, GRAY, LIGHT]] = 1.0
+    prototypes[ACHROMATIC] = prototype
+    return prototypes
+
+
+PROTOTYPES = _build_prototypes()
+
+
+class Classification:
+    __slots__ = ("color_id", "confidence", "coverage")
+
+    def __init__(self, color_id: str, confidence: float, coverage: float):
+        self.color_id = color_id
+        self.confidence = confidence
+        self.coverage = coverage
+
+
+def center_hsv(image: Image.Image) -> np.ndarray:
+    """Hue, saturation and value of the downscaled center pixels, all in 0..1"""
+    sample = center_crop(image, CENTER)
+    sample.thumbnail((SAMPLE_EDGE, SAMPLE_EDGE))
+    return np.asarray(sample.convert("HSV"), dtype=np.float32).reshape(-1, 3) / 255
+
+
+def histogram(hsv: np.ndarray) -> np.ndarray:
+    """Share of the center pixels in every bin"""
+    hue, saturation, value = hsv[:, 0] * 360, hsv[:, 1], hsv[:, 2]
+
+    bins = np.minimum((hue // HUE_BIN_DEGREES).astype(np.int64), HUE_BINS - 1)
+    bins += np.where(saturation >= SATURATION_SPLIT, HUE_BINS, 0)
+    achromatic = np.where(value >= LIGHT_VALUE, LIGHT, GRAY)
+    bins = np.where(saturation < MIN_SATURATION, achromatic, bins)
+    bins = np.where(value < MIN_VALUE, DARK, bins)
+    return np.bincount(bins, minlength=BIN_COUNT) / len(bins)
+
+
+def classify(image: Image.Image, valid_colors: Iterable[str]) -> Optional[Classification]:
+    """Color of a clear-cut photo, None when the model should decide"""
+    candidates = [color_id for color_id in valid_colors if color_id in PROTOTYPES and color_id != ACHROMATIC]
+    if len(candidates) < 2:
+        return None
+    hsv = center_hsv(image)
+    if float(hsv[:, 2].std()) < MIN_DETAIL:
+        return None
+    candidates.append(ACHROMATIC)
+    scores = np.array([PROTOTYPES[color_id] for color_id in candidates]) @ histogram(hsv)
+    runner_up, best = np.argsort(scores)[-2:]
+    total = scores[best] + scores[runner_up]
+    confidence = float(scores[best] / total) if total else 0.0
+    coverage = float(scores[best])
+    if candidates[best] == ACHROMATIC or coverage < MIN_COVERAGE or confidence < CONFIDENCE:
+        return None
+    return Classification(candidates[best], confidence, coverage)
+
+
+class ClassifierStats:
+    """How often the fast path answers and identification latency with and without the model"""
+
+    def __init__(self, samples: int = 1000):
+        self.answered = 0
+        self.escalated = 0
+        self._local = deque(maxlen=samples)
+        self._model = deque(maxlen=samples)
+
+    def add_local(self, seconds: float):
+        self.answered += 1
+        self._local.append(seconds)
+
+    def add_escalated(self):
+        self.escalated += 1
+
+    def add_model(self, seconds: float):
+        self._model.append(seconds)
+
+    def as_dict(self) -> dict:
+        total = self.answered + self.escalated
+        result = {
+            "enabled": ENABLED,
+            "answered": self.answered,
+            "escalated": self.escalated,
+            "answered_ratio": self.answered / total if total else 0.0,
+        }
+        for name, samples in (("local", self._local), ("model", self._model)):
+            for percentile in (50, 99):
+                result[f"{name}_p{percentile}_seconds"] = float(np.percentile(samples, percentile)) if samples else None
+        for percentile in (50, 99):
+            local, model = result[f"local_p{percentile}_seconds"], result[f"model_p{percentile}_seconds"]
+            result[f"saved_p{percentile}_seconds"] = model - local if local is not None and model is not None else None
+        return result
+
+
+stats = ClassifierStats()
@@ -0,0 +1,159 @@
+"""
+Per-request SQL statistics.
+Engine events count every statement and its time against the request that ran it (a context
+variable set by the QueryCounts middleware, it follows the request into the AsyncSession's greenlet). The totals
+go out as Server-Timing / X-DB-Queries headers, and every route keeps its query counts and its
+slowest statements in memory for /debug/db_stats, so an N+1 shows up as a growing count.
+Statements run outside a request (session engine flush, reaper, startup) are not counted.
+"""
+import contextvars
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.datastructures import MutableHeaders
+
+ENABLED = os.getenv("DB_METRICS", "1") != "0"
+TOP_STATEMENTS = int(os.getenv("DB_METRICS_TOP_STATEMENTS", "5"))  # slowest statements kept per route
+
+# expanded IN lists and VALUES rows differ in length from request to request, fold them into one
+_PARAMETER_LIST = re.compile(r"\((?:\s*(?:\?|\$\d+|%\(\w+\)s)\s*,)+\s*(?:\?|\$\d+|%\(\w+\)s)\s*\)")
+
+
+class RequestStats:
+    __slots__ = ("queries", "seconds", "statements")
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+        self.statements: Dict[str, List[float]] = {}  # statement -> [count, seconds, slowest]
+
+    def add(self, statement: str, seconds: float):
+        self.queries += 1
+        self.seconds += seconds
+        entry = self.statements.get(statement)
+        if entry is None:
+            self.statements[statement] = [1, seconds, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.seconds * 1000:.1f};desc="{self.queries} queries"'
+
+
+class RouteStats:
+    __slots__ = ("requests", "queries", "max_queries", "seconds", "statements")
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.seconds = 0.0
+        self.statements: Dict[str, List[float]] = {}  # statement -> [count, seconds, slowest]
+
+    def add(self, request: RequestStats):
+        self.requests += 1
+        self.queries += request.queries
+        self.max_queries = max(self.max_queries, request.queries)
+        self.seconds += request.seconds
+        for statement, (count, seconds, slowest) in request.statements.items():
+            entry = self.statements.setdefault(statement, [0, 0.0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+            entry[2] = max(entry[2], slowest)
+        # keep the slowest few, with some slack so a statement can work its way up
+        if len(self.statements) > TOP_STATEMENTS * 4:
+            slowest = sorted(self.statements.items(), key=lambda item: item[1][2], reverse=True)
+            self.statements = dict(slowest[:TOP_STATEMENTS * 2])
+
+    def to_dict(self) -> dict:
+        slowest = sorted(self.statements.items(), key=lambda item: item[1][2], reverse=True)[:TOP_STATEMENTS]
+        return {
+            "requests": self.requests,
+            "queries_avg": round(self.queries / self.requests, 2),
+            "queries_max": self.max_queries,
+            "db_ms_avg": round(self.seconds * 1000 / self.requests, 2),
+            "slowest_statements": [{"statement": statement, "count": count,
+                                    "ms_avg": round(seconds * 1000 / count, 2), "ms_max": round(slowest * 1000, 2)}
+                                   for statement, (count, seconds, slowest) in slowest],
+        }
+
+
+class DbMetrics:
+    def __init__(self, enabled: bool = ENABLED):
+        self.enabled = enabled
+        self._current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("db_request_stats", default=None)
+        self._routes: Dict[str, RouteStats] = {}
+
+    def install(self, engine: Engine):
+        """Listen to the statements of a (sync) engine, for an AsyncEngine pass its sync_engine"""
+        if not self.enabled:
+            return
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+        event.listen(engine, "handle_error", self._error)
+
+    def finish(self, route: str, stats: RequestStats):
+        self._routes.setdefault(route, RouteStats()).add(stats)
+
+    def stats(self) -> dict:
+        """Routes with the most queries per request first"""
+        routes = sorted(self._routes.items(), key=lambda item: item[1].queries / item[1].requests, reverse=True)
+        return {route: stats.to_dict() for route, stats in routes}
+
+    def reset(self):
+        self._routes.clear()
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        if self._current.get() is not None:
+            conn.info.setdefault("db_metrics_started", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self._current.get()
+        if stats is None:
+            return
+        seconds = time.perf_counter() - conn.info["db_metrics_started"].pop()
+        stats.add(_PARAMETER_LIST.sub("(...)", " ".join(statement.split())), seconds)
+
+    def _error(self, exception_context):
+        # a failed statement never reaches _after
+        started = exception_context.connection.info.get("db_metrics_started") if exception_context.connection else None
+        if started:
+            started.pop()
+
+
+metrics = DbMetrics()
+
+
+class QueryCounts:
+    """ASGI middleware putting the request's statements and db time in the response headers, totals per route for /debug/db_stats"""
+
+    def __init__(self, app, metrics: DbMetrics = metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                # streamed bodies (SSE, NDJSON) keep querying after the headers went out, those are not in here
+                headers = MutableHeaders(scope=message)
+                headers["X-DB-Queries"] = str(stats.queries)
+                headers.append("Server-Timing", stats.server_timing())
+                route = scope.get("route")
+                self.metrics.finish(f"{scope['method']} {route.path if route else 'unmatched'}", stats)
+            await send(message)
+
+        token = self.metrics._current.set(stats)
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            self.metrics._current.reset(token)
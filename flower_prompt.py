@@ -0,0 +1,75 @@
+"""
+Flower identification prompt, rendered once per set of flower colors.
+The Jinja template, the JSON schema and the valid colors only change when a flower is added,
+so requests reuse the rendered messages and only attach their own image.
+The colors come from the in-memory game catalog, getting the prompt never touches the db.
+"""
+from typing import List, Optional
+
+from olingo_llm_parser import parse_template_and_schema
+
+import game_catalog
+
+TEMPLATE = "flower_identification_prompt.jinja"
+SCHEMA = "flower_identification_schema.json"
+
+
+class CompiledPrompt:
+    __slots__ = ("version", "valid_colors", "messages", "response_format")
+
+    def __init__(self, version: int, valid_colors: List[str], messages: List[dict], response_format: dict):
+        self.version = version
+        self.valid_colors = valid_colors
+        self.messages = messages
+        self.response_format = response_format
+
+    def with_image(self, image_url: str) -> List[dict]:
+        """Copy of the messages with the image added to the user message"""
+        messages = [dict(message) for message in self.messages]
+        user_message = messages[-1]  # Last message should be the user message
+        user_message["content"] = [
+            {
+                "type": "text",
+                "text": user_message["content"]
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
+                }
+            }
+        ]
+        return messages
+
+
+class FlowerPrompt:
+    def __init__(self):
+        self.version = 0  # bumped when the valid colors change, part of the vision cache key
+        self.builds = 0
+        self._compiled: Optional[CompiledPrompt] = None
+        self._catalog_version = None
+
+    def get(self) -> Optional[CompiledPrompt]:
+        """The prompt for the current flower catalog, None if there are no flowers"""
+        snapshot = game_catalog.catalog.snapshot
+        if snapshot.version == self._catalog_version:
+            return self._compiled
+        valid_colors = snapshot.valid_colors()
+        # recipes and decorations make new catalog versions too, only other colors need a new prompt
+        if self._compiled is None or self._compiled.valid_colors != valid_colors:
+            self.version += 1
+            self._compiled = self._render(valid_colors) if valid_colors else None
+        self._catalog_version = snapshot.version
+        return self._compiled
+
+    def _render(self, valid_colors: List[str]) -> CompiledPrompt:
+        messages, response_format = parse_template_and_schema(
+            template=TEMPLATE,
+            schema=SCHEMA,
+            variables={"valid_colors": valid_colors}
+        )
+        self.builds += 1
+        return CompiledPrompt(self.version, valid_colors, messages, response_format)
+
+
+prompt = FlowerPrompt()
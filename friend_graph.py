@@ -0,0 +1,78 @@
+"""
+Friendship graph kept in memory.
+Every player maps to their friends and the potions brewed together, and the graph keeps the name and
+profile picture of everybody in it, so the friends list is a dictionary lookup instead of a friendship
+scan plus one player query per friend.
+Built from player_friendships and the players' profiles on startup and by /debug/reload, then kept
+current by add/remove friend, finished recipes and profile updates.
+"""
+import threading
+import uuid
+from typing import Dict, Iterable, List, Tuple
+
+# (player_id, name, profile_picture)
+Profile = Tuple[uuid.UUID, str, int]
+
+
+class FriendGraph:
+    def __init__(self):
+        self._friends: Dict[uuid.UUID, Dict[uuid.UUID, int]] = {}
+        self._profiles: Dict[uuid.UUID, Tuple[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def load(self, friendships: Iterable[Tuple[Profile, Profile, int]]):
+        """Replace the graph with (player1, player2, potions_together) rows"""
+        with self._lock:
+            self._friends.clear()
+            self._profiles.clear()
+            for player1, player2, potions_together in friendships:
+                self._add(player1, player2, potions_together)
+
+    def add(self, player1: Profile, player2: Profile, potions_together: int = 0):
+        with self._lock:
+            self._add(player1, player2, potions_together)
+
+    def remove(self, player1_id: uuid.UUID, player2_id: uuid.UUID):
+        with self._lock:
+            for player_id, other_id in ((player1_id, player2_id), (player2_id, player1_id)):
+                friends = self._friends.get(player_id)
+                if friends is None:
+                    continue
+                friends.pop(other_id, None)
+                # players without friends leave the graph
+                if not friends:
+                    del self._friends[player_id]
+                    self._profiles.pop(player_id, None)
+
+    def count_potions(self, pairs: Iterable[Tuple[uuid.UUID, uuid.UUID]]):
+        """One more potion brewed together for every pair of friends"""
+        with self._lock:
+            for player1_id, player2_id in pairs:
+                friends = self._friends.get(player1_id)
+                if friends is None or player2_id not in friends:
+                    continue
+                friends[player2_id] += 1
+                self._friends[player2_id][player1_id] += 1
+
+    def update_profile(self, player_id: uuid.UUID, name: str, profile_picture: int):
+        with self._lock:
+            if player_id in self._profiles:
+                self._profiles[player_id] = (name, profile_picture)
+
+    def friends_of(self, player_id: uuid.UUID) -> List[Tuple[Profile, int]]:
+        """(friend profile, potions_together) in the order the friendships were made"""
+        with self._lock:
+            friends = self._friends.get(player_id, {})
+            return [((friend_id, *self._profiles[friend_id]), potions_together)
+                    for friend_id, potions_together in friends.items()]
+
+    def __len__(self):
+        return len(self._friends)
+
+    def _add(self, player1: Profile, player2: Profile, potions_together: int):
+        for (player_id, name, profile_picture), other in ((player1, player2), (player2, player1)):
+            self._friends.setdefault(player_id, {})[other[0]] = potions_together
+            self._profiles[player_id] = (name, profile_picture)
+
+
+graph = FriendGraph()
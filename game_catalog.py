@@ -0,0 +1,88 @@
+"""
+Game catalog kept in memory: recipes, flowers and decorations.
+The catalog only changes through /recipes/add, /flowers/add, /decorations/add and /debug/reset. Each of
+those loads a new snapshot from the db in one pass and swaps it in as a whole, so a request that took
+the current snapshot keeps seeing one consistent catalog. Snapshots are never changed after they are
+built, validating against them and serving the catalog GET endpoints costs no db round-trip.
+Each snapshot is the recipes, flowers and decorations tables as of that endpoint or /debug/reload.
+"""
+from types import MappingProxyType
+from typing import Iterable, Mapping, NamedTuple, Optional, Tuple
+
+
+class CatalogRecipe(NamedTuple):
+    id: int
+    name: str
+    flower_ids: Tuple[int, ...]
+    potion_ids: Tuple[int, ...]
+
+
+class CatalogFlower(NamedTuple):
+    id: int
+    color_id: str
+    name: str
+
+
+class CatalogDecoration(NamedTuple):
+    id: int
+    name: str
+    cost: int
+    allowed_position: int  # bitmask like 0b10101
+
+    def allows(self, position: int) -> bool:
+        return position >= 0 and bool(self.allowed_position & (1 << position))
+
+
+class Snapshot:
+    __slots__ = ("version", "recipes", "flowers", "flowers_by_color", "decorations")
+
+    def __init__(self, version: int, recipes: Iterable[CatalogRecipe], flowers: Iterable[CatalogFlower],
+                 decorations: Iterable[CatalogDecoration]):
+        self.version = version
+        # by id, in the order they were loaded
+        self.recipes: Mapping[int, CatalogRecipe] = MappingProxyType({recipe.id: recipe for recipe in recipes})
+        self.flowers: Mapping[int, CatalogFlower] = MappingProxyType({flower.id: flower for flower in flowers})
+        by_color = {}
+        for flower in self.flowers.values():
+            by_color.setdefault(flower.color_id, flower)
+        self.flowers_by_color: Mapping[str, CatalogFlower] = MappingProxyType(by_color)
+        self.decorations: Mapping[int, CatalogDecoration] = MappingProxyType(
+            {decoration.id: decoration for decoration in decorations})
+
+    def valid_colors(self) -> list:
+        """Flower colors, sorted so prompts rendered from them don't change between versions"""
+        return sorted(self.flowers_by_color)
+
+
+class Catalog:
+    def __init__(self):
+        self.snapshot = Snapshot(0, (), (), ())
+        self.loads = 0
+
+    def load(self, recipes: Iterable[CatalogRecipe], flowers: Iterable[CatalogFlower],
+             decorations: Iterable[CatalogDecoration]) -> Snapshot:
+        """Build the next snapshot and make it the current one"""
+        snapshot = Snapshot(self.snapshot.version + 1, recipes, flowers, decorations)
+        self.snapshot = snapshot
+        self.loads += 1
+        return snapshot
+
+    def recipe(self, recipe_id: int) -> Optional[CatalogRecipe]:
+        return self.snapshot.recipes.get(recipe_id)
+
+    def flower(self, flower_id: int) -> Optional[CatalogFlower]:
+        return self.snapshot.flowers.get(flower_id)
+
+    def flower_by_color(self, color_id: Optional[str]) -> Optional[CatalogFlower]:
+        return self.snapshot.flowers_by_color.get(color_id)
+
+    def decoration(self, decoration_id: int) -> Optional[CatalogDecoration]:
+        return self.snapshot.decorations.get(decoration_id)
+
+    def stats(self) -> dict:
+        snapshot = self.snapshot
+        return {"version": snapshot.version, "loads": self.loads, "recipes": len(snapshot.recipes),
+                "flowers": len(snapshot.flowers), "decorations": len(snapshot.decorations)}
+
+
+catalog = Catalog()
@@ -0,0 +1,95 @@
+"""
+Grid index over session locations.
+The map is cut into cells of roughly CELL_SIZE meters, every session sits in the cell of its
+initial location. Finding sessions around a player only scans the few cells that overlap
+the search radius instead of computing the distance to every session.
+Holds the sessions table's locations as of startup or the last /debug/reload, plus sessions created here.
+"""
+import math
+import os
+import threading
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+CELL_SIZE = float(os.getenv("SESSION_GRID_CELL_SIZE", "500"))  # meters
+EARTH_RADIUS = 6371008.8  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Distance in meters, close enough to geodesic for a few kilometers"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lng2 - lng1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class GeoIndex:
+    def __init__(self, cell_size: float = CELL_SIZE):
+        self.cell_degrees = cell_size / METERS_PER_DEGREE
+        self._cells = defaultdict(set)
+        self._locations: Dict[uuid.UUID, Tuple[float, float, Tuple[int, int]]] = {}
+        self._lock = threading.Lock()
+
+    def _cell(self, lat: float, lng: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_degrees), math.floor(lng / self.cell_degrees)
+
+    def load(self, locations):
+        """Replace the index with (session_id, lat, lng) rows"""
+        with self._lock:
+            self._cells.clear()
+            self._locations.clear()
+            for session_id, lat, lng in locations:
+                self._add(session_id, lat, lng)
+
+    def add(self, session_id: uuid.UUID, lat: float, lng: float):
+        """Add or move a session"""
+        with self._lock:
+            self._remove(session_id)
+            self._add(session_id, lat, lng)
+
+    def remove(self, session_id: uuid.UUID):
+        with self._lock:
+            self._remove(session_id)
+
+    def nearby(self, lat: float, lng: float, radius: float) -> List[Tuple[uuid.UUID, float]]:
+        """Sessions within radius meters, closest first, as (session_id, distance)"""
+        lat_cells = math.ceil(radius / (self.cell_degrees * METERS_PER_DEGREE))
+        # cells get narrower towards the poles, so more of them are needed along the longitude
+        lng_cells = math.ceil(lat_cells / max(math.cos(math.radians(lat)), 0.01))
+        row, column = self._cell(lat, lng)
+        found = []
+        with self._lock:
+            for r in range(row - lat_cells, row + lat_cells + 1):
+                for c in range(column - lng_cells, column + lng_cells + 1):
+                    for session_id in self._cells.get((r, c), ()):
+                        session_lat, session_lng, _ = self._locations[session_id]
+                        distance = haversine(lat, lng, session_lat, session_lng)
+                        if distance <= radius:
+                            found.append((session_id, distance))
+        found.sort(key=lambda item: item[1])
+        return found
+
+    def __len__(self):
+        return len(self._locations)
+
+    def _add(self, session_id: uuid.UUID, lat: float, lng: float):
+        if lat is None or lng is None:
+            return
+        cell = self._cell(lat, lng)
+        self._cells[cell].add(session_id)
+        self._locations[session_id] = (lat, lng, cell)
+
+    def _remove(self, session_id: uuid.UUID):
+        location = self._locations.pop(session_id, None)
+        if not location:
+            return
+        cell = location[2]
+        self._cells[cell].discard(session_id)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+
+index = GeoIndex()
@@ -0,0 +1,154 @@
+"""
+Preprocessing of uploaded flower photos before they are sent to the vision model.
+Phone photos are several megabytes, the model only needs the dominant petal color, so we
+center-crop, downscale to VISION_IMAGE_MAX_EDGE, re-encode compactly and drop EXIF metadata.
+An average hash of the result lets near-identical photos be recognized without the model.
+Uploads are decoded straight from the spooled upload file and capped at VISION_MAX_UPLOAD_BYTES,
+so a large photo is never held in memory as a whole.
+"""
+import base64
+import os
+import time
+from io import BytesIO
+from typing import BinaryIO, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+MAX_EDGE = int(os.getenv("VISION_IMAGE_MAX_EDGE", "512"))
+CROP = float(os.getenv("VISION_IMAGE_CROP", "0.8"))  # part of each side kept by the center crop
+FORMAT = os.getenv("VISION_IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+QUALITY = int(os.getenv("VISION_IMAGE_QUALITY", "80"))
+MAX_UPLOAD_BYTES = int(os.getenv("VISION_MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+
+CONTENT_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+HASH_SIZE = 8  # the average hash has HASH_SIZE * HASH_SIZE bits
+
+
+class ImageError(Exception):
+    pass
+
+
+class ImageTooLarge(ImageError):
+    pass
+
+
+class PreparedImage:
+    __slots__ = ("data", "content_type", "image", "image_hash", "color_key", "image_url", "original_size", "size",
+                 "seconds")
+
+    def __init__(self, data: bytes, content_type: str, image: Image.Image, image_hash: int, color_key: tuple,
+                 original_size: int, seconds: float):
+        self.data = data
+        self.image = image
+        # encoded once here, in the worker thread, instead of on the event loop
+        self.image_url = f"data:{content_type};base64," + base64.b64encode(data).decode("ascii")
+        self.content_type = content_type
+        self.image_hash = image_hash
+        self.color_key = color_key
+        self.original_size = original_size
+        self.size = len(data)
+        self.seconds = seconds
+
+    def server_timing(self) -> str:
+        return f'image;dur={self.seconds * 1000:.1f};desc="{self.original_size} -> {self.size} bytes"'
+
+    def decoded(self) -> Image.Image:
+        """The shrunk photo, decoded again from `data` once `image` was dropped"""
+        if self.image is None:
+            self.image = Image.open(BytesIO(self.data)).convert("RGB")
+        return self.image
+
+
+class PreprocessStats:
+    def __init__(self):
+        self.images = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.total_seconds = 0.0
+
+    def add(self, prepared: PreparedImage):
+        self.images += 1
+        self.bytes_in += prepared.original_size
+        self.bytes_out += prepared.size
+        self.total_seconds += prepared.seconds
+
+    def as_dict(self) -> dict:
+        return {
+            "images": self.images,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "average_seconds": self.total_seconds / self.images if self.images else 0.0,
+        }
+
+
+stats = PreprocessStats()
+
+
+def center_crop(image: Image.Image, fraction: float = CROP) -> Image.Image:
+    if fraction >= 1:
+        return image
+    width, height = image.size
+    crop_width, crop_height = int(width * fraction), int(height * fraction)
+    left, top = (width - crop_width) // 2, (height - crop_height) // 2
+    return image.crop((left, top, left + crop_width, top + crop_height))
+
+
+def average_hash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """One bit per cell of a tiny grayscale copy, set where the cell is brighter than the mean"""
+    pixels = list(image.convert("L").resize((hash_size, hash_size), Image.Resampling.BOX).getdata())
+    mean = sum(pixels) / len(pixels)
+    image_hash = 0
+    for pixel in pixels:
+        image_hash = (image_hash << 1) | (pixel > mean)
+    return image_hash
+
+
+def color_key(image: Image.Image) -> tuple:
+    """Mean color in 8 steps per channel, the average hash alone does not see color"""
+    return tuple(channel >> 5 for channel in image.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0)))
+
+
+def upload_size(source: BinaryIO) -> int:
+    """Size of a seekable upload without reading it"""
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END)
+    source.seek(position)
+    return size
+
+
+def check_upload_size(size: int):
+    if size > MAX_UPLOAD_BYTES:
+        raise ImageTooLarge(f"Image is larger than the {MAX_UPLOAD_BYTES} byte limit")
+
+
+def prepare_image(source: Union[bytes, BinaryIO]) -> PreparedImage:
+    """Decode, crop, downscale and re-encode an upload, CPU bound so run it in a thread.
+    Takes the bytes or the (seekable) upload file, a file is decoded as it is read"""
+    started = time.perf_counter()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    original_size = upload_size(source)
+    check_upload_size(original_size)
+    source.seek(0)
+    try:
+        with Image.open(source) as image:
+            # let the JPEG decoder skip detail we throw away anyway
+            image.draft("RGB", (MAX_EDGE * 2, MAX_EDGE * 2))
+            # apply the camera rotation before the EXIF data is dropped
+            image = ImageOps.exif_transpose(image)
+            image = center_crop(image)
+            image.thumbnail((MAX_EDGE, MAX_EDGE))
+            image = image.convert("RGB")
+            image_hash = average_hash(image)
+            image_color = color_key(image)
+
+            out = BytesIO()
+            # no exif argument, so no metadata is written
+            image.save(out, FORMAT, quality=QUALITY)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise ImageError(f"Could not read image: {e}")
+
+    prepared = PreparedImage(out.getvalue(), CONTENT_TYPES.get(FORMAT, "image/jpeg"), image, image_hash, image_color,
+                             original_size, time.perf_counter() - started)
+    stats.add(prepared)
+    return prepared
@@ -1,27 +1,153 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import Optional
 
-from sqlalchemy import or_
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy import delete, func, insert, select, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased, selectinload
+from sqlalchemy.orm.exc import StaleDataError
+from typing import BinaryIO, List, Tuple, Union
 import models, schemas
+import app_metrics
+import code_allocator
+import collect_jobs
+import color_classifier
+import db_metrics
+import flower_prompt
+import friend_graph
+import game_catalog
+import geo_index
+import image_processing
 import seed_data
+import session_engine
+import session_events
+import session_reaper
 import utils
-from database import SessionLocal, engine, get_db
+import vision
+import vision_cache
+from database import (AsyncSessionLocal, SessionLocal, async_engine, get_db, get_primary_db, migrate, read_engine,
+                      read_your_writes)
+import asyncio
+import itertools
+import json
 import uuid
 import random
-from datetime import datetime, timedelta
-import base64
+import time
 import openai
-import os
-from olingo_llm_parser import parse_template_and_schema
 
 from schemas import DecorationUsed
 
-# Create tables
-models.Base.metadata.create_all(bind=engine)
+# Create or migrate tables
+migrate()
 
 app = FastAPI(title="My Little Grimoire API", version="1.0.0")
+db_metrics.metrics.install(async_engine.sync_engine)
+app_metrics.metrics.time_checkouts(async_engine.sync_engine, "primary")
+if read_engine is not async_engine:
+    db_metrics.metrics.install(read_engine.sync_engine)
+    app_metrics.metrics.time_checkouts(read_engine.sync_engine, "replica")
+
+def _load_session_indexes(db: Session):
+    """Fill the join code allocator and the location index from existing sessions"""
+    rows = db.query(models.Session.session_id, models.Session.code,
+                    models.Session.initial_lat, models.Session.initial_lng).all()
+    code_allocator.allocator.load(row.code for row in rows)
+    geo_index.index.load((row.session_id, row.initial_lat, row.initial_lng) for row in rows)
+
+def _load_friend_graph(db: Session):
+    """Fill the friend graph from all friendships joined with both players' profiles"""
+    player1, player2 = aliased(models.Player), aliased(models.Player)
+    rows = db.execute(select(models.PlayerFriendship.potions_together,
+                             player1.player_id, player1.name, player1.profile_picture,
+                             player2.player_id, player2.name, player2.profile_picture)
+                      .join(player1, player1.player_id == models.PlayerFriendship.player1_id)
+                      .join(player2, player2.player_id == models.PlayerFriendship.player2_id)
+                      .order_by(models.PlayerFriendship.id))
+    friend_graph.graph.load((row[1:4], row[4:7], row[0]) for row in rows)
+
+def _load_catalog(db: Session):
+    """Build the next catalog snapshot from all recipes, flowers and decorations"""
+    recipes = db.scalars(select(models.Recipe).options(*RECIPE_LOAD).order_by(models.Recipe.id)).all()
+    flowers = db.scalars(select(models.Flower).order_by(models.Flower.id)).all()
+    decorations = db.scalars(select(models.Decoration).order_by(models.Decoration.id)).all()
+    game_catalog.catalog.load(
+        (game_catalog.CatalogRecipe(r.id, r.name, tuple(f.id for f in r.required_flowers),
+                                    tuple(p.id for p in r.required_potions)) for r in recipes),
+        (game_catalog.CatalogFlower(f.id, f.color_id, f.name) for f in flowers),
+        (game_catalog.CatalogDecoration(d.id, d.name, d.cost, d.allowed_position) for d in decorations))
+
+# one catalog load at a time, a slower load that started first must not replace a newer snapshot
+_catalog_lock = asyncio.Lock()
+
+async def _reload_catalog(db: AsyncSession):
+    """Swap in a new catalog snapshot, call after committing a recipe, flower or decoration"""
+    async with _catalog_lock:
+        await db.run_sync(_load_catalog)
+
+async def _reload_from_db(db: AsyncSession):
+    """Rebuild everything startup loads, live sessions of the session engine excepted"""
+    await _reload_catalog(db)
+    await db.run_sync(_load_session_indexes)
+    await db.run_sync(_load_friend_graph)
+
+@app.on_event("startup")
+async def startup():
+    db = SessionLocal()
+    try:
+        _load_session_indexes(db)
+        _load_friend_graph(db)
+        _load_catalog(db)
+    finally:
+        db.close()
+    if session_engine.engine.enabled:
+        await session_engine.engine.startup()
+    session_reaper.reaper.start(_sessions_removed)
+    collect_jobs.jobs.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await session_reaper.reaper.stop()
+    await collect_jobs.jobs.stop()
+    await vision.client.close()
+    if session_engine.engine.enabled:
+        await session_engine.engine.shutdown()
+
+@app.exception_handler(StaleDataError)
+async def session_conflict_handler(request: Request, exc: StaleDataError):
+    """Another request changed the same session first"""
+    return JSONResponse(status_code=409, content={"detail": "Session changed in the meantime, try again"})
+
+# room for the multipart boundaries and headers around the image
+UPLOAD_FORM_OVERHEAD = 64 * 1024
+
+def _upload_body_limit(path: str) -> Optional[int]:
+    """Largest request body accepted by the photo upload routes"""
+    if path == "/debug/identify/batch":
+        return image_processing.MAX_UPLOAD_BYTES * IDENTIFY_BATCH_MAX_IMAGES + UPLOAD_FORM_OVERHEAD
+    if path == "/debug/identify" or path.endswith("/session/collect_flower"):
+        return image_processing.MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+    return None
+
+class UploadSizeLimit:
+    """ASGI middleware rejecting oversized photo uploads from their Content-Length, before the body is read"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        limit = _upload_body_limit(scope["path"]) if scope["type"] == "http" and scope["method"] == "POST" else None
+        if limit:
+            length = dict(scope["headers"]).get(b"content-length", b"")
+            if length.isdigit() and int(length) > limit:
+                response = JSONResponse(status_code=413, content={"detail": "Upload too large"})
+                return await response(scope, receive, send)
+        await self.app(scope, receive, send)
+
+# plain ASGI, an @app.middleware layer would add about 0.2 ms to every request; the last added is outermost
+app.add_middleware(UploadSizeLimit)
+if db_metrics.metrics.enabled:
+    app.add_middleware(db_metrics.QueryCounts)
+app.add_middleware(app_metrics.RequestMetrics)
 
 # Sample endpoints based on the diagram
 
@@ -29,48 +155,88 @@ app = FastAPI(title="My Little Grimoire API", version="1.0.0")
 async def root():
     return {"message": "Welcome to My Little Grimoire API"}
 
+SESSION_STATUS_NAMES = {0: "waiting", 1: "collecting", 2: "brewing"}
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics(db: AsyncSession = Depends(get_db)):
+    """Prometheus metrics in the text format"""
+    metrics = app_metrics.metrics
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are turned off")
+    if session_engine.engine.enabled:
+        statuses = {}
+        for session in session_engine.engine.sessions():
+            statuses[session.status] = statuses.get(session.status, 0) + 1
+    else:
+        statuses = dict((await db.execute(select(models.Session.status, func.count())
+                                          .group_by(models.Session.status))).all())
+    metrics.sessions.set({(SESSION_STATUS_NAMES.get(status, str(status)),): count for status, count in statuses.items()})
+    pools = {"primary": async_engine.sync_engine.pool}
+    if read_engine is not async_engine:
+        pools["replica"] = read_engine.sync_engine.pool
+    metrics.pool_in_use.set({(name,): pool.checkedout() for name, pool in pools.items() if hasattr(pool, "checkedout")})
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 #login endpoints
 @app.post("/register", response_model=schemas.Player, tags=["Account"])
-async def register_player(reg_data: schemas.PlayerRegister, db: Session = Depends(get_db)):
-    existing = db.query(models.PlayerAccount).filter(models.PlayerAccount.user_name == reg_data.user_name).first()
+async def register_player(reg_data: schemas.PlayerRegister, db: AsyncSession = Depends(get_db)):
+    existing = await db.scalar(select(models.PlayerAccount).where(models.PlayerAccount.user_name == reg_data.user_name))
     if existing:
         raise HTTPException(status_code=400, detail="Username already taken.")
 
     # Create Player
     new_player = models.Player()
     db.add(new_player)
-    db.flush()  #
+    await db.flush()  #
 
-    # Create Account
+    # Create Account, bcrypt takes a while so it runs off the event loop
     account = models.PlayerAccount(
         user_name=reg_data.user_name,
-        password_hash=utils.hash_password(reg_data.password),
+        password_hash=await asyncio.to_thread(utils.hash_password, reg_data.password),
         player_id=new_player.id
     )
     db.add(account)
-    db.commit()
+    await db.commit()
 
-    db_grimoire = models.Grimoire(player=new_player)
+    db_grimoire = models.Grimoire(player_id=new_player.player_id)
     db.add(db_grimoire)
-    db.commit()
-    db.refresh(new_player)
+    await db.commit()
     return new_player
 
 @app.post("/login", response_model=schemas.Player, tags=["Account"])
-async def login_player(login_data: schemas.PlayerLogin, db: Session = Depends(get_db)):
-    account = db.query(models.PlayerAccount).filter(models.PlayerAccount.user_name == login_data.user_name).first()
-    if not account or not utils.verify_password(login_data.password, account.password_hash):
+async def login_player(login_data: schemas.PlayerLogin, db: AsyncSession = Depends(get_db)):
+    account = await db.scalar(select(models.PlayerAccount).where(models.PlayerAccount.user_name == login_data.user_name))
+    if not account or not await asyncio.to_thread(utils.verify_password, login_data.password, account.password_hash):
         raise HTTPException(status_code=401, detail="Invalid username or password.")
-    player = db.query(models.Player).filter(models.Player.id == account.player_id).first()
+    player = await db.scalar(select(models.Player).where(models.Player.id == account.player_id))
     return player
 
 # Playerendpoints
+async def _get_player(player_id: uuid.UUID, db: AsyncSession, *options) -> models.Player:
+    """Player by UUID with the given loader options"""
+    player = await db.scalar(select(models.Player).options(*options).where(models.Player.player_id == player_id))
+    if not player:
+        raise HTTPException(status_code=404, detail="Player not found")
+    return player
+
+def player_loader(*options):
+    """Dependency for the player of the path's player_id, the relationships an endpoint
+    reads come with it through the loader options instead of queries afterwards"""
+    async def load_player(player_id: uuid.UUID, db: AsyncSession = Depends(get_db)) -> models.Player:
+        return await _get_player(player_id, db, *options)
+    return load_player
+
+# FastAPI resolves a dependency once per request, endpoints and their helpers share these
+PLAYER = player_loader()
+PLAYER_WITH_INVENTORY = player_loader(selectinload(models.Player.inventory_items))
+PLAYER_WITH_DECORATIONS = player_loader(selectinload(models.Player.decorations))
+
 @app.get("/players", response_model=List[schemas.Player], tags=["Player"])
-async def get_all_players(db: Session = Depends(get_db)):
-    players = db.query(models.Player).all()
+async def get_all_players(db: AsyncSession = Depends(get_db)):
+    players = (await db.scalars(select(models.Player))).all()
     return players
 @app.post("/players/create_noAcc", response_model=schemas.Player, tags = ["Debug", "Player"])
-async def create_player_noAcc(player: schemas.PlayerCreate, db: Session = Depends(get_db)):
+async def create_player_noAcc(player: schemas.PlayerCreate, db: AsyncSession = Depends(get_db)):
     """Create a new player with their grimoire. Created without link to account"""
 
     db_player = models.Player(
@@ -78,210 +244,174 @@ async def create_player_noAcc(player: schemas.PlayerCreate, db: Session = Depend
         profile_picture=player.profile_picture
     )
     db.add(db_player)
-    db.flush()
-    db_grimoire = models.Grimoire(player=db_player)
+    await db.flush()
+    db_grimoire = models.Grimoire(player_id=db_player.player_id)
     db.add(db_grimoire)
-    db.commit()
-    db.refresh(db_player)
+    await db.commit()
     return db_player
 
 @app.post("/players/{player_id}/updateData", response_model=schemas.Player, tags = ["Player"])
-async def update_player_data(player_id: uuid.UUID, player_data: schemas.PlayerBase, db: Session = Depends(get_db)):
+async def update_player_data(player_id: uuid.UUID, player_data: schemas.PlayerBase,
+                             db_player: models.Player = Depends(PLAYER), db: AsyncSession = Depends(get_db)):
     """Use this when just registered or if player changes his data"""
-    db_player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not db_player:
-        raise HTTPException(status_code=404, detail="Player not found.")
-
     if player_data.name:
         db_player.name = player_data.name
     db_player.profile_picture = player_data.profile_picture
 
-    db.commit()
-    db.refresh(db_player)
+    await db.commit()
+    friend_graph.graph.update_profile(player_id, db_player.name, db_player.profile_picture)
+    if session_engine.engine.enabled:
+        session_engine.engine.rename_player(db_player)
+        live_session = session_engine.engine.session_of(player_id)
+        if live_session:
+            _publish_live_session(live_session)
     return db_player
 @app.get("/players/{player_id}", response_model=schemas.Player, tags = ["Player"])
-async def get_player(player_id: uuid.UUID, db: Session = Depends(get_db)):
+async def get_player(db_player: models.Player = Depends(PLAYER)):
     """Get player by UUID"""
-    db_player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not db_player:
-        raise HTTPException(status_code=404, detail="Player not found")
     return db_player
 
 @app.post("/players/{player_id}/add-friend/{other_id}", tags=["Friends"])
-async def add_friend(player_id: uuid.UUID, other_id: uuid.UUID, db: Session = Depends(get_db)):
+async def add_friend(player_id: uuid.UUID, other_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     if player_id == other_id:
         raise HTTPException(status_code=400, detail="Cannot add yourself")
 
-    p1 = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    p2 = db.query(models.Player).filter(models.Player.player_id == other_id).first()
+    p1 = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
+    p2 = await db.scalar(select(models.Player).where(models.Player.player_id == other_id))
     if not p1 or not p2:
         raise HTTPException(status_code=404, detail="Player(s) not found")
 
     id1, id2 = utils.get_ordered_ids(p1.player_id, p2.player_id)
-    existing = db.query(models.PlayerFriendship).filter_by(player1_id=id1, player2_id=id2).first()
+    existing = await db.scalar(select(models.PlayerFriendship).filter_by(player1_id=id1, player2_id=id2))
     if existing:
         raise HTTPException(status_code=400, detail="Already friends")
 
     friendship = models.PlayerFriendship(player1_id=id1, player2_id=id2)
     db.add(friendship)
-    db.commit()
+    await db.commit()
+    friend_graph.graph.add((p1.player_id, p1.name, p1.profile_picture), (p2.player_id, p2.name, p2.profile_picture))
     return {"message": "Friendship created"}
 
 @app.post("/players/{player_id}/remove-friend/{other_id}", tags=["Friends"])
-async def remove_friend(player_id: uuid.UUID, other_id: uuid.UUID, db: Session = Depends(get_db)):
-    p1 = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    p2 = db.query(models.Player).filter(models.Player.player_id == other_id).first()
+async def remove_friend(player_id: uuid.UUID, other_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
+    p1 = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
+    p2 = await db.scalar(select(models.Player).where(models.Player.player_id == other_id))
     if not p1 or not p2:
         raise HTTPException(status_code=404, detail="Player(s) not found")
 
     id1, id2 = utils.get_ordered_ids(p1.player_id, p2.player_id)
-    deleted = db.query(models.PlayerFriendship).filter_by(player1_id=id1, player2_id=id2).delete()
+    result = await db.execute(delete(models.PlayerFriendship).filter_by(player1_id=id1, player2_id=id2))
 
-    if not deleted:
+    if not result.rowcount:
         raise HTTPException(status_code=400, detail="Not friends")
 
-    db.commit()
+    await db.commit()
+    friend_graph.graph.remove(id1, id2)
     return {"message": "Friendship removed"}
 
 @app.get("/players/{player_id}/friends", response_model=List[schemas.FriendshipData], tags=["Friends"])
-async def get_friends(player_id: uuid.UUID, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
+async def get_friends(player_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
+    friends = friend_graph.graph.friends_of(player_id)
+    # only players without friends are not in the graph
+    if not friends and not await db.scalar(select(models.Player.id).where(models.Player.player_id == player_id)):
         raise HTTPException(status_code=404, detail="Player not found")
 
-    friendships = (db.query(models.PlayerFriendship)
-                   .filter(
-                        or_(
-                            models.PlayerFriendship.player1_id == player_id,
-                            models.PlayerFriendship.player2_id == player_id
-                        )
-                    )
-                   .all())
-
-    results = []
-    for friendship in friendships:
-        friend_id = (
-            friendship.player2_id
-            if friendship.player1_id == player_id
-            else friendship.player1_id
-        )
-
-        friend = db.query(models.Player).filter(models.Player.player_id == friend_id).first()
-        if friend:
-            results.append(
-                schemas.FriendshipData(
-                    friend=schemas.FriendInfo(name = friend.name, profile_picture = friend.profile_picture, player_id = friend.player_id),
-                    potions_together=friendship.potions_together
-                )
-            )
-        else:
-            raise HTTPException(status_code=404, detail="Error getting information about friends")
-
-    return results
+    return [schemas.FriendshipData(
+                friend=schemas.FriendInfo(name=name, profile_picture=profile_picture, player_id=friend_id),
+                potions_together=potions_together)
+            for (friend_id, name, profile_picture), potions_together in friends]
 
 
 
 
 #Customers
 @app.put("/players/{player_id}/customer/{customer_id}", response_model=schemas.Player, tags = ["Customers"])
-async def set_customer_id(player_id: uuid.UUID, customer_id: int, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
+async def set_customer_id(customer_id: int, player: models.Player = Depends(PLAYER), db: AsyncSession = Depends(get_db)):
     player.customer_id = customer_id
-    db.commit()
-    db.refresh(player)
+    await db.commit()
     return player
 
 @app.post("/players/{player_id}/customer_post/{customer_id}", response_model=schemas.Player, tags = ["Customers", "Debug"])
-async def set_customer_id_post(player_id: uuid.UUID, customer_id: int, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
+async def set_customer_id_post(customer_id: int, player: models.Player = Depends(PLAYER), db: AsyncSession = Depends(get_db)):
     player.customer_id = customer_id
-    db.commit()
-    db.refresh(player)
+    await db.commit()
     return player
 
 #Money
 @app.post("/players/{player_id}/money/change", response_model=int, tags = ["Money"])
-async def change_player_money(player_id: uuid.UUID, amount: int, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
+async def change_player_money(amount: int, player: models.Player = Depends(PLAYER), db: AsyncSession = Depends(get_db)):
     new_money = max(player.money + amount, 0)
     player.money = new_money
-    db.commit()
-    db.refresh(player)
+    await db.commit()
     return player.money
 
 #Grimoire
 
-def _format_grimoire(grimoire: models.Grimoire, db: Session) -> schemas.Grimoire:
+def _format_grimoire(grimoire: models.Grimoire, db: AsyncSession) -> schemas.Grimoire:
     """Format grimoire"""
     return schemas.Grimoire(unlocked_recipes=[r.id for r in grimoire.unlocked_recipes])
 
 @app.get("/players/{player_id}/grimoire", response_model=schemas.Grimoire, tags = ["Grimoire"])
-async def get_player_grimoire(player_id: uuid.UUID, db: Session = Depends(get_db)):
+async def get_player_grimoire(player_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """Get player's grimoire"""
-    db_grimoire = db.query(models.Grimoire).filter(models.Grimoire.player_id == player_id).first()
+    db_grimoire = await db.scalar(select(models.Grimoire).options(selectinload(models.Grimoire.unlocked_recipes))
+                                  .where(models.Grimoire.player_id == player_id))
     if not db_grimoire:
         raise HTTPException(status_code=404, detail="Grimoire not found")
     return _format_grimoire(db_grimoire, db)
 
 
 @app.post("/players/{player_id}/grimoire/unlock/{recipe_id}", response_model=schemas.Grimoire, tags = ["Grimoire"])
-async def unlock_recipe_for_player(player_id: uuid.UUID, recipe_id: int, db: Session = Depends(get_db)):
+async def unlock_recipe_for_player(player_id: uuid.UUID, recipe_id: int, db: AsyncSession = Depends(get_db)):
     """Add recipe to player's grimoire"""
     # Find grimoire for player
-    db_grimoire = db.query(models.Grimoire).filter(models.Grimoire.player_id == player_id).first()
+    db_grimoire = await db.scalar(select(models.Grimoire).options(selectinload(models.Grimoire.unlocked_recipes))
+                                  .where(models.Grimoire.player_id == player_id))
     if not db_grimoire:
         raise HTTPException(status_code=404, detail="Grimoire not found")
 
     # Find recipe by ID (optional)
-    recipe = db.query(models.Recipe).filter(models.Recipe.id == recipe_id).first()
-    if not recipe:
+    if not game_catalog.catalog.recipe(recipe_id):
         raise HTTPException(status_code=404, detail="Recipe not found")
 
     # Check if recipe is already unlocked
-    if recipe in db_grimoire.unlocked_recipes:
+    unlocked_ids = [r.id for r in db_grimoire.unlocked_recipes]
+    if recipe_id in unlocked_ids:
         raise HTTPException(status_code=404, detail="Recipe is already unlocked")
 
-    # Unlock recipe
-    db_grimoire.unlocked_recipes.append(recipe)
-    db.commit()
-    db.refresh(db_grimoire)
+    # Unlock recipe, a row in the association table, no need to load the recipe for it
+    await db.execute(insert(models.grimoire_recipes).values(grimoire_id=db_grimoire.id, recipe_id=recipe_id))
+    await db.commit()
 
     # Return updated grimoire recipe ids
-    return _format_grimoire(db_grimoire, db)
+    return schemas.Grimoire(unlocked_recipes=sorted(unlocked_ids + [recipe_id]))
 
 #TODO: maybe change to remove
 @app.post("/players/{player_id}/grimoire/lock/{recipe_id}", response_model=schemas.Grimoire, tags = ["Grimoire"])
-async def lock_recipe_for_player(player_id: uuid.UUID, recipe_id: int, db: Session = Depends(get_db)):
+async def lock_recipe_for_player(player_id: uuid.UUID, recipe_id: int, db: AsyncSession = Depends(get_db)):
     """Add recipe to player's grimoire"""
     # Find grimoire for player
-    db_grimoire = db.query(models.Grimoire).filter(models.Grimoire.player_id == player_id).first()
+    db_grimoire = await db.scalar(select(models.Grimoire).options(selectinload(models.Grimoire.unlocked_recipes))
+                                  .where(models.Grimoire.player_id == player_id))
     if not db_grimoire:
         raise HTTPException(status_code=404, detail="Grimoire not found")
 
     # Find recipe by ID (optional)
-    recipe = db.query(models.Recipe).filter(models.Recipe.id == recipe_id).first()
-    if not recipe:
+    if not game_catalog.catalog.recipe(recipe_id):
         raise HTTPException(status_code=404, detail="Recipe not found")
 
     # Check if recipe is already unlocked
-    if recipe in db_grimoire.unlocked_recipes:
+    recipe = next((r for r in db_grimoire.unlocked_recipes if r.id == recipe_id), None)
+    if recipe:
         db_grimoire.unlocked_recipes.remove(recipe)
-        db.commit()
-        db.refresh(db_grimoire)
+        await db.commit()
         return _format_grimoire(db_grimoire, db)
 
     else:
         raise HTTPException(status_code=404, detail="Recipe has not been unlocked yet")
 
 
-def _format_inventory(inventory_items: List[models.InventoryItem], db: Session) -> schemas.Inventory:
+def _format_inventory(inventory_items: List[models.InventoryItem], db: AsyncSession) -> schemas.Inventory:
     """Format inventory"""
     return schemas.Inventory(potions = [schemas.InventoryItem(potion_id = item.potion_id, amount=item.amount)
                 for item in inventory_items
@@ -290,158 +420,125 @@ def _format_inventory(inventory_items: List[models.InventoryItem], db: Session)
 
 # Inventory
 @app.get("/players/{player_id}/inventory", response_model=schemas.Inventory, tags = ["Inventory"])
-async def get_inventory(player_id: uuid.UUID, db: Session = Depends(get_db)):
+async def get_inventory(player: models.Player = Depends(PLAYER_WITH_INVENTORY), db: AsyncSession = Depends(get_db)):
     """Get player's recipe by his UUID"""
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
     return _format_inventory(player.inventory_items, db)
 
 
 @app.post("/players/{player_id}/inventory/add/{potion_id}", response_model=schemas.Inventory, tags = ["Inventory"])
-async def add_potion_to_inventory(player_id: uuid.UUID, potion_id: int, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
-    potion = db.query(models.Recipe).filter(models.Recipe.id == potion_id).first()
-    if not potion:
+async def add_potion_to_inventory(potion_id: int, player: models.Player = Depends(PLAYER_WITH_INVENTORY),
+                                  db: AsyncSession = Depends(get_db)):
+    if not game_catalog.catalog.recipe(potion_id):
         raise HTTPException(status_code=404, detail="Potion does not exist")
 
     # Check if player already has this potion
-    inventory_item = db.query(models.InventoryItem).filter_by(player_id=player_id, potion_id=potion_id).first()
+    inventory_item = next((item for item in player.inventory_items if item.potion_id == potion_id), None)
 
     if inventory_item:
         inventory_item.amount +=1
     else:
-        new_item = models.InventoryItem(player_id=player_id, potion_id=potion_id, amount=1)
-        db.add(new_item)
+        player.inventory_items.append(models.InventoryItem(potion_id=potion_id, amount=1))
 
-    db.commit()
+    await db.commit()
     return _format_inventory(player.inventory_items, db)
 
 
 #TODO: maybe choose from psot to remove (-> notify Maxi later)
 @app.post("/players/{player_id}/inventory/remove/{potion_id}", response_model=schemas.Inventory, tags = ["Inventory"])
-async def remove_potion_from_inventory(player_id: uuid.UUID, potion_id: int, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
-    inventory_item = db.query(models.InventoryItem).filter_by(player_id=player_id, potion_id=potion_id).first()
+async def remove_potion_from_inventory(potion_id: int, player: models.Player = Depends(PLAYER_WITH_INVENTORY),
+                                       db: AsyncSession = Depends(get_db)):
+    inventory_item = next((item for item in player.inventory_items if item.potion_id == potion_id), None)
     if not inventory_item:
         raise HTTPException(status_code=404, detail="Potion not found in inventory")
 
     if inventory_item.amount > 1:
         inventory_item.amount -= 1
     else:
-        db.delete(inventory_item)
+        # delete-orphan cascade deletes the row
+        player.inventory_items.remove(inventory_item)
 
-    db.commit()
+    await db.commit()
     return _format_inventory(player.inventory_items, db)
 
 
 #TODO: ideally merge into previous
-def remove_potion_from_inventory_func(player_id: uuid.UUID, potion_id: int, db: Session):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-       return
-
-    inventory_item = db.query(models.InventoryItem).filter_by(player_id=player_id, potion_id=potion_id).first()
+# does not commit, the caller does
+async def remove_potion_from_inventory_func(player_id: uuid.UUID, potion_id: int, db: AsyncSession):
+    inventory_item = await db.scalar(select(models.InventoryItem).filter_by(player_id=player_id, potion_id=potion_id))
     if not inventory_item:
         return
 
     if inventory_item.amount > 1:
         inventory_item.amount -= 1
     else:
-        db.delete(inventory_item)
-
-    db.commit()
+        await db.delete(inventory_item)
 
 # Decorations
 
-def _format_decorations(inventory_decorations: List[models.DecorationPlayer], db: Session) -> schemas.DecorationInventory:
+def _owned_decoration(player: models.Player, decoration_id: int) -> Optional[models.DecorationPlayer]:
+    return next((d for d in player.decorations if d.decoration_id == decoration_id), None)
+
+def _format_decorations(inventory_decorations: List[models.DecorationPlayer], db: AsyncSession) -> schemas.DecorationInventory:
     """Format decorations"""
     return schemas.DecorationInventory(decorations = [schemas.DecorationPlayer(used = d.used, position = d.position, decoration_id = d.decoration_id) for d in inventory_decorations])
 
 @app.post("/players/{player_id}/decorations/buy/{decoration_id}", response_model=schemas.DecorationInventory, tags = ["Decorations"])
-async def buy_decoration(player_id: uuid.UUID, decoration_id: int, db: Session = Depends(get_db)):
-    decoration = db.query(models.Decoration).get(decoration_id)
+async def buy_decoration(decoration_id: int, player: models.Player = Depends(PLAYER_WITH_DECORATIONS),
+                         db: AsyncSession = Depends(get_db)):
+    decoration = game_catalog.catalog.decoration(decoration_id)
     if not decoration:
         raise HTTPException(404, "Decoration not found")
 
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
     if player.money < decoration.cost:
         raise HTTPException(400, "Insufficient funds")
 
     # Check if already owns
-    already_owned = db.query(models.DecorationPlayer).filter_by(player_id=player_id, decoration_id=decoration_id).first()
-    if already_owned:
+    if _owned_decoration(player, decoration_id):
         raise HTTPException(400, "Already owned")
 
     player.money -= decoration.cost
-    player_decoration = models.DecorationPlayer(player_id=player_id, decoration_id=decoration_id)
-    db.add(player_decoration)
-    db.commit()
+    player.decorations.append(models.DecorationPlayer(decoration_id=decoration_id))
+    await db.commit()
 
     return _format_decorations (player.decorations, db)
 
 
 #Get decorations
 @app.get("/players/{player_id}/decorations", response_model=schemas.DecorationInventory, tags = ["Decorations"])
-async def get_player_decorations(player_id: uuid.UUID, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
+async def get_player_decorations(player: models.Player = Depends(PLAYER_WITH_DECORATIONS), db: AsyncSession = Depends(get_db)):
     return _format_decorations (player.decorations, db)
 
 @app.post("/players/{player_id}/decorations/place/{decoration_id}", response_model=schemas.DecorationInventory, tags = ["Decorations"])
-async def place_decoration(player_id: uuid.UUID, decoration_id: int, position: int, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
-    decoration_player = db.query(models.DecorationPlayer).filter_by(player_id=player_id, decoration_id=decoration_id).first()
+async def place_decoration(decoration_id: int, position: int, player: models.Player = Depends(PLAYER_WITH_DECORATIONS),
+                           db: AsyncSession = Depends(get_db)):
+    decoration_player = _owned_decoration(player, decoration_id)
 
     if not decoration_player:
         raise HTTPException(status_code=404, detail="Player does not own this decoration")
 
-    decoration = db.query(models.Decoration).filter_by(id=decoration_id).first()
+    decoration = game_catalog.catalog.decoration(decoration_id)
     if not decoration:
         raise HTTPException(status_code=404, detail="Decoration not found")
 
     # Check allowed position using bitmask
-    if position < 0 or not (decoration.allowed_position & (1 << position)):
+    if not decoration.allows(position):
         raise HTTPException(status_code=400, detail="Invalid position for this decoration")
 
-    other_at_position = (db.query(models.DecorationPlayer)
-                        .filter(models.DecorationPlayer.player_id == player_id,
-                            models.DecorationPlayer.used == True,
-                            models.DecorationPlayer.position == position)
-                        .first())
-    if other_at_position:
-        # Unplace the other decoration
-        other_at_position.used = False
-        other_at_position.position = None
+    for other_at_position in player.decorations:
+        if other_at_position.used and other_at_position.position == position:
+            # Unplace the other decoration
+            other_at_position.used = False
+            other_at_position.position = None
     decoration_player.used = True
     decoration_player.position = position
-    db.commit()
+    await db.commit()
     return _format_decorations (player.decorations, db)
 
 @app.post("/players/{player_id}/decorations/unplace/{decoration_id}", response_model=schemas.DecorationInventory, tags = ["Decorations"])
-async def unplace_decoration(player_id: uuid.UUID, decoration_id: int, db: Session = Depends(get_db)):
-    # Get player
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
+async def unplace_decoration(decoration_id: int, player: models.Player = Depends(PLAYER_WITH_DECORATIONS),
+                             db: AsyncSession = Depends(get_db)):
     # Check if player owns the decoration
-    decoration_player = db.query(models.DecorationPlayer).filter_by(player_id=player_id, decoration_id=decoration_id
-    ).first()
+    decoration_player = _owned_decoration(player, decoration_id)
 
     if not decoration_player:
         raise HTTPException(status_code=404, detail="Player does not own this decoration")
@@ -453,33 +550,24 @@ async def unplace_decoration(player_id: uuid.UUID, decoration_id: int, db: Sessi
     # Unplace it
     decoration_player.used = False
     decoration_player.position = None
-    db.commit()
+    await db.commit()
 
     return _format_decorations(player.decorations, db)
 @app.get("/players/{player_id}/decorations/used", response_model=List[schemas.DecorationUsed], tags = ["Decorations"])
-async def get_used_decorations(player_id: uuid.UUID, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
-    if not player:
-        raise HTTPException(status_code=404, detail="Player not found")
-
-    used_decorations = db.query(models.DecorationPlayer).filter(
-        models.DecorationPlayer.player_id == player_id,
-        models.DecorationPlayer.used == True
-    ).all()
+async def get_used_decorations(player: models.Player = Depends(PLAYER_WITH_DECORATIONS)):
+    return [schemas.DecorationUsed(decoration_id = d.decoration_id, position = d.position) for d in player.decorations if d.used]
 
-    return [schemas.DecorationUsed(decoration_id = d.decoration_id, position = d.position) for d in used_decorations]
 
 
-
-def _format_player_session_info(players: List[models.Player], db: Session) -> List[schemas.PlayerSessionInfo]:
+def _format_player_session_info(players: List[models.Player], db: AsyncSession) -> List[schemas.PlayerSessionInfo]:
     """Format player session info"""
     return [schemas.PlayerSessionInfo(player_id=p.player_id, name=p.name, assigned_flower=p.assigned_flower,
                                            profile_picture=p.profile_picture) for p in players]
 
-def _format_flowers(flowers: List[models.Flower], db: Session) -> List[int]:
+def _format_flowers(flowers: List[models.Flower], db: AsyncSession) -> List[int]:
     """Format flower to return id only"""
     return [f.id for f in flowers]
-def _format_session_info(session: models.Session, flower: int, db: Session) -> schemas.SessionInfo:
+def _format_session_info(session: models.Session, flower: int, db: AsyncSession) -> schemas.SessionInfo:
     """Format session info"""
     return schemas.SessionInfo(
         recipe_id=session.recipe_id,
@@ -488,56 +576,146 @@ def _format_session_info(session: models.Session, flower: int, db: Session) -> s
         initial_player=session.initial_player,
         flowers_collected=_format_flowers(session.flowers_collected, db),
         players=_format_player_session_info(session.players, db),
-        status=session.status
+        status=session.status,
+        version=session.version
     )
 
+# what _format_session_info reads, there is no lazy loading on an AsyncSession
+SESSION_INFO_LOAD = (selectinload(models.Session.players), selectinload(models.Session.flowers_collected))
+# same for the flowers and potions a recipe needs
+RECIPE_LOAD = (selectinload(models.Recipe.required_flowers), selectinload(models.Recipe.required_potions))
+
+async def _reload_session_info(session: models.Session, db: AsyncSession):
+    """Read players and collected flowers of the session again, after a commit changed them"""
+    await db.refresh(session, ["players", "flowers_collected"])
+
+def _bump_session_version(session: models.Session):
+    """Mark the session as changed for long-polling clients, call before commit"""
+    session.version = (session.version or 0) + 1
+
+# how often a session change is retried when another request changed the session first
+SESSION_COMMIT_RETRIES = 5
+
+async def _commit_session_change(db: AsyncSession) -> bool:
+    """Commit, False if the session version moved on since we read it (sessions are optimistically locked)"""
+    try:
+        await db.commit()
+        return True
+    except StaleDataError:
+        await db.rollback()
+        return False
+
+def _publish_session(session: models.Session, db: AsyncSession):
+    """Push committed session state to everyone streaming this session"""
+    session_events.broadcaster.publish(session.session_id, _format_session_info(session, None, db))
+
+def _publish_session_deleted(session_id: uuid.UUID):
+    """Tell streaming clients that the session is gone"""
+    session_events.broadcaster.publish(session_id, None)
+
+def _sessions_removed(removed):
+    """Clean up after sessions deleted in bulk, removed are (session_id, code) pairs"""
+    for session_id, code in removed:
+        code_allocator.allocator.release(code)
+        geo_index.index.remove(session_id)
+        _publish_session_deleted(session_id)
+
+def _publish_live_session(session: session_engine.LiveSession):
+    """Same as _publish_session for sessions held by the session engine"""
+    if session.deleted:
+        _publish_session_deleted(session.session_id)
+    else:
+        session_events.broadcaster.publish(session.session_id, session_engine.engine.info(session, None))
+
+async def _finish_recipe(initial_player: uuid.UUID, potion_ids: List[int], player_uuids: List[uuid.UUID],
+                         db: AsyncSession) -> List[Tuple[uuid.UUID, uuid.UUID]]:
+    """Take the required potions from the initial player and count the potion for every pair of friends,
+    returns the pairs for the friend graph once the caller committed"""
+    for potion in potion_ids:
+        await remove_potion_from_inventory_func(initial_player, potion, db)
+    pairs = {utils.get_ordered_ids(uuid1, uuid2) for uuid1, uuid2 in itertools.combinations(player_uuids, 2)}
+    if not pairs:
+        return []
+    # one statement for all pairs, only the ones that are friends match
+    friendship = models.PlayerFriendship
+    counted = await db.execute(update(friendship)
+                               .where(tuple_(friendship.player1_id, friendship.player2_id).in_(pairs))
+                               .values(potions_together=friendship.potions_together + 1)
+                               .returning(friendship.player1_id, friendship.player2_id)
+                               .execution_options(synchronize_session=False))
+    return [tuple(row) for row in counted]
+
 """Sessions"""
+def _update_loc_live_session(player_id: uuid.UUID, data: schemas.PlayerLocation) -> schemas.SessionInfo:
+    session = session_engine.engine.update_location(player_id, data.initial_lat, data.initial_lng)
+    _publish_live_session(session)
+    return session_engine.engine.info(session, session.players[player_id].assigned_flower)
+
 #update location
 @app.put("/players/{player_id}/session/update_loc", response_model=schemas.SessionInfo, tags = ["Session"])
-async def update_loc_session(player_id: uuid.UUID, data: schemas.PlayerLocation, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+async def update_loc_session(player_id: uuid.UUID, data: schemas.PlayerLocation, db: AsyncSession = Depends(get_db)):
+    if session_engine.engine.enabled:
+        return _update_loc_live_session(player_id, data)
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     if not player.session_id:
         raise HTTPException(status_code=400, detail="Player not in a session")
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
+    session = await db.scalar(select(models.Session).where(models.Session.session_id == player.session_id))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     if player_id != session.initial_player:
         raise HTTPException(status_code=400, detail="Player is not initial player in this session")
     session.initial_lat = data.initial_lat
     session.initial_lng = data.initial_lng
-    db.commit()
-    db.refresh(session)
+    _bump_session_version(session)
+    await db.commit()
+    geo_index.index.add(session.session_id, data.initial_lat, data.initial_lng)
+    await _reload_session_info(session, db)
+    _publish_session(session, db)
     return _format_session_info(session, player.assigned_flower, db)
 
 @app.post("/players/{player_id}/session/update_loc_post", response_model=schemas.SessionInfo, tags = ["Session"])
-async def update_loc_session_post(player_id: uuid.UUID, data: schemas.PlayerLocation, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+async def update_loc_session_post(player_id: uuid.UUID, data: schemas.PlayerLocation, db: AsyncSession = Depends(get_db)):
+    if session_engine.engine.enabled:
+        return _update_loc_live_session(player_id, data)
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     if not player.session_id:
         raise HTTPException(status_code=400, detail="Player not in a session")
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
+    session = await db.scalar(select(models.Session).where(models.Session.session_id == player.session_id))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     if player_id != session.initial_player:
         raise HTTPException(status_code=400, detail="Player is not initial player in this session")
     session.initial_lat = data.initial_lat
     session.initial_lng = data.initial_lng
-    db.commit()
-    db.refresh(session)
+    _bump_session_version(session)
+    await db.commit()
+    geo_index.index.add(session.session_id, data.initial_lat, data.initial_lng)
+    await _reload_session_info(session, db)
+    _publish_session(session, db)
     return _format_session_info(session, player.assigned_flower, db)
 
+def _in_session(player: models.Player) -> bool:
+    """With the session engine the db can lag behind, so ask the engine"""
+    if session_engine.engine.enabled:
+        return session_engine.engine.session_of(player.player_id) is not None
+    return player.session_id is not None
+
 #create session
 @app.post("/session/create", response_model=schemas.SessionInfo, tags = ["Session"])
-async def create_session(data: schemas.SessionCreate, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == data.player_id).first()
+async def create_session(data: schemas.SessionCreate, db: AsyncSession = Depends(get_db)):
+    player = await db.scalar(select(models.Player)
+                             .options(selectinload(models.Player.grimoire).selectinload(models.Grimoire.unlocked_recipes),
+                                      selectinload(models.Player.inventory_items))
+                             .where(models.Player.player_id == data.player_id))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
-    if player.session_id:
+    if _in_session(player):
         raise HTTPException(status_code=400, detail="Player already in a session")
-    recipe = db.query(models.Recipe).filter(models.Recipe.id == data.recipe_id).first()
+    recipe = game_catalog.catalog.recipe(data.recipe_id)
 
     if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
@@ -547,27 +725,29 @@ async def create_session(data: schemas.SessionCreate, db: Session = Depends(get_
         raise HTTPException(status_code=400, detail="Player has no grimoire")
 
     # Check if the recipe is in the player's unlocked recipes
-    if recipe not in player.grimoire.unlocked_recipes:
+    if not any(r.id == recipe.id for r in player.grimoire.unlocked_recipes):
         raise HTTPException(status_code=403, detail="Recipe is not unlocked by this player")
 
     player_potion_ids = {item.potion_id for item in player.inventory_items}
-    required_potion_ids = {p.id for p in recipe.required_potions}
+    required_potion_ids = set(recipe.potion_ids)
     missing = required_potion_ids - player_potion_ids
     if missing:
          raise HTTPException(status_code=400, detail="Player is missing required potions to start this recipe")
 
+    if session_engine.engine.enabled:
+        join_code = code_allocator.allocator.allocate()
+        live_session = session_engine.engine.create(player, recipe, join_code, data.initial_lat, data.initial_lng)
+        return session_engine.engine.info(live_session, live_session.players[player.player_id].assigned_flower)
+
     #Extract flower color_ids from required flowers
-    available_flowers = list({flower.id for flower in recipe.required_flowers})
+    available_flowers = list(set(recipe.flower_ids))
 
     if not available_flowers:
         raise HTTPException(status_code=400, detail="No available colors in recipe")
 
     assigned_flower = available_flowers.pop(0)
 
-    join_code = utils.generate_code()
-
-    while db.query(models.Session).filter_by(code=join_code).first():
-        join_code = utils.generate_code()
+    join_code = code_allocator.allocator.allocate()
     status = 0
 
     # #change status to collecting
@@ -584,24 +764,30 @@ async def create_session(data: schemas.SessionCreate, db: Session = Depends(get_
         status = status
     )
     db.add(new_session)
-    db.flush()
+    await db.flush()
 
     player.session_id = new_session.session_id
     player.assigned_flower = assigned_flower
-    db.commit()
+    await db.commit()
+    geo_index.index.add(new_session.session_id, data.initial_lat, data.initial_lng)
+    await _reload_session_info(new_session, db)
 
     return _format_session_info(new_session, assigned_flower, db)
 
 
 #start session
 @app.post("/players/{player_id}/session/start", response_model=schemas.SessionInfo, tags = ["Session"])
-async def start_session(player_id: uuid.UUID, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+async def start_session(player_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
+    if session_engine.engine.enabled:
+        live_session = session_engine.engine.start(player_id)
+        _publish_live_session(live_session)
+        return session_engine.engine.info(live_session, live_session.players[player_id].assigned_flower)
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
     if not player.session_id:
         raise HTTPException(status_code=400, detail="Player not in a session")
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
+    session = await db.scalar(select(models.Session).where(models.Session.session_id == player.session_id))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     if player_id != session.initial_player:
@@ -612,95 +798,206 @@ async def start_session(player_id: uuid.UUID, db: Session = Depends(get_db)):
         session.status = 1
     else:
         raise HTTPException(status_code=400, detail="Not enough players")
-    db.commit()
-    db.refresh(session)
+    _bump_session_version(session)
+    await db.commit()
+    await _reload_session_info(session, db)
+    _publish_session(session, db)
     return _format_session_info(session, player.assigned_flower, db)
 
 #Join session
 @app.post("/session/join", response_model=schemas.SessionInfo, tags = ["Session"])
-async def join_session(data: schemas.SessionJoin, db: Session = Depends(get_db)):
+async def join_session(data: schemas.SessionJoin, db: AsyncSession = Depends(get_db)):
     #get player
-    player = db.query(models.Player).filter(models.Player.player_id == data.player_id).first()
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == data.player_id))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
-    if player.session_id:
+    if _in_session(player):
         raise HTTPException(status_code=400, detail="Player already in a session")
 
-    #get session
-    session = db.query(models.Session).filter(models.Session.code == data.code).first()
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    if session.status == 1 or session.status == 2:
-        raise HTTPException(status_code=400, detail="Session already in collecting or brewing stage")
-    #ambiguous
-    if not session.flowers_available:
-        raise HTTPException(status_code=400, detail="No flowers available")
-
-    if not utils.is_within_distance(data.lat, data.lng, session.initial_lat, session.initial_lng):
-        raise HTTPException(status_code=400, detail="Too far from session")
-
+    if session_engine.engine.enabled:
+        live_session = session_engine.engine.join(player, data.code, data.lat, data.lng)
+        _publish_live_session(live_session)
+        return session_engine.engine.info(live_session, live_session.players[player.player_id].assigned_flower)
+
+    for _ in range(SESSION_COMMIT_RETRIES):
+        #get session
+        session = await db.scalar(select(models.Session).where(models.Session.code == data.code))
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        if session.status == 1 or session.status == 2:
+            raise HTTPException(status_code=400, detail="Session already in collecting or brewing stage")
+        #ambiguous
+        if not session.flowers_available:
+            raise HTTPException(status_code=400, detail="No flowers available")
+
+        if not utils.is_within_distance(data.lat, data.lng, session.initial_lat, session.initial_lng):
+            raise HTTPException(status_code=400, detail="Too far from session")
+
+        assigned_flower = session.flowers_available[0]
+        session.flowers_available = session.flowers_available[1:]
+        player.session_id = session.session_id
+        player.assigned_flower = assigned_flower
+
+        # #change to collecting
+        # if not session.flowers_available:
+        #     session.status = 1
+        _bump_session_version(session)
+        if await _commit_session_change(db):
+            break
+    else:
+        raise HTTPException(status_code=409, detail="Session is busy, try again")
+    await _reload_session_info(session, db)
+    _publish_session(session, db)
 
+    return _format_session_info(session, assigned_flower, db)
 
-    assigned_flower = session.flowers_available[0]
-    session.flowers_available = session.flowers_available[1:]
-    player.session_id = session.session_id
-    player.assigned_flower = assigned_flower
 
+# how far and how many sessions the nearby search returns at most
+NEARBY_MAX_RADIUS = 5000
+NEARBY_MAX_RESULTS = 50
 
-    # #change to collecting
-    # if not session.flowers_available:
-    #     session.status = 1
-    db.commit()
-    db.refresh(session)
+@app.get("/session/nearby", response_model=List[schemas.NearbySession], tags = ["Session"])
+async def nearby_sessions(lat: float, lng: float, radius: float = 500, limit: int = 20, db: AsyncSession = Depends(get_db)):
+    """Open sessions that can still be joined, closest first"""
+    radius = min(max(radius, 0), NEARBY_MAX_RADIUS)
+    limit = min(max(limit, 0), NEARBY_MAX_RESULTS)
+    candidates = geo_index.index.nearby(lat, lng, radius)
+    if not candidates:
+        return []
 
-    return _format_session_info(session, assigned_flower, db)
+    results = []
+    if session_engine.engine.enabled:
+        for session_id, distance in candidates:
+            live_session = session_engine.engine.get(session_id)
+            if live_session and live_session.status == 0 and live_session.flowers_available:
+                results.append(schemas.NearbySession(code=live_session.code, recipe_id=live_session.recipe_id,
+                                                     initial_player=live_session.initial_player,
+                                                     players=len(live_session.players),
+                                                     flowers_available=len(live_session.flowers_available),
+                                                     distance=distance))
+                if len(results) >= limit:
+                    break
+        return results
+
+    distances = dict(candidates)
+    sessions = (await db.scalars(select(models.Session)
+                .options(selectinload(models.Session.players))
+                .where(models.Session.session_id.in_(list(distances)), models.Session.status == 0))).all()
+    for session in sessions:
+        if session.flowers_available:
+            results.append(schemas.NearbySession(code=session.code, recipe_id=session.recipe_id,
+                                                 initial_player=session.initial_player,
+                                                 players=len(session.players),
+                                                 flowers_available=len(session.flowers_available),
+                                                 distance=distances[session.session_id]))
+    results.sort(key=lambda r: r.distance)
+    return results[:limit]
 
 
 #Leave all sessions
 @app.post("/players/{player_id}/leaveSession", tags = ["Session"])
-async def leave_session(player_id: uuid.UUID, db: Session = Depends(get_db)):
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+async def leave_session(player_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
+    if session_engine.engine.enabled:
+        live_session, message = session_engine.engine.leave(player_id)
+        _publish_live_session(live_session)
+        return {"message": message}
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player:
         raise HTTPException(status_code=404, detail="Player not found")
-    if not player.session_id:
-        raise HTTPException(status_code=404, detail="Player not in any session")
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
-
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    if player.assigned_flower:
-        session.flowers_available.append(player.assigned_flower)
-
-    player.session_id = None
-    player.assigned_flower = None
-    db.commit()
+    for attempt in range(SESSION_COMMIT_RETRIES):
+        if attempt:
+            # the rollback expired the player
+            await db.refresh(player)
+        if not player.session_id:
+            raise HTTPException(status_code=404, detail="Player not in any session")
+        session = await db.scalar(select(models.Session).where(models.Session.session_id == player.session_id))
+
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        if player.assigned_flower:
+            session.flowers_available.append(player.assigned_flower)
+
+        player.session_id = None
+        player.assigned_flower = None
+        _bump_session_version(session)
+        if await _commit_session_change(db):
+            break
+    else:
+        raise HTTPException(status_code=409, detail="Session is busy, try again")
+    await _reload_session_info(session, db)
     remaining_players = session.players
+    session_id = session.session_id
     if not remaining_players:
-        db.delete(session)
-        db.commit()
+        await db.delete(session)
+        await db.commit()
+        code_allocator.allocator.release(session.code)
+        geo_index.index.remove(session_id)
+        _publish_session_deleted(session_id)
         return {"message": "Left session successfully"}
     #if initial player leaves during collection, stop session
     if session.initial_player == player.player_id and (session.status == 0 or session.status == 1):
-        db.delete(session)
-        db.commit()
+        await db.delete(session)
+        await db.commit()
+        code_allocator.allocator.release(session.code)
+        geo_index.index.remove(session_id)
+        _publish_session_deleted(session_id)
         return {"message": "Left session successfully. It was initial player, so the session was deleted"}
     if session.status == 1:
         session.status = 0
-        db.commit()
+        _bump_session_version(session)
+        await db.commit()
+        _publish_session(session, db)
         return {"message": "Player left. Other player will return to lobby"}
+    _publish_session(session, db)
     return {"message": "Left session successfully"}
 
 
-@app.post("/players/{player_id}/session/collect_flower", response_model=Optional[schemas.SessionInfo], tags = ["Session"])
-async def collect_flower(player_id: uuid.UUID, image: UploadFile = File(...), db: Session = Depends(get_db)):
-    """Collect flower"""
+@app.post("/players/{player_id}/session/collect_flower", response_model=Optional[schemas.SessionInfo], tags = ["Session"],
+          responses={202: {"model": schemas.CollectJob}})
+async def collect_flower(player_id: uuid.UUID, response: Response, image: UploadFile = File(...), background: bool = False,
+                         db: AsyncSession = Depends(get_db)):
+    """Collect flower.
+    With background=true the photo is identified by a worker and the answer is 202 with a job id,
+    the outcome shows up in session_info and at /players/{player_id}/session/collect_jobs/{job_id}"""
+    if session_engine.engine.enabled:
+        live_session, _ = session_engine.engine.player_session(player_id)
+        session_engine.engine.check_collecting(live_session)
+    else:
+        await _collecting_session(player_id, db)
+        # identifying takes seconds (the wait for a free vision slot included), don't hold a pooled
+        # connection through it: end the transaction here, the collect reads player and session again
+        await db.rollback()
+
+    if background:
+        _check_image_type(image.content_type)
+        if image.size is not None and image.size > image_processing.MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Upload too large")
+        # the upload file is closed once the response is sent, the job keeps the shrunk photo instead;
+        # the decoded pixels (768 KB at 512 px) are dropped, so a queued job holds the encoded photo and
+        # its base64 data URL, around a hundred kilobytes
+        prepared = await _prepare_image(image.file)
+        prepared.image = None
+        job = collect_jobs.jobs.submit(player_id, lambda: _collect_flower_job(player_id, prepared))
+        accepted = JSONResponse(status_code=202, content=_format_collect_job(job).model_dump(mode="json"))
+        _add_image_headers(accepted, prepared)
+        return accepted
+
+    flower_response = await _identify_flower(image, response)
+    if session_engine.engine.enabled:
+        return await _collect_identified_flower_live(player_id, flower_response, db)
+    player, session = await _collecting_session(player_id, db)
+    return await _collect_identified_flower(player, session, flower_response, db)
+
+async def _collecting_session(player_id: uuid.UUID, db: AsyncSession):
+    """Player and the session they collect flowers in"""
     #player
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player or not player.session_id:
         raise HTTPException(status_code=404, detail="Player not in a session")
 
     # get session
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
+    session = await db.scalar(select(models.Session).options(*SESSION_INFO_LOAD)
+                              .where(models.Session.session_id == player.session_id))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -709,13 +1006,14 @@ async def collect_flower(player_id: uuid.UUID, image: UploadFile = File(...), db
 
     if session.status == 2:
         raise HTTPException(status_code=400, detail="Session already in brewing stage")
+    return player, session
 
-    flower_response = await identify_flower(image, db)
-
+async def _collect_identified_flower(player: models.Player, session: models.Session,
+                                     flower_response: schemas.FlowerIdentificationResponse, db: AsyncSession) -> schemas.SessionInfo:
     if flower_response.error:
         raise HTTPException(status_code=404, detail=flower_response.error)
 
-    flower = db.query(models.Flower).filter(models.Flower.color_id == flower_response.color_id).first()
+    flower = game_catalog.catalog.flower_by_color(flower_response.color_id)
 
     if not flower:
         raise HTTPException(status_code=404, detail="Flower not found")
@@ -725,196 +1023,390 @@ async def collect_flower(player_id: uuid.UUID, image: UploadFile = File(...), db
         raise HTTPException(status_code=400, detail="You cannot collect this flower! Your flower was identified as " + flower.color_id)
 
     # Add flower to session's collected flowers
-    recipe = db.query(models.Recipe).get(session.recipe_id)
-    recipe_flower_ids = {f.id for f in recipe.required_flowers}
+    recipe = game_catalog.catalog.recipe(session.recipe_id)
+    recipe_flower_ids = set(recipe.flower_ids)
 
     if flower.id not in recipe_flower_ids:
         raise HTTPException(status_code=400, detail="This flower is not required for the recipe. Your flower was identified as "+ flower.color_id)
+    required_potion_ids = list(recipe.potion_ids)
+    # the collected flowers are a relationship, appending needs the mapped flower
+    flower = await db.get(models.Flower, flower.id)
+
+    # the vision call took a while, other players may have collected in the meantime
+    for attempt in range(SESSION_COMMIT_RETRIES):
+        if attempt:
+            # the rollback expired everything we loaded, read it again
+            await db.refresh(player)
+            await db.refresh(flower)
+            session = await db.scalar(select(models.Session).options(*SESSION_INFO_LOAD)
+                                      .where(models.Session.session_id == player.session_id))
+            if not session:
+                raise HTTPException(status_code=404, detail="Session not found")
+            if session.status != 1:
+                raise HTTPException(status_code=400, detail="Session is not collecting flowers anymore")
+
+        session.flowers_collected.append(flower)
+        _bump_session_version(session)
+
+        # Check if recipe requirements are met
+        collected_ids = {f.id for f in session.flowers_collected}
+        friend_pairs = []
+        if recipe_flower_ids.issubset(collected_ids):
+            session.status = 2  # Complete
+            friend_pairs = await _finish_recipe(session.initial_player, required_potion_ids,
+                                                [p.player_id for p in session.players], db)
+
+        if await _commit_session_change(db):
+            break
+    else:
+        raise HTTPException(status_code=409, detail="Session is busy, try again")
+    friend_graph.graph.count_potions(friend_pairs)
+    await _reload_session_info(session, db)
+    _publish_session(session, db)
+    return _format_session_info(session, player.assigned_flower, db)
 
-    session.flowers_collected.append(flower)
+async def _collect_identified_flower_live(player_id: uuid.UUID, flower_response: schemas.FlowerIdentificationResponse,
+                                          db: AsyncSession) -> schemas.SessionInfo:
+    """_collect_identified_flower for sessions held by the session engine"""
+    live_session, live_player = session_engine.engine.player_session(player_id)
+    session_engine.engine.check_collecting(live_session)
 
-    # Check if recipe requirements are met
-    recipe = session.recipe
-    required_ids = {f.id for f in recipe.required_flowers}
-    collected_ids = {f.id for f in session.flowers_collected}
-    if required_ids.issubset(collected_ids):
-        session.status = 2  # Complete
-        for potion in [p.id for p in recipe.required_potions]:
-            remove_potion_from_inventory_func(session.initial_player,potion, db)
-        player_uuids = [p.player_id for p in session.players]
-        for i in range(len(player_uuids)):
-            for j in range(i + 1, len(player_uuids)):
-                uuid1, uuid2 = utils.get_ordered_ids(player_uuids[i], player_uuids[j])
-
-                friendship = db.query(models.PlayerFriendship).filter_by(
-                    player1_id=uuid1,
-                    player2_id=uuid2
-                ).first()
-
-                if friendship:
-                    friendship.potions_together += 1
-
-    db.commit()
-    db.refresh(session)
-    return _format_session_info(session, player.assigned_flower, db)
+    if flower_response.error:
+        raise HTTPException(status_code=404, detail=flower_response.error)
 
-async def identify_flower(image:UploadFile, db:Session):
-    """Identify flower color from an uploaded image using AI vision"""
+    flower = game_catalog.catalog.flower_by_color(flower_response.color_id)
+
+    if not flower:
+        raise HTTPException(status_code=404, detail="Flower not found")
+
+    if flower.id != live_player.assigned_flower:
+        raise HTTPException(status_code=400, detail="You cannot collect this flower! Your flower was identified as " + flower.color_id)
+
+    if flower.id not in live_session.required_flowers:
+        raise HTTPException(status_code=400, detail="This flower is not required for the recipe. Your flower was identified as "+ flower.color_id)
+
+    return await _apply_live_collect(player_id, flower.id, db)
+
+async def _collect_flower_job(player_id: uuid.UUID, prepared: image_processing.PreparedImage) -> schemas.SessionInfo:
+    """collect_flower run by a background worker, a db session is only open around the db work"""
+    compiled = _flower_prompt()
+    flower_response = await _identify_image(prepared, compiled)
+
+    async with AsyncSessionLocal() as db:
+        if session_engine.engine.enabled:
+            return await _collect_identified_flower_live(player_id, flower_response, db)
+        player, session = await _collecting_session(player_id, db)
+        return await _collect_identified_flower(player, session, flower_response, db)
+
+def _format_collect_job(job: collect_jobs.CollectJob) -> schemas.CollectJob:
+    return schemas.CollectJob(job_id=job.job_id, status=job.status, session=job.result,
+                              error=job.error, status_code=job.status_code)
+
+@app.get("/players/{player_id}/session/collect_jobs/{job_id}", response_model=schemas.CollectJob, tags = ["Session"])
+async def collect_job_status(player_id: uuid.UUID, job_id: uuid.UUID):
+    """State of a background collect_flower job"""
+    job = collect_jobs.jobs.get(job_id)
+    if not job or job.player_id != player_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return _format_collect_job(job)
+
+async def _apply_live_collect(player_id: uuid.UUID, flower_id: int, db: AsyncSession) -> schemas.SessionInfo:
+    live_session, completed = session_engine.engine.collect(player_id, flower_id)
+    if completed:
+        friend_pairs = await _finish_recipe(live_session.initial_player, list(live_session.required_potions),
+                                            list(live_session.players), db)
+        await db.commit()
+        friend_graph.graph.count_potions(friend_pairs)
+    _publish_live_session(live_session)
+    return session_engine.engine.info(live_session, live_session.players[player_id].assigned_flower)
+
+async def _identify_flower(image: UploadFile, response: Optional[Response] = None) -> schemas.FlowerIdentificationResponse:
+    """Identify flower color from an uploaded image using AI vision, the photo's sizes go in the response's headers"""
 
     # Validate that the uploaded file is an image
-    if not image.content_type or not image.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="File must be an image")
+    _check_image_type(image.content_type)
+
+    # Uploads without a Content-Length are only known after spooling, check again
+    if image.size is not None and image.size > image_processing.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Upload too large")
+
+    # Prompt and valid colors, rendered once per set of flower colors
+    compiled = _flower_prompt()
+    # decoded straight from the spooled upload file, never read into memory as a whole
+    return await _identify_image(image.file, compiled, response)
 
+def _flower_prompt() -> Optional[flower_prompt.CompiledPrompt]:
+    """The prompt for the current catalog, a broken template or schema is answered like any other identification error"""
     try:
-        # Read the image file
-        image_bytes = await image.read()
+        return flower_prompt.prompt.get()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
-        # Convert image to base64 for OpenAI API
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+def _check_image_type(content_type: Optional[str]):
+    if not content_type or not content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
 
-        # Get valid colors dynamically from the database
-        flowers = db.query(models.Flower).all()
-        valid_colors = list(set(flower.color_id for flower in flowers))
+def _add_image_headers(response: Response, prepared: image_processing.PreparedImage):
+    """Upload and shrunk size of the photo, and the time shrinking it took"""
+    response.headers["X-Image-Bytes"] = f"in={prepared.original_size}, out={prepared.size}"
+    response.headers.append("Server-Timing", prepared.server_timing())
 
-        if not valid_colors:
-            raise HTTPException(status_code=500, detail="No flower colors found in database")
+async def _prepare_image(image_source: BinaryIO) -> image_processing.PreparedImage:
+    """Shrink a photo to what the model needs, off the event loop"""
+    try:
+        return await asyncio.to_thread(image_processing.prepare_image, image_source)
+    except image_processing.ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except image_processing.ImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-        # Parse template and schema
-        messages, response_format = parse_template_and_schema(
-            template="flower_identification_prompt.jinja",
-            schema="flower_identification_schema.json",
-            variables={"valid_colors": valid_colors}
-        )
+async def _identify_image(image_source: Union[BinaryIO, image_processing.PreparedImage],
+                          compiled: Optional[flower_prompt.CompiledPrompt],
+                          response: Optional[Response] = None) -> schemas.FlowerIdentificationResponse:
+    """Identify flower color of an image: cached answer, local classifier, then the vision model"""
 
-        # Add the image to the user message
-        user_message = messages[-1]  # Last message should be the user message
-        user_message["content"] = [
-            {
-                "type": "text",
-                "text": user_message["content"]
-            },
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{image.content_type};base64,{image_base64}"
-                }
-            }
-        ]
-
-        # Get OpenAI API key from environment
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            print("!!!!!!!!!!!!!!!!OpenAI API key not configured")
-            return schemas.FlowerIdentificationResponse(
-                color_id="red"
-            )
-
-        # Initialize OpenAI client
-        client = openai.OpenAI(api_key=api_key)
-
-        # Call OpenAI API with vision capabilities
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=messages,
-            response_format=response_format,
-            max_tokens=300
-        )
+    if not compiled:
+        raise HTTPException(status_code=500, detail="No flower colors found in database")
+
+    try:
+        started = time.perf_counter()
 
-        # Parse the response
-        result = response.choices[0].message.content
+        # Shrink it to what the model needs, off the event loop, queued photos are shrunk already
+        if isinstance(image_source, image_processing.PreparedImage):
+            prepared = image_source
+        else:
+            prepared = await asyncio.to_thread(image_processing.prepare_image, image_source)
+        if response is not None:
+            _add_image_headers(response, prepared)
+
+        # Same or nearly the same photo as a recent one, reuse that answer
+        cached = vision_cache.cache.get(prepared.image_hash, prepared.color_key, compiled.version)
+        if cached:
+            color_id, error = cached
+            if error:
+                raise HTTPException(status_code=400, detail=error)
+            return schemas.FlowerIdentificationResponse(color_id=color_id)
+
+        # Clear-cut colors are decided locally, only ambiguous photos go to the model
+        if color_classifier.ENABLED:
+            guess = await asyncio.to_thread(color_classifier.classify, prepared.decoded(), compiled.valid_colors)
+            if guess:
+                color_classifier.stats.add_local(time.perf_counter() - started)
+                return schemas.FlowerIdentificationResponse(color_id=guess.color_id)
+            color_classifier.stats.add_escalated()
+
+        # Add the base64 image to a copy of the prompt
+        messages = compiled.with_image(prepared.image_url)
+
+        # Ask the vision provider, shared client with limited concurrency, deadline and circuit breaker
+        result = await vision.client.complete(messages, compiled.response_format)
 
         # The response should be JSON thanks to the structured output
-        import json
         parsed_result = json.loads(result)
+        color_classifier.stats.add_model(time.perf_counter() - started)
 
         if parsed_result.get("error") and parsed_result.get("error") != "":
+            vision_cache.cache.put(prepared.image_hash, prepared.color_key, compiled.version, None, parsed_result.get("error"))
             raise HTTPException(status_code=400, detail=parsed_result.get("error"))
 
+        vision_cache.cache.put(prepared.image_hash, prepared.color_key, compiled.version, parsed_result.get("color_id"))
+
         return schemas.FlowerIdentificationResponse(
             color_id=parsed_result.get("color_id")
         )
 
+    except HTTPException:
+        raise
+    except image_processing.ImageTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except image_processing.ImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except vision.VisionTimeout as e:
+        raise HTTPException(status_code=504, detail=str(e))
+    except vision.VisionUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except openai.APIError as e:
         raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
 
+# long-poll timeouts for session_info, in seconds
+SESSION_LONG_POLL_TIMEOUT = 25
+SESSION_LONG_POLL_MAX_TIMEOUT = 60
+
+async def _track_player_session(player_id: uuid.UUID, db: AsyncSession):
+    """Load the player's session version into the broadcaster"""
+    if session_engine.engine.enabled:
+        live_session = session_engine.engine.session_of(player_id)
+        if live_session:
+            session_events.broadcaster.track(live_session.session_id, live_session.version, live_session.players)
+        return
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
+    if not player or not player.session_id:
+        return
+    session = await db.scalar(select(models.Session).options(selectinload(models.Session.players))
+                              .where(models.Session.session_id == player.session_id))
+    if session:
+        session_events.broadcaster.track(session.session_id, session.version, [p.player_id for p in session.players])
+
 @app.get("/players/{player_id}/session/info", response_model=Optional[schemas.SessionInfo], tags = ["Session"])
-async def session_info(player_id: uuid.UUID, db: Session = Depends(get_db)):
-    """Info about a current session"""
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+async def session_info(player_id: uuid.UUID, since_version: Optional[int] = None,
+                       timeout: float = SESSION_LONG_POLL_TIMEOUT, db: AsyncSession = Depends(get_db)):
+    """Info about a current session.
+    With since_version the request waits until the session is newer than that version,
+    if nothing changes before the timeout it returns 304 without reading the db"""
+    if since_version is not None:
+        if session_events.broadcaster.version_for_player(player_id) is None:
+            # nothing known about this session in this process yet, read it once
+            await _track_player_session(player_id, db)
+            await db.rollback()  # give the connection back while we wait
+        timeout = min(max(timeout, 0), SESSION_LONG_POLL_MAX_TIMEOUT)
+        if not await session_events.broadcaster.wait_for_change(player_id, since_version, timeout):
+            return Response(status_code=304)
+
+    if session_engine.engine.enabled:
+        live_session, live_player = session_engine.engine.player_session(player_id)
+        return session_engine.engine.info(live_session, live_player.assigned_flower)
+
+    info = await _read_session_info(player_id, db)
+    if db.bind is not async_engine:
+        known_version = session_events.broadcaster.version_for_player(player_id)
+        if known_version is not None and info.version < known_version:
+            # the replica has not caught up with a change announced here, read it where it was written
+            async with AsyncSessionLocal() as primary:
+                info = await _read_session_info(player_id, primary)
+    return info
+
+async def _read_session_info(player_id: uuid.UUID, db: AsyncSession) -> schemas.SessionInfo:
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player or not player.session_id:
         raise HTTPException(status_code=404, detail="Player not in a session")
 
     # get session
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
+    session = await db.scalar(select(models.Session).options(*SESSION_INFO_LOAD)
+                              .where(models.Session.session_id == player.session_id))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
     return _format_session_info(session, player.assigned_flower, db)
 
+# seconds between keep-alive comments on an idle session stream
+SESSION_STREAM_KEEPALIVE = 15
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _session_event_stream(player_id: uuid.UUID, session_id: uuid.UUID, info: schemas.SessionInfo, request: Request):
+    """Yield the current session state and then only the fields that changed"""
+    queue = session_events.broadcaster.subscribe(session_id)
+    try:
+        last = info.model_dump(mode="json")
+        yield _sse_event("session", last)
+        while not await request.is_disconnected():
+            try:
+                update = await asyncio.wait_for(queue.get(), timeout=SESSION_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if update is None:
+                yield _sse_event("deleted", {})
+                return
+            me = next((p for p in update.players if p.player_id == player_id), None)
+            if me is None:
+                # player left, nothing more to watch
+                yield _sse_event("left", {})
+                return
+            current = update.model_copy(update={"flower_id": me.assigned_flower}).model_dump(mode="json")
+            delta = {key: value for key, value in current.items() if last.get(key) != value}
+            last = current
+            if delta:
+                yield _sse_event("delta", delta)
+    finally:
+        session_events.broadcaster.unsubscribe(session_id, queue)
+
+@app.get("/players/{player_id}/session/stream", tags = ["Session"])
+async def session_stream(player_id: uuid.UUID, request: Request):
+    """Server-Sent Events stream of the player's session.
+    First event is the full session info, after that only changed fields are sent"""
+    if session_engine.engine.enabled:
+        live_session, live_player = session_engine.engine.player_session(player_id)
+        info = session_engine.engine.info(live_session, live_player.assigned_flower)
+        session_id = live_session.session_id
+    else:
+        # not using get_db, the connection would stay checked out for the whole stream
+        async with AsyncSessionLocal() as db:
+            player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
+            if not player or not player.session_id:
+                raise HTTPException(status_code=404, detail="Player not in a session")
+            session = await db.scalar(select(models.Session).options(*SESSION_INFO_LOAD)
+                                      .where(models.Session.session_id == player.session_id))
+            if not session:
+                raise HTTPException(status_code=404, detail="Session not found")
+            info = _format_session_info(session, player.assigned_flower, db)
+            session_id = session.session_id
+
+    return StreamingResponse(
+        _session_event_stream(player_id, session_id, info, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 
 #Overall
 @app.get("/decorations", response_model=List[schemas.DecorationShop], tags = ["Decorations"])
-async def get_all_decorations(db: Session = Depends(get_db)):
+async def get_all_decorations():
     """Get info about all decorations"""
-    return db.query(models.Decoration).all()
+    return [schemas.DecorationShop(name=d.name, id=d.id, cost=d.cost)
+            for d in game_catalog.catalog.snapshot.decorations.values()]
 
 @app.post("/decorations/add", tags = ["Decorations"])
-async def add_decoration(decoration: schemas.DecorationCreate, db: Session = Depends(get_db)):
+async def add_decoration(decoration: schemas.DecorationCreate, db: AsyncSession = Depends(get_db)):
     """Add a new decoration"""
 
-    decoration_db = db.query(models.Decoration).filter(models.Decoration.name == decoration.name).first()
+    decoration_db = await db.scalar(select(models.Decoration).where(models.Decoration.name == decoration.name))
     if decoration_db:
         raise HTTPException(status_code=404, detail="Decoration already exists")
     decoration_db =  models.Decoration(name = decoration.name, cost = decoration.cost, allowed_position = decoration.allowed_position)
     db.add(decoration_db)
-    db.commit()
+    await db.commit()
+    await _reload_catalog(db)
     return {"message": "New decoration added!"}
 
-def _format_recipe_id(recipes: List[models.Recipe], db: Session) -> List[int]:
-    """Format recipe to return id only"""
-    return [r.id for r in recipes]
-
-def _format_recipe (r: models.Recipe, db: Session) -> schemas.Recipe:
+def _format_recipe(r: game_catalog.CatalogRecipe) -> schemas.Recipe:
     """Format recipes to return id only"""
-    return schemas.Recipe(name=r.name, required_flowers=_format_flowers(r.required_flowers, db),
-                          required_potions=_format_recipe_id(r.required_potions, db), id=r.id)
-def _format_recipes(recipes: List[models.Recipe], db: Session) -> List[schemas.Recipe]:
-    """Format recipe info to return id only"""
-    return [_format_recipe(r, db) for r in recipes]
+    return schemas.Recipe(name=r.name, required_flowers=list(r.flower_ids), required_potions=list(r.potion_ids), id=r.id)
+
 @app.get("/recipes", response_model=List[schemas.Recipe], tags = ["Recipe"])
-async def get_all_recipes(db: Session = Depends(get_db)):
+async def get_all_recipes():
     """Get all recipes"""
-    recipes = db.query(models.Recipe).all()
-    return _format_recipes(recipes, db)
+    return [_format_recipe(r) for r in game_catalog.catalog.snapshot.recipes.values()]
 
 @app.get("/recipes/{recipe_id}", response_model=schemas.Recipe, tags = ["Recipe"])
-async def get_recipe(recipe_id: int, db: Session = Depends(get_db)):
+async def get_recipe(recipe_id: int):
     """Get information about recipe"""
-    db_recipe = db.query(models.Recipe).filter(models.Recipe.id == recipe_id).first()
-    if not db_recipe:
+    recipe = game_catalog.catalog.recipe(recipe_id)
+    if not recipe:
         raise HTTPException(status_code=404, detail="Recipe not found")
-    return _format_recipe(db_recipe, db)
+    return _format_recipe(recipe)
 
 @app.post("/recipes/add", tags = ["Recipe"])
-async def add_recipe(recipe: schemas.RecipeCreate, db: Session = Depends(get_db)):
+async def add_recipe(recipe: schemas.RecipeCreate, db: AsyncSession = Depends(get_db)):
     """Add a new recipe"""
 
-    recipe_db = db.query(models.Recipe).filter(models.Recipe.name == recipe.name).first()
+    recipe_db = await db.scalar(select(models.Recipe).where(models.Recipe.name == recipe.name))
     if recipe_db:
         raise HTTPException(status_code=404, detail="Recipe already exists")
 
     flowers = []
 
     for flower_id in recipe.required_flowers:
-        flower_db = db.query(models.Flower).get(flower_id)
+        flower_db = await db.get(models.Flower, flower_id)
         if not flower_db:
             raise HTTPException(status_code=404, detail="Flower for recipe not found")
         flowers.append(flower_db)
     potions = []
     for potion_id in recipe.required_potions:
-        potion_db = db.query(models.Recipe).get(potion_id)
+        potion_db = await db.get(models.Recipe, potion_id)
         if not potion_db:
             raise HTTPException(status_code=404, detail="Potion for recipe not found")
         potions.append(potion_db)
@@ -922,50 +1414,53 @@ async def add_recipe(recipe: schemas.RecipeCreate, db: Session = Depends(get_db)
 
     recipe_db =  models.Recipe(name = recipe.name, required_potions = potions, required_flowers = flowers)
     db.add(recipe_db)
-    db.commit()
+    await db.commit()
+    await _reload_catalog(db)
     return {"message": "New recipe added!"}
 
 
 @app.get("/flowers", response_model=List[schemas.Flower], tags = ["Flower"])
-async def get_all_flowers(db: Session = Depends(get_db)):
+async def get_all_flowers():
     """Get all flowers"""
-    flowers = db.query(models.Flower).all()
-    return flowers
+    return [schemas.Flower(id=f.id, color_id=f.color_id, name=f.name) for f in game_catalog.catalog.snapshot.flowers.values()]
 @app.post("/flowers/add", tags = ["Flower"])
-async def add_flower(color_id: str, name:str, db: Session = Depends(get_db)):
+async def add_flower(color_id: str, name:str, db: AsyncSession = Depends(get_db)):
     """Add a new flower"""
 
-    flower_db = db.query(models.Flower).filter(models.Flower.color_id == color_id).first()
+    flower_db = await db.scalar(select(models.Flower).where(models.Flower.color_id == color_id))
     if flower_db:
         raise HTTPException(status_code=404, detail="Flower with this color already exists")
     flower_db =  models.Flower(color_id = color_id, name = name)
     db.add(flower_db)
-    db.commit()
+    await db.commit()
+    await _reload_catalog(db)
     return {"message": "New flower added!"}
 
 
 # Trading System - Simple Buy/Sell Marketplace
 
+# what _format_trade_response reads
+TRADE_LOAD = (selectinload(models.Trade.seller), selectinload(models.Trade.item))
+
 @app.post("/trading/create", response_model=schemas.TradeResponse, tags=["Trading"])
-async def create_sale(trade: schemas.TradeCreate, seller_id: uuid.UUID, db: Session = Depends(get_db)):
+async def create_sale(trade: schemas.TradeCreate, seller_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """Create a sale listing - put a potion up for sale at a fixed price"""
     
     # Verify seller exists
-    seller = db.query(models.Player).filter(models.Player.player_id == seller_id).first()
+    seller = await db.scalar(select(models.Player).where(models.Player.player_id == seller_id))
     if not seller:
         raise HTTPException(status_code=404, detail="Seller not found")
     
     # Verify seller has the item to sell
-    inventory_item = db.query(models.InventoryItem).filter_by(
+    inventory_item = await db.scalar(select(models.InventoryItem).filter_by(
         player_id=seller_id, 
         potion_id=trade.item_id
-    ).first()
+    ))
     if not inventory_item or inventory_item.amount < trade.item_amount:
         raise HTTPException(status_code=400, detail="Insufficient items in inventory")
     
     # Verify the potion exists
-    potion = db.query(models.Recipe).filter(models.Recipe.id == trade.item_id).first()
-    if not potion:
+    if not game_catalog.catalog.recipe(trade.item_id):
         raise HTTPException(status_code=404, detail="Potion not found")
 
 
@@ -973,7 +1468,7 @@ async def create_sale(trade: schemas.TradeCreate, seller_id: uuid.UUID, db: Sess
     if inventory_item.amount > trade.item_amount:
         inventory_item.amount -= trade.item_amount
     else:
-        db.delete(inventory_item)
+        await db.delete(inventory_item)
     # Create the sale listing
     new_trade = models.Trade(
         seller_id=seller_id,
@@ -982,23 +1477,24 @@ async def create_sale(trade: schemas.TradeCreate, seller_id: uuid.UUID, db: Sess
         price=trade.price
     )
     db.add(new_trade)
-    db.commit()
-    db.refresh(new_trade)
+    await db.commit()
+    await db.refresh(new_trade, ["seller", "item"])
     
     return _format_trade_response(new_trade, db)
 
 
 @app.get("/trading/board", response_model=schemas.TradeBoardResponse, tags=["Trading"])
-async def get_trading_board(skip: int = 0, limit: int = 50, db: Session = Depends(get_db)):
+async def get_trading_board(skip: int = 0, limit: int = 50, db: AsyncSession = Depends(get_db)):
     """Get all available items for sale"""
     
-    trades = db.query(models.Trade).filter(
+    # newest first, a stable order so offset pages do not overlap
+    trades = (await db.scalars(select(models.Trade).options(*TRADE_LOAD).where(
         models.Trade.status == "available"
-    ).offset(skip).limit(limit).all()
+    ).order_by(models.Trade.created_at.desc(), models.Trade.id.desc()).offset(skip).limit(limit))).all()
     
-    total_count = db.query(models.Trade).filter(
+    total_count = await db.scalar(select(func.count()).select_from(models.Trade).where(
         models.Trade.status == "available"
-    ).count()
+    ))
     
     trade_responses = [_format_trade_response(trade, db) for trade in trades]
     
@@ -1009,26 +1505,25 @@ async def get_trading_board(skip: int = 0, limit: int = 50, db: Session = Depend
 
 
 @app.post("/trading/{trade_id}/buy", response_model=schemas.TradeResponse, tags=["Trading"])
-async def buy_item(trade_id: int, buyer_id: uuid.UUID, db: Session = Depends(get_db)):
+async def buy_item(trade_id: int, buyer_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """Buy an item from a sale listing"""
     
     # Get the trade and make sure nobody is currently buying the item
     try:
-        trade = db.query(models.Trade).filter(models.Trade.id == trade_id).with_for_update().first()
+        trade = await db.scalar(select(models.Trade).options(*TRADE_LOAD).where(models.Trade.id == trade_id).with_for_update())
         if not trade:
             raise HTTPException(status_code=404, detail="Trade not found")
     
         if trade.status != "available":
             raise HTTPException(status_code=400, detail="Item is no longer available")
         trade.status = "processing"
-        db.commit()
-        db.refresh(trade)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
     # Verify buyer exists and is not the seller
-    buyer = db.query(models.Player).filter(models.Player.player_id == buyer_id).first()
+    buyer = await db.scalar(select(models.Player).where(models.Player.player_id == buyer_id))
     if not buyer:
         trade.status = "available"
         raise HTTPException(status_code=404, detail="Buyer not found")
@@ -1058,10 +1553,10 @@ async def buy_item(trade_id: int, buyer_id: uuid.UUID, db: Session = Depends(get
     seller.money += trade.price
     
     # Add item to buyer
-    buyer_item = db.query(models.InventoryItem).filter_by(
+    buyer_item = await db.scalar(select(models.InventoryItem).filter_by(
         player_id=buyer_id,
         potion_id=trade.item_id
-    ).first()
+    ))
     
     if buyer_item:
         buyer_item.amount += trade.item_amount
@@ -1076,17 +1571,16 @@ async def buy_item(trade_id: int, buyer_id: uuid.UUID, db: Session = Depends(get
     # Mark trade as sold
     trade.status = "sold"
     
-    db.commit()
-    db.refresh(trade)
+    await db.commit()
     
     return _format_trade_response(trade, db)
 
 
 @app.delete("/trading/{trade_id}/cancel", tags=["Trading"])
-async def cancel_sale(trade_id: int, seller_id: uuid.UUID, db: Session = Depends(get_db)):
+async def cancel_sale(trade_id: int, seller_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """Cancel a sale listing (only the seller can cancel)"""
     try:
-        trade = db.query(models.Trade).filter(models.Trade.id == trade_id).with_for_update().first()
+        trade = await db.scalar(select(models.Trade).where(models.Trade.id == trade_id).with_for_update())
         if not trade:
             raise HTTPException(status_code=404, detail="Trade not found")
 
@@ -1097,17 +1591,16 @@ async def cancel_sale(trade_id: int, seller_id: uuid.UUID, db: Session = Depends
             raise HTTPException(status_code=400, detail="Can only cancel available sales")
 
         trade.status = "cancelled"
-        db.commit()
-        db.refresh(trade)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
     #return item to the seller
-    seller_item = db.query(models.InventoryItem).filter_by(
+    seller_item = await db.scalar(select(models.InventoryItem).filter_by(
         player_id=seller_id,
         potion_id=trade.item_id
-    ).first()
+    ))
     if seller_item:
         seller_item.amount += trade.item_amount
     else:
@@ -1118,21 +1611,21 @@ async def cancel_sale(trade_id: int, seller_id: uuid.UUID, db: Session = Depends
         )
         db.add(new_item)
     
-    db.commit()
+    await db.commit()
     
     return {"message": "Sale cancelled successfully"}
 
 
 @app.get("/players/{player_id}/trades/selling", response_model=List[schemas.TradeResponse], tags=["Trading"])
-async def get_player_sales(player_id: uuid.UUID, db: Session = Depends(get_db)):
+async def get_player_sales(player_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """Get all sales by a player"""
     
-    trades = db.query(models.Trade).filter(models.Trade.seller_id == player_id).all()
+    trades = (await db.scalars(select(models.Trade).options(*TRADE_LOAD).where(models.Trade.seller_id == player_id))).all()
     return [_format_trade_response(trade, db) for trade in trades]
 
 
 # Helper function for trading
-def _format_trade_response(trade: models.Trade, db: Session) -> schemas.TradeResponse:
+def _format_trade_response(trade: models.Trade, db: AsyncSession) -> schemas.TradeResponse:
     """Format a trade for response"""
     
     return schemas.TradeResponse(
@@ -1151,49 +1644,80 @@ def _format_trade_response(trade: models.Trade, db: Session) -> schemas.TradeRes
 
 #for debug only
 @app.post("/debug/reset", tags = ["Debug"])
-async def reset(db: Session = Depends(get_db)):
+async def reset(db: AsyncSession = Depends(get_db)):
     """Reset db to initial state"""
-    seed_data.reset_and_seed_call()
+    await asyncio.to_thread(seed_data.reset_and_seed_call)
+    await _reload_from_db(db)
+    if session_engine.engine.enabled:
+        await db.run_sync(session_engine.engine.recover)
     return {"message": "Done!"}
+
+@app.post("/debug/reload", tags = ["Debug"])
+async def reload_from_db(db: AsyncSession = Depends(get_db)):
+    """Rebuild the in-memory catalog, join codes, location index and friend graph, after another process wrote to the db"""
+    await _reload_from_db(db)
+    return game_catalog.catalog.stats()
 #get all sessions (for debugging)
 @app.get("/debug/sessions", response_model=List[schemas.DebugSessionInfo], tags = ["Debug"])
-async def get_all_sessions(db: Session = Depends(get_db)):
-    """Get all sessions"""
-    sessions = db.query(models.Session).all()
+async def get_all_sessions(db: AsyncSession = Depends(get_primary_db)):
+    """Get all sessions, as the primary has them"""
+    # recipes nest their required potions to any depth, load the whole (small) catalog up front,
+    # held here so the sessions below get these loaded objects from the identity map
+    recipes = (await db.scalars(select(models.Recipe).options(*RECIPE_LOAD))).all()
+    sessions = (await db.scalars(select(models.Session)
+                                 .options(*SESSION_INFO_LOAD, selectinload(models.Session.recipe)))).all()
     return sessions
 
-#clean sessions (based on creation_time)
-
+#clean sessions (based on creation_time), the reaper does the same periodically
 @app.post("/debug/clearStaleSessions", tags = ["Debug"])
-async def clear_stale_sessions(db: Session = Depends(get_db)):
-    """Remove old sessions"""
-    cutoff = datetime.now() - timedelta(days=1)
-    # Fetch all sessions (you could optimize this by filtering in SQL if needed)
-    sessions = db.query(models.Session).all()
-    removed_count = 0
-
-    for session in sessions:
-        is_old = session.started_at < cutoff
-        has_no_players = not session.players or len(session.players) == 0
-
-        if is_old or has_no_players:
-            db.delete(session)
-            removed_count += 1
-
-    db.commit()
-    return removed_count
+async def clear_stale_sessions():
+    """Remove old sessions and sessions without players"""
+    return await session_reaper.reaper.run_once(_sessions_removed)
+
+@app.get("/debug/collect_jobs", tags = ["Debug"])
+async def collect_job_stats():
+    """Counters of the background collect_flower workers"""
+    return collect_jobs.jobs.stats()
+
+@app.get("/debug/db_stats", tags = ["Debug"])
+async def db_stats(reset: bool = False):
+    """Queries and db time per route with their slowest statements, most queries per request first"""
+    stats = db_metrics.metrics.stats()
+    if reset:
+        db_metrics.metrics.reset()
+    return stats
+
+@app.get("/debug/read_replica", tags = ["Debug"])
+async def read_replica_stats():
+    """How GET requests were routed between the replica and the primary"""
+    return read_your_writes.stats()
+
+@app.get("/debug/catalog", tags = ["Debug"])
+async def catalog_stats():
+    """Version and size of the in-memory catalog snapshot"""
+    return game_catalog.catalog.stats()
+
+@app.get("/debug/reaper", tags = ["Debug"])
+async def reaper_stats():
+    """Counters and durations of the stale session reaper"""
+    return session_reaper.reaper.stats()
 
 #Right now: mocked up with flower_ids
 @app.post("/players/{player_id}/session/collect_flower_old/{flower_id}", response_model=Optional[schemas.SessionInfo], tags = ["Debug"])
-async def collect_flower_old( flower_id: int, player_id: uuid.UUID, db: Session = Depends(get_db)):
+async def collect_flower_old( flower_id: int, player_id: uuid.UUID, db: AsyncSession = Depends(get_db)):
     """Collect flower with flower_id, if identifying doesn't work"""
+    if session_engine.engine.enabled:
+        if not game_catalog.catalog.flower(flower_id):
+            raise HTTPException(status_code=404, detail="Flower not found")
+        return await _apply_live_collect(player_id, flower_id, db)
     #player
-    player = db.query(models.Player).filter(models.Player.player_id == player_id).first()
+    player = await db.scalar(select(models.Player).where(models.Player.player_id == player_id))
     if not player or not player.session_id:
         raise HTTPException(status_code=404, detail="Player not in a session")
 
     # get session
-    session = db.query(models.Session).filter(models.Session.session_id == player.session_id).first()
+    session = await db.scalar(select(models.Session).options(*SESSION_INFO_LOAD)
+                              .where(models.Session.session_id == player.session_id))
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -1203,8 +1727,7 @@ async def collect_flower_old( flower_id: int, player_id: uuid.UUID, db: Session
     if session.status == 2:
         raise HTTPException(status_code=400, detail="Session already in brewing stage")
 
-    flower = db.query(models.Flower).filter(models.Flower.id == flower_id).first()
-    if not flower:
+    if not game_catalog.catalog.flower(flower_id):
         raise HTTPException(status_code=404, detail="Flower not found")
 
     # Check if flower color matches player's shears
@@ -1212,116 +1735,76 @@ async def collect_flower_old( flower_id: int, player_id: uuid.UUID, db: Session
         raise HTTPException(status_code=400, detail="You cannot collect this flower!")
 
     # Add flower to session's collected flowers
-    recipe = db.query(models.Recipe).get(session.recipe_id)
-    recipe_flower_ids = {f.id for f in recipe.required_flowers}
+    recipe = game_catalog.catalog.recipe(session.recipe_id)
+    recipe_flower_ids = set(recipe.flower_ids)
 
     if flower_id not in recipe_flower_ids:
         raise HTTPException(status_code=400, detail="This flower is not required for the recipe")
 
-    session.flowers_collected.append(flower)
+    session.flowers_collected.append(await db.get(models.Flower, flower_id))
+    _bump_session_version(session)
 
     # Check if recipe requirements are met
-    recipe = session.recipe
-    required_ids = {f.id for f in recipe.required_flowers}
     collected_ids = {f.id for f in session.flowers_collected}
-    if required_ids.issubset(collected_ids):
+    friend_pairs = []
+    if recipe_flower_ids.issubset(collected_ids):
         session.status = 2  # Complete
-        for potion in [p.id for p in recipe.required_potions]:
-            remove_potion_from_inventory_func(session.initial_player,potion, db)
-        player_uuids = [p.player_id for p in session.players]
-        for i in range(len(player_uuids)):
-            for j in range(i + 1, len(player_uuids)):
-                uuid1, uuid2 = utils.get_ordered_ids(player_uuids[i], player_uuids[j])
-
-                friendship = db.query(models.PlayerFriendship).filter_by(
-                    player1_id=uuid1,
-                    player2_id=uuid2
-                ).first()
-
-                if friendship:
-                    friendship.potions_together += 1
-    db.commit()
-    db.refresh(session)
+        friend_pairs = await _finish_recipe(session.initial_player, list(recipe.potion_ids),
+                                            [p.player_id for p in session.players], db)
+    await db.commit()
+    friend_graph.graph.count_potions(friend_pairs)
+    await _reload_session_info(session, db)
+    _publish_session(session, db)
     return _format_session_info(session, player.assigned_flower, db)
 
 @app.post("/debug/identify", tags = ["Debug"])
-async def identify_flower(image: UploadFile = File(...), db: Session = Depends(get_db)):
+async def identify_flower(response: Response, image: UploadFile = File(...)):
     """Identify flower color from an uploaded image using AI vision"""
-
-    # Validate that the uploaded file is an image
-    if not image.content_type or not image.content_type.startswith('image/'):
-        raise HTTPException(status_code=400, detail="File must be an image")
-
+    return await _identify_flower(image, response)
+
+# most images accepted by one batch identify request
+IDENTIFY_BATCH_MAX_IMAGES = 20
+
+async def _identify_batch_stream(uploads: List[tuple], compiled: Optional[flower_prompt.CompiledPrompt]):
+    """Identify all images concurrently, yield one JSON line per image as soon as it is done"""
+
+    async def identify(index: int, filename: str, content_type: str, image_source: BinaryIO) -> dict:
+        started = time.perf_counter()
+        line = {"index": index, "filename": filename}
+        try:
+            _check_image_type(content_type)
+            result = await _identify_image(image_source, compiled)
+            line.update(status=200, color_id=result.color_id, error=result.error)
+        except HTTPException as e:
+            line.update(status=e.status_code, color_id=None, error=e.detail)
+        line["seconds"] = time.perf_counter() - started
+        return line
+
+    # the vision client's semaphore keeps the number of model calls bounded
+    tasks = [asyncio.create_task(identify(index, *upload)) for index, upload in enumerate(uploads)]
     try:
-        # Read the image file
-        image_bytes = await image.read()
-
-        # Convert image to base64 for OpenAI API
-        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-
-        # Get valid colors dynamically from the database
-        flowers = db.query(models.Flower).all()
-        valid_colors = list(set(flower.color_id for flower in flowers))
-
-        if not valid_colors:
-            raise HTTPException(status_code=500, detail="No flower colors found in database")
-
-        # Parse template and schema
-        messages, response_format = parse_template_and_schema(
-            template="flower_identification_prompt.jinja",
-            schema="flower_identification_schema.json",
-            variables={"valid_colors": valid_colors}
-        )
-
-        # Add the image to the user message
-        user_message = messages[-1]  # Last message should be the user message
-        user_message["content"] = [
-            {
-                "type": "text",
-                "text": user_message["content"]
-            },
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{image.content_type};base64,{image_base64}"
-                }
-            }
-        ]
-
-        # Get OpenAI API key from environment
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            print("!!!!!!!!!!!!!!!!OpenAI API key not configured")
-            return schemas.FlowerIdentificationResponse(
-                color_id="red"
-            )
-
-        # Initialize OpenAI client
-        client = openai.OpenAI(api_key=api_key)
-
-        # Call OpenAI API with vision capabilities
-        response = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=messages,
-            response_format=response_format,
-            max_tokens=300
-        )
-
-        # Parse the response
-        result = response.choices[0].message.content
-
-        # The response should be JSON thanks to the structured output
-        import json
-        parsed_result = json.loads(result)
-
-        if parsed_result.get("error") and parsed_result.get("error") != "":
-            raise HTTPException(status_code=400, detail=parsed_result.get("error"))
-
-        return schemas.FlowerIdentificationResponse(
-            color_id=parsed_result.get("color_id")
-        )
-
-    except openai.APIError as e:
-        raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
\ No newline at end of file
+        for done in asyncio.as_completed(tasks):
+            yield json.dumps(await done) + "\n"
+    finally:
+        # client went away, stop the remaining calls
+        for task in tasks:
+            task.cancel()
+
+@app.post("/debug/identify/batch", tags = ["Debug"])
+async def identify_flower_batch(images: List[UploadFile] = File(...)):
+    """Identify many images in one request.
+    Streams NDJSON, one line per image with its index, in the order the images finish"""
+    if len(images) > IDENTIFY_BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"At most {IDENTIFY_BATCH_MAX_IMAGES} images per batch")
+    # the upload files stay open until the response is finished
+    uploads = [(image.filename, image.content_type, image.file) for image in images]
+
+    compiled = _flower_prompt()
+    return StreamingResponse(_identify_batch_stream(uploads, compiled), media_type="application/x-ndjson")
+
+@app.get("/debug/vision", tags = ["Debug"])
+async def vision_stats():
+    """Concurrency, latency and cache counters of flower identification"""
+    return {**vision.client.stats(), "preprocessing": image_processing.stats.as_dict(),
+            "cache": vision_cache.cache.stats(), "classifier": color_classifier.stats.as_dict(),
+            "prompt": {"catalog_version": flower_prompt.prompt.version, "builds": flower_prompt.prompt.builds}}
@@ -1,6 +1,6 @@
 import random
 
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean, DateTime, Text, Table
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Boolean, DateTime, Text, Table, Index
 from sqlalchemy.ext.mutable import MutableList
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import UUID
@@ -55,6 +55,12 @@ class PlayerFriendship(Base):
 
     potions_together = Column(Integer, default=0, nullable=False)
 
+    # one row per pair, the unique index serves lookups by player1_id, the second one by player2_id
+    __table_args__ = (
+        Index("ix_player_friendships_pair", "player1_id", "player2_id", unique=True),
+        Index("ix_player_friendships_player2_id", "player2_id", "player1_id"),
+    )
+
 def random_name():
     return random.choice(["Alex", "Krystof", "Ben", "Maxi", "Heloisa"])
 
@@ -92,7 +98,7 @@ class Player(Base):
     """
 
     #session
-    session_id = Column(UUID(as_uuid=True), ForeignKey("sessions.session_id", ondelete="SET NULL"), nullable=True)
+    session_id = Column(UUID(as_uuid=True), ForeignKey("sessions.session_id", ondelete="SET NULL"), nullable=True, index=True)
     assigned_flower = Column(Integer, nullable=True)
 
     # Relationships
@@ -147,6 +153,9 @@ class InventoryItem(Base):
     player = relationship("Player", back_populates="inventory_items")
     potion = relationship("Recipe")
 
+    # one stack per potion, every inventory and trading lookup goes by this pair
+    __table_args__ = (Index("ix_inventory_items_player_potion", "player_id", "potion_id", unique=True),)
+
 
 class Flower(Base):
     __tablename__ = "flowers"
@@ -162,12 +171,13 @@ class Session(Base):
     session_id = Column(UUID(as_uuid=True), default=uuid.uuid4, unique=True, index=True, nullable=False)
     recipe_id = Column(Integer, ForeignKey("recipes.id"), nullable=False)
     status = Column(Integer, default=0)  # 0 = in progress, 1 = ended
+    version = Column(Integer, default=0, server_default="0", nullable=False)  # bumped on every change, used for long-polling
     code = Column(String(5), unique=True, nullable=False)  # 5-letter join code
     flowers_available = Column(MutableList.as_mutable(JSON))  # List of color_ids
-    started_at = Column(DateTime, default=datetime.now)
+    started_at = Column(DateTime, default=datetime.now, index=True)
     initial_lat = Column(Float, nullable=True)
     initial_lng = Column(Float, nullable=True)
-    initial_player = Column (UUID(as_uuid=True), ForeignKey("players.player_id", ondelete="CASCADE"), nullable=False)
+    initial_player = Column (UUID(as_uuid=True), ForeignKey("players.player_id", ondelete="CASCADE"), nullable=False, index=True)
     players = relationship(
         "Player",
         back_populates="session",
@@ -179,6 +189,9 @@ class Session(Base):
         secondary=session_flower_association
     )
 
+    # optimistic locking: every UPDATE/DELETE checks the version we read, the app bumps it itself
+    __mapper_args__ = {"version_id_col": version, "version_id_generator": False}
+
 
 #Decorations
 class Decoration(Base):
@@ -203,13 +216,20 @@ class DecorationPlayer(Base):
     player = relationship("Player", back_populates="decorations")
     decoration = relationship("Decoration")
 
+    __table_args__ = (
+        Index("ix_decoraion_player_decoration", "player_id", "decoration_id", unique=True),
+        # only placed decorations are looked up by position
+        Index("ix_decoraion_player_placed", "player_id", "position",
+              postgresql_where=used == True, sqlite_where=used == True),
+    )
+
 
 # Trading System - Simple Sale Listings
 class Trade(Base):
     __tablename__ = "trades"
     
     id = Column(Integer, primary_key=True, index=True)
-    seller_id = Column(UUID(as_uuid=True), ForeignKey("players.player_id", ondelete="CASCADE"), nullable=False)
+    seller_id = Column(UUID(as_uuid=True), ForeignKey("players.player_id", ondelete="CASCADE"), nullable=False, index=True)
     item_id = Column(Integer, ForeignKey("recipes.id"), nullable=False)  # Potion being sold
     item_amount = Column(Integer, nullable=False, default=1)
     price = Column(Integer, nullable=False)  # Fixed sale price
@@ -219,3 +239,7 @@ class Trade(Base):
     # Relationships
     seller = relationship("Player", foreign_keys=[seller_id])
     item = relationship("Recipe")  # The potion being sold
+
+    # the trading board pages through one status newest first
+    # (not a partial index, the status is a bound parameter and prepared statements would skip it)
+    __table_args__ = (Index("ix_trades_status_created_at", "status", "created_at", "id"),)
@@ -109,6 +109,15 @@ class SessionJoin(BaseModel):
         orm_mode = True
 
 
+class NearbySession(BaseModel):
+    code: str
+    recipe_id: int
+    initial_player: uuid.UUID
+    players: int
+    flowers_available: int
+    distance: float  # meters
+
+
 # for debugging
 class PlayerSessionInfo(BaseModel):
     player_id: uuid.UUID
@@ -126,9 +135,18 @@ class SessionInfo(BaseModel):
     players: List[PlayerSessionInfo] =[]
     flowers_collected: List[int]
     status: int
+    version: int = 0
     class Config:
         orm_mode = True
 
+class CollectJob(BaseModel):
+    job_id: uuid.UUID
+    #queued, running, done or failed
+    status: str
+    session: Optional[SessionInfo] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+
 class DebugSessionInfo(BaseModel):
     code: str
     recipe: RecipeDebug
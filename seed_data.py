@@ -3,11 +3,17 @@
 Seed script to populate the database with sample data for testing
 Run this after the database is up to have some initial data to work with
 """
+import os
+import urllib.request
+
 from sqlalchemy import text
 from sqlalchemy.orm import Session
-from database import SessionLocal, engine
+from database import SessionLocal, migrate
 import models
 
+# where the running backend listens, seen from where this script runs (inside the web container by default)
+RELOAD_URL = os.getenv("SEED_RELOAD_URL", "http://localhost:8000/debug/reload")
+
 def create_sample_data():
     db = SessionLocal()
     try:
@@ -248,7 +254,7 @@ def create_seed_trades(db: Session, death_potion, eternal_health, sleep_potion):
             potion_id=eternal_health.id,
             amount=1
         )
-        db.add(eternal_health)
+        db.add(eternal_health_inventory)
         
         # Give players more money for trading
         player1.money = 200
@@ -257,39 +263,6 @@ def create_seed_trades(db: Session, death_potion, eternal_health, sleep_potion):
         
         db.commit()
         
-        # Simple sale listings
-
-        # Player 1 gets 3 Sleep Potions
-        sleep_potion_inventory = models.InventoryItem(
-            player_id=player1.player_id,
-            potion_id=sleep_potion.id,
-            amount=3
-        )
-        db.add(sleep_potion_inventory)
-
-        # Player 2 gets 2 Death Potions
-        death_potion_inventory = models.InventoryItem(
-            player_id=player2.player_id,
-            potion_id=death_potion.id,
-            amount=2
-        )
-        db.add(death_potion_inventory)
-
-        # Player 3 gets 1 Eternal Health potion (legendary)
-        eternal_health_inventory = models.InventoryItem(
-            player_id=player3.player_id,
-            potion_id=eternal_health.id,
-            amount=1
-        )
-        db.add(eternal_health_inventory)
-
-        # Add some money to players for trading
-        player1.money = 200
-        player2.money = 150
-        player3.money = 500
-
-        db.commit()
-
         # Create trade listings
 
         # Sale 1: Sleep Potion for 50 coins (available)
@@ -387,8 +360,17 @@ def reset_db():
         db.close()
 def reset_and_seed_call():
     reset_db()
-    models.Base.metadata.create_all(bind=engine)
+    migrate()
     create_sample_data()
+def reload_backend(url: str = RELOAD_URL):
+    """Tell a running backend to rebuild what it keeps in memory (catalog, join codes, friend graph)"""
+    try:
+        urllib.request.urlopen(urllib.request.Request(url, method="POST"), timeout=30).close()
+        print(f"Backend reloaded ({url})")
+    except OSError as e:
+        print(f"Could not reach the backend at {url} ({e}), restart it or call POST /debug/reload")
+
 if __name__ == "__main__":
     reset_and_seed_call()
+    reload_backend()
 
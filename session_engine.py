@@ -0,0 +1,417 @@
+"""
+In-memory session engine.
+Live sessions (players, free flower slots, collected flowers, status) are kept in small slotted
+objects and the lobby endpoints change them in memory, without going to the db.
+Changes are written to postgres in the background (write-behind), on startup the state is
+loaded back from the db, so a crash loses at most the last flush interval.
+
+Only works with a single uvicorn worker, enable it with SESSION_ENGINE=memory.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy.orm import Session, selectinload
+
+import code_allocator
+import game_catalog
+import geo_index
+import models
+import schemas
+import utils
+from database import SessionLocal
+
+# seconds between two writes of changed sessions to the db
+FLUSH_INTERVAL = float(os.getenv("SESSION_ENGINE_FLUSH_INTERVAL", "0.2"))
+
+
+class LivePlayer:
+    __slots__ = ("player_id", "name", "profile_picture", "assigned_flower")
+
+    def __init__(self, player_id: uuid.UUID, name: str, profile_picture: int, assigned_flower: Optional[int]):
+        self.player_id = player_id
+        self.name = name
+        self.profile_picture = profile_picture
+        self.assigned_flower = assigned_flower
+
+
+class LiveSession:
+    __slots__ = ("session_id", "code", "recipe_id", "status", "version", "initial_player",
+                 "initial_lat", "initial_lng", "started_at", "flowers_available",
+                 "flowers_collected", "players", "required_flowers", "required_potions", "deleted")
+
+    def __init__(self, session_id: uuid.UUID, code: str, recipe_id: int, initial_player: uuid.UUID,
+                 initial_lat: float, initial_lng: float, flowers_available: List[int],
+                 required_flowers: Iterable[int], required_potions: Iterable[int]):
+        self.session_id = session_id
+        self.code = code
+        self.recipe_id = recipe_id
+        self.status = 0
+        self.version = 0
+        self.initial_player = initial_player
+        self.initial_lat = initial_lat
+        self.initial_lng = initial_lng
+        self.started_at = datetime.now()
+        self.flowers_available = flowers_available
+        self.flowers_collected = []
+        self.players: Dict[uuid.UUID, LivePlayer] = {}
+        self.required_flowers = frozenset(required_flowers)
+        self.required_potions = tuple(required_potions)
+        self.deleted = False
+
+    def snapshot(self) -> dict:
+        """Plain copy of the state that can be written from another thread"""
+        return {
+            "session_id": self.session_id,
+            "code": self.code,
+            "recipe_id": self.recipe_id,
+            "status": self.status,
+            "version": self.version,
+            "initial_player": self.initial_player,
+            "initial_lat": self.initial_lat,
+            "initial_lng": self.initial_lng,
+            "started_at": self.started_at,
+            "flowers_available": list(self.flowers_available),
+            "flowers_collected": list(self.flowers_collected),
+            "players": [(p.player_id, p.assigned_flower) for p in self.players.values()],
+            "deleted": self.deleted,
+        }
+
+
+class SessionEngine:
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._sessions: Dict[uuid.UUID, LiveSession] = {}
+        self._codes: Dict[str, uuid.UUID] = {}
+        self._player_sessions: Dict[uuid.UUID, uuid.UUID] = {}
+        self._dirty: Dict[uuid.UUID, LiveSession] = {}
+        self._wakeup = None
+        self._flusher = None
+
+    # Lookups
+
+    def session_of(self, player_id: uuid.UUID) -> Optional[LiveSession]:
+        session_id = self._player_sessions.get(player_id)
+        return self._sessions.get(session_id)
+
+    def by_code(self, code: str) -> Optional[LiveSession]:
+        return self._sessions.get(self._codes.get(code))
+
+    def code_taken(self, code: str) -> bool:
+        return code in self._codes
+
+    def sessions(self) -> List[LiveSession]:
+        return list(self._sessions.values())
+
+    def get(self, session_id: uuid.UUID) -> Optional[LiveSession]:
+        return self._sessions.get(session_id)
+
+    def info(self, session: LiveSession, flower: Optional[int]) -> schemas.SessionInfo:
+        return schemas.SessionInfo(
+            recipe_id=session.recipe_id,
+            flower_id=flower,
+            code=session.code,
+            initial_player=session.initial_player,
+            flowers_collected=list(session.flowers_collected),
+            players=[schemas.PlayerSessionInfo(player_id=p.player_id, name=p.name, assigned_flower=p.assigned_flower,
+                                               profile_picture=p.profile_picture) for p in session.players.values()],
+            status=session.status,
+            version=session.version
+        )
+
+    def player_session(self, player_id: uuid.UUID) -> Tuple[LiveSession, LivePlayer]:
+        session = self.session_of(player_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Player not in a session")
+        return session, session.players[player_id]
+
+    # Mutations, these run on the event loop so nothing else can interleave with them
+
+    def create(self, player: models.Player, recipe: game_catalog.CatalogRecipe, code: str, lat: float, lng: float) -> LiveSession:
+        if player.player_id in self._player_sessions:
+            raise HTTPException(status_code=400, detail="Player already in a session")
+        if code in self._codes:
+            raise HTTPException(status_code=400, detail="Join code already in use")
+
+        available_flowers = list(set(recipe.flower_ids))
+        if not available_flowers:
+            raise HTTPException(status_code=400, detail="No available colors in recipe")
+        assigned_flower = available_flowers.pop(0)
+
+        session = LiveSession(
+            session_id=uuid.uuid4(),
+            code=code,
+            recipe_id=recipe.id,
+            initial_player=player.player_id,
+            initial_lat=lat,
+            initial_lng=lng,
+            flowers_available=available_flowers,
+            required_flowers=recipe.flower_ids,
+            required_potions=recipe.potion_ids
+        )
+        self._sessions[session.session_id] = session
+        self._codes[code] = session.session_id
+        geo_index.index.add(session.session_id, lat, lng)
+        self._add_player(session, LivePlayer(player.player_id, player.name, player.profile_picture, assigned_flower))
+        self._changed(session)
+        return session
+
+    def join(self, player: models.Player, code: str, lat: float, lng: float) -> LiveSession:
+        if player.player_id in self._player_sessions:
+            raise HTTPException(status_code=400, detail="Player already in a session")
+        session = self.by_code(code)
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        if session.status == 1 or session.status == 2:
+            raise HTTPException(status_code=400, detail="Session already in collecting or brewing stage")
+        if not session.flowers_available:
+            raise HTTPException(status_code=400, detail="No flowers available")
+        if not utils.is_within_distance(lat, lng, session.initial_lat, session.initial_lng):
+            raise HTTPException(status_code=400, detail="Too far from session")
+
+        assigned_flower = session.flowers_available.pop(0)
+        self._add_player(session, LivePlayer(player.player_id, player.name, player.profile_picture, assigned_flower))
+        self._changed(session)
+        return session
+
+    def start(self, player_id: uuid.UUID) -> LiveSession:
+        session = self.session_of(player_id)
+        if not session:
+            raise HTTPException(status_code=400, detail="Player not in a session")
+        if player_id != session.initial_player:
+            raise HTTPException(status_code=400, detail="Player is not initial player in this session")
+        if session.status != 0:
+            raise HTTPException(status_code=400, detail="Session already started")
+        if session.flowers_available:
+            raise HTTPException(status_code=400, detail="Not enough players")
+        session.status = 1
+        self._changed(session)
+        return session
+
+    def update_location(self, player_id: uuid.UUID, lat: float, lng: float) -> LiveSession:
+        session = self.session_of(player_id)
+        if not session:
+            raise HTTPException(status_code=400, detail="Player not in a session")
+        if player_id != session.initial_player:
+            raise HTTPException(status_code=400, detail="Player is not initial player in this session")
+        session.initial_lat = lat
+        session.initial_lng = lng
+        geo_index.index.add(session.session_id, lat, lng)
+        self._changed(session)
+        return session
+
+    def leave(self, player_id: uuid.UUID) -> Tuple[LiveSession, str]:
+        session = self.session_of(player_id)
+        if not session:
+            raise HTTPException(status_code=404, detail="Player not in any session")
+
+        player = session.players.pop(player_id)
+        del self._player_sessions[player_id]
+        if player.assigned_flower:
+            session.flowers_available.append(player.assigned_flower)
+
+        if not session.players:
+            self._delete(session)
+            return session, "Left session successfully"
+        # if initial player leaves during collection, stop session
+        if session.initial_player == player_id and (session.status == 0 or session.status == 1):
+            self._delete(session)
+            return session, "Left session successfully. It was initial player, so the session was deleted"
+        if session.status == 1:
+            session.status = 0
+            self._changed(session)
+            return session, "Player left. Other player will return to lobby"
+        self._changed(session)
+        return session, "Left session successfully"
+
+    def collect(self, player_id: uuid.UUID, flower_id: int) -> Tuple[LiveSession, bool]:
+        """Add a collected flower, returns the session and whether the recipe is complete"""
+        session, player = self.player_session(player_id)
+        self.check_collecting(session)
+        if flower_id != player.assigned_flower:
+            raise HTTPException(status_code=400, detail="You cannot collect this flower!")
+        if flower_id not in session.required_flowers:
+            raise HTTPException(status_code=400, detail="This flower is not required for the recipe")
+
+        session.flowers_collected.append(flower_id)
+        completed = session.required_flowers.issubset(session.flowers_collected)
+        if completed:
+            session.status = 2
+        self._changed(session)
+        return session, completed
+
+    def check_collecting(self, session: LiveSession):
+        if session.status == 0:
+            raise HTTPException(status_code=400, detail="Waiting for other players")
+        if session.status == 2:
+            raise HTTPException(status_code=400, detail="Session already in brewing stage")
+
+    def rename_player(self, player: models.Player):
+        session = self.session_of(player.player_id)
+        if session:
+            live_player = session.players[player.player_id]
+            live_player.name = player.name
+            live_player.profile_picture = player.profile_picture
+            self._changed(session, persist=False)
+
+    def remove(self, session_id: uuid.UUID) -> Optional[LiveSession]:
+        session = self._sessions.get(session_id)
+        if session:
+            self._delete(session)
+        return session
+
+    def _add_player(self, session: LiveSession, player: LivePlayer):
+        session.players[player.player_id] = player
+        self._player_sessions[player.player_id] = session.session_id
+
+    def _delete(self, session: LiveSession):
+        session.deleted = True
+        for player_id in session.players:
+            self._player_sessions.pop(player_id, None)
+        self._sessions.pop(session.session_id, None)
+        self._codes.pop(session.code, None)
+        code_allocator.allocator.release(session.code)
+        geo_index.index.remove(session.session_id)
+        self._changed(session)
+
+    def _changed(self, session: LiveSession, persist: bool = True):
+        session.version += 1
+        if persist:
+            self._dirty[session.session_id] = session
+            if self._wakeup:
+                self._wakeup.set()
+
+    # Persistence
+
+    def recover(self, db: Session):
+        """Load all sessions from the db, used on startup"""
+        self._sessions.clear()
+        self._codes.clear()
+        self._player_sessions.clear()
+        self._dirty.clear()
+        db_sessions = (db.query(models.Session)
+                       .options(selectinload(models.Session.players),
+                                selectinload(models.Session.flowers_collected),
+                                selectinload(models.Session.recipe).selectinload(models.Recipe.required_flowers))
+                       .all())
+        for db_session in db_sessions:
+            session = LiveSession(
+                session_id=db_session.session_id,
+                code=db_session.code,
+                recipe_id=db_session.recipe_id,
+                initial_player=db_session.initial_player,
+                initial_lat=db_session.initial_lat,
+                initial_lng=db_session.initial_lng,
+                flowers_available=list(db_session.flowers_available or []),
+                required_flowers=(f.id for f in db_session.recipe.required_flowers),
+                required_potions=(p.id for p in db_session.recipe.required_potions)
+            )
+            session.status = db_session.status
+            session.version = db_session.version
+            session.started_at = db_session.started_at
+            session.flowers_collected = [f.id for f in db_session.flowers_collected]
+            self._sessions[session.session_id] = session
+            self._codes[session.code] = session.session_id
+            for p in db_session.players:
+                self._add_player(session, LivePlayer(p.player_id, p.name, p.profile_picture, p.assigned_flower))
+        return len(self._sessions)
+
+    async def startup(self):
+        """Recover state from the db and start writing changes back"""
+        db = SessionLocal()
+        try:
+            count = await asyncio.to_thread(self.recover, db)
+        finally:
+            db.close()
+        print(f"Session engine recovered {count} sessions")
+        self._wakeup = asyncio.Event()
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def shutdown(self):
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+    async def flush(self):
+        """Write all changed sessions to the db"""
+        if not self._dirty:
+            return
+        batch = self._dirty
+        self._dirty = {}
+        # deletes first, so a freed join code can be reused in the same batch
+        snapshots = sorted((session.snapshot() for session in batch.values()), key=lambda s: not s["deleted"])
+        try:
+            await asyncio.to_thread(_write_snapshots, snapshots)
+        except Exception as e:
+            # state is still in memory, try again on the next flush
+            print(f"Session engine flush failed: {e}")
+            for session_id, session in batch.items():
+                self._dirty.setdefault(session_id, session)
+            if self._wakeup:
+                self._wakeup.set()
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            await self.flush()
+            await asyncio.sleep(FLUSH_INTERVAL)
+
+
+def _write_snapshots(snapshots: List[dict]):
+    db = SessionLocal()
+    try:
+        for snapshot in snapshots:
+            _write_snapshot(snapshot, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _write_snapshot(snapshot: dict, db: Session):
+    session_id = snapshot["session_id"]
+    db_session = db.query(models.Session).filter(models.Session.session_id == session_id).first()
+    member_ids = [player_id for player_id, _ in snapshot["players"]]
+
+    # players who are no longer in the session
+    left = db.query(models.Player).filter(models.Player.session_id == session_id)
+    if member_ids and not snapshot["deleted"]:
+        left = left.filter(models.Player.player_id.notin_(member_ids))
+    left.update({models.Player.session_id: None, models.Player.assigned_flower: None}, synchronize_session=False)
+
+    if snapshot["deleted"]:
+        if db_session:
+            db.delete(db_session)
+            # the unit of work would run inserts first, the code may be reused later in this batch
+            db.flush()
+        return
+
+    if not db_session:
+        db_session = models.Session(session_id=session_id)
+        db.add(db_session)
+    for field in ("code", "recipe_id", "status", "version", "initial_player", "initial_lat", "initial_lng",
+                  "started_at", "flowers_available"):
+        setattr(db_session, field, snapshot[field])
+    db_session.flowers_collected = (db.query(models.Flower).filter(models.Flower.id.in_(snapshot["flowers_collected"])).all()
+                                    if snapshot["flowers_collected"] else [])
+    db.flush()
+
+    for player_id, assigned_flower in snapshot["players"]:
+        db.query(models.Player).filter(models.Player.player_id == player_id).update(
+            {models.Player.session_id: session_id, models.Player.assigned_flower: assigned_flower},
+            synchronize_session=False
+        )
+
+
+engine = SessionEngine(enabled=os.getenv("SESSION_ENGINE", "db") == "memory")
@@ -0,0 +1,103 @@
+"""
+In-process fan-out of session changes to clients watching a lobby.
+Mutating session endpoints publish the committed state once, every subscriber of that
+session gets it from memory instead of polling /players/{player_id}/session/info.
+The last known version of every session is kept as well, so long-polling clients can
+wait for a change without touching the db.
+Only changes made through this process are published, subscribers never hear about another one's.
+"""
+import asyncio
+import uuid
+from collections import defaultdict
+from typing import Iterable, Optional
+
+import schemas
+
+# how many unread updates a slow client can have before the oldest ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 16
+
+
+class SessionBroadcaster:
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._versions = {}
+        self._members = {}
+        self._player_sessions = {}
+        self._changed = {}
+
+    def subscribe(self, session_id: uuid.UUID) -> asyncio.Queue:
+        """Register a new listener for a session"""
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self._subscribers[session_id].add(queue)
+        return queue
+
+    def unsubscribe(self, session_id: uuid.UUID, queue: asyncio.Queue):
+        listeners = self._subscribers.get(session_id)
+        if not listeners:
+            return
+        listeners.discard(queue)
+        if not listeners:
+            del self._subscribers[session_id]
+
+    def subscriber_count(self, session_id: uuid.UUID) -> int:
+        return len(self._subscribers.get(session_id, ()))
+
+    def track(self, session_id: uuid.UUID, version: int, player_ids: Iterable[uuid.UUID]):
+        """Remember the committed version of a session and who is in it"""
+        for player_id in self._members.pop(session_id, ()):
+            self._player_sessions.pop(player_id, None)
+        members = set(player_ids)
+        for player_id in members:
+            self._player_sessions[player_id] = session_id
+        self._members[session_id] = members
+        self._versions[session_id] = version
+
+    def forget(self, session_id: uuid.UUID):
+        for player_id in self._members.pop(session_id, ()):
+            self._player_sessions.pop(player_id, None)
+        self._versions.pop(session_id, None)
+
+    def version_for_player(self, player_id: uuid.UUID) -> Optional[int]:
+        """Last known version of the player's session, None if we know nothing about it"""
+        session_id = self._player_sessions.get(player_id)
+        return self._versions.get(session_id)
+
+    async def wait_for_change(self, player_id: uuid.UUID, since_version: int, timeout: float) -> bool:
+        """Wait until the player's session is newer than since_version.
+        Returns False if nothing changed before the timeout"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            session_id = self._player_sessions.get(player_id)
+            version = self._versions.get(session_id)
+            # unknown version means the player left or the session is gone, caller has to look
+            if version is None or version > since_version:
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            changed = self._changed.setdefault(session_id, asyncio.Event())
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                return False
+
+    def publish(self, session_id: uuid.UUID, info: Optional[schemas.SessionInfo]):
+        """Send new session state to all listeners, None means the session was deleted"""
+        if info is None:
+            self.forget(session_id)
+        else:
+            self.track(session_id, info.version, (p.player_id for p in info.players))
+
+        changed = self._changed.pop(session_id, None)
+        if changed:
+            changed.set()
+
+        for queue in list(self._subscribers.get(session_id, ())):
+            if queue.full():
+                # client is not reading, only the newest state matters
+                queue.get_nowait()
+            queue.put_nowait(info)
+
+
+broadcaster = SessionBroadcaster()
@@ -0,0 +1,140 @@
+"""
+Background cleanup of stale sessions.
+Runs on the app's event loop every SESSION_REAPER_INTERVAL seconds and removes sessions that are
+older than SESSION_MAX_AGE_HOURS or have no players left. Deletes happen in bounded batches of
+plain set-based statements, so a run costs the same no matter how many sessions piled up.
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Callable, List, Tuple
+
+from sqlalchemy import delete, exists, select, update
+from sqlalchemy.orm import Session
+
+import models
+import session_engine
+from database import SessionLocal
+
+REAPER_INTERVAL = float(os.getenv("SESSION_REAPER_INTERVAL", "60"))  # seconds, 0 disables the reaper
+MAX_SESSION_AGE = timedelta(hours=float(os.getenv("SESSION_MAX_AGE_HOURS", "24")))
+BATCH_SIZE = int(os.getenv("SESSION_REAPER_BATCH", "500"))
+MAX_BATCHES_PER_RUN = 20
+
+
+def reap_batch(db: Session, cutoff: datetime, batch_size: int = BATCH_SIZE) -> List[Tuple]:
+    """Delete one batch of stale sessions, returns (session_id, code) of the deleted ones"""
+    # two selects instead of one OR, so each can use its index: old sessions by ix_sessions_started_at,
+    # the newer ones left without players by ix_players_session_id
+    old = (select(models.Session.session_id, models.Session.code)
+           .where(models.Session.started_at < cutoff)
+           .limit(batch_size)
+           .with_for_update(skip_locked=True))
+    rows = db.execute(old).all()
+    if len(rows) < batch_size:
+        has_players = exists().where(models.Player.session_id == models.Session.session_id)
+        empty = (select(models.Session.session_id, models.Session.code)
+                 .where(models.Session.started_at >= cutoff, ~has_players)
+                 .limit(batch_size - len(rows))
+                 .with_for_update(skip_locked=True))
+        rows += db.execute(empty).all()
+    if not rows:
+        return []
+    session_ids = [row.session_id for row in rows]
+
+    db.execute(update(models.Player)
+               .where(models.Player.session_id.in_(session_ids))
+               .values(session_id=None, assigned_flower=None))
+    db.execute(delete(models.session_flower_association)
+               .where(models.session_flower_association.c.session_id.in_(session_ids)))
+    db.execute(delete(models.Session).where(models.Session.session_id.in_(session_ids)))
+    db.commit()
+    return [(row.session_id, row.code) for row in rows]
+
+
+def reap(db: Session, cutoff: datetime, max_batches: int = MAX_BATCHES_PER_RUN) -> List[Tuple]:
+    removed = []
+    for _ in range(max_batches):
+        batch = reap_batch(db, cutoff)
+        removed.extend(batch)
+        if len(batch) < BATCH_SIZE:
+            break
+    return removed
+
+
+def _reap_with_new_session(cutoff: datetime) -> List[Tuple]:
+    db = SessionLocal()
+    try:
+        return reap(db, cutoff)
+    finally:
+        db.close()
+
+
+class SessionReaper:
+    def __init__(self):
+        self.runs = 0
+        self.removed_total = 0
+        self.last_removed = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.last_run_at = None
+        self.errors = 0
+        self._task = None
+
+    async def run_once(self, on_removed: Callable[[List[Tuple]], None]) -> int:
+        """Remove stale sessions now, on_removed gets the (session_id, code) pairs"""
+        started = time.perf_counter()
+        cutoff = datetime.now() - MAX_SESSION_AGE
+        if session_engine.engine.enabled:
+            removed = [(s.session_id, s.code) for s in session_engine.engine.sessions()
+                       if s.started_at < cutoff or not s.players]
+            for session_id, _ in removed:
+                session_engine.engine.remove(session_id)
+        else:
+            removed = await asyncio.to_thread(_reap_with_new_session, cutoff)
+        on_removed(removed)
+
+        self.last_duration = time.perf_counter() - started
+        self.total_duration += self.last_duration
+        self.last_removed = len(removed)
+        self.removed_total += len(removed)
+        self.last_run_at = datetime.now()
+        self.runs += 1
+        return len(removed)
+
+    def start(self, on_removed: Callable[[List[Tuple]], None]):
+        if REAPER_INTERVAL > 0 and not self._task:
+            self._task = asyncio.create_task(self._loop(on_removed))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "errors": self.errors,
+            "removed_total": self.removed_total,
+            "last_removed": self.last_removed,
+            "last_duration_seconds": self.last_duration,
+            "total_duration_seconds": self.total_duration,
+            "last_run_at": self.last_run_at,
+        }
+
+    async def _loop(self, on_removed: Callable[[List[Tuple]], None]):
+        while True:
+            await asyncio.sleep(REAPER_INTERVAL)
+            try:
+                await self.run_once(on_removed)
+            except Exception as e:
+                self.errors += 1
+                print(f"Session reaper failed: {e}")
+
+
+reaper = SessionReaper()
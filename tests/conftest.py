@@ -0,0 +1,74 @@
+"""
+The app runs in this process against a fresh SQLite database seeded with the sample data, requests
+go through httpx's ASGI transport, so there is no server to start. Everything runs on one event
+loop: the async engine's connections belong to the loop that opened them.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import uuid
+
+# read when the app's modules are imported, so set before importing them
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="grimoire-tests-"), "test.db")
+# TEST_DATABASE_URL runs them against postgres instead, that database is reset and seeded
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", f"sqlite:///{DB_PATH}")
+os.environ["VISION_PROVIDER"] = "fixed"
+os.environ["SESSION_ENGINE"] = "db"  # the tests read sessions back from the db
+os.environ["SESSION_REAPER_INTERVAL"] = "0"
+os.environ["DB_METRICS"] = "1"  # X-DB-Queries
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import pytest
+
+import main
+import seed_data
+
+
+@pytest.fixture(scope="session")
+def app_loop():
+    if os.getenv("TEST_DATABASE_URL"):
+        seed_data.reset_and_seed_call()
+    else:
+        seed_data.create_sample_data()  # the sqlite file is new
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(main.startup())
+    yield loop
+    loop.run_until_complete(main.shutdown())
+    loop.close()
+
+
+@pytest.fixture
+def run(app_loop):
+    """Run `body(client)` on the app's loop, the client talks to the app in-process"""
+    def run(body):
+        async def with_client():
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await body(client)
+        return app_loop.run_until_complete(with_client())
+    return run
+
+
+async def create_player(client: httpx.AsyncClient, name: str = None) -> str:
+    response = await client.post("/players/create_noAcc",
+                                 json={"name": name or f"p-{uuid.uuid4().hex[:8]}", "profile_picture": 1})
+    assert response.status_code == 200, response.text
+    return response.json()["player_id"]
+
+
+async def recipe_ids(client: httpx.AsyncClient) -> dict:
+    """Recipe id by name"""
+    return {recipe["name"]: recipe["id"] for recipe in (await client.get("/recipes")).json()}
+
+
+async def create_session(client: httpx.AsyncClient, player_id: str, recipe_id: int, lat: float = 50.0,
+                         lng: float = 14.0) -> dict:
+    """Unlock the recipe for the player and open a session with it"""
+    response = await client.post(f"/players/{player_id}/grimoire/unlock/{recipe_id}")
+    assert response.status_code == 200, response.text
+    response = await client.post("/session/create", json={"player_id": player_id, "initial_lat": lat,
+                                                           "initial_lng": lng, "recipe_id": recipe_id})
+    assert response.status_code == 200, response.text
+    return response.json()
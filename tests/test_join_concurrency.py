@@ -0,0 +1,52 @@
+"""
+Many players joining the same sessions at once: join retries on a version conflict, so every
+free flower goes to exactly one player and none disappear.
+"""
+import asyncio
+from collections import Counter
+
+from sqlalchemy import select
+
+import models
+from conftest import create_player, create_session, recipe_ids
+from database import SessionLocal
+
+SESSIONS = 40
+JOINS_PER_SESSION = 6
+
+
+def test_simultaneous_joins_assign_every_flower_once(run):
+    async def body(client):
+        recipe_id = (await recipe_ids(client))["Eternal Wealth"]
+        sessions = []
+        for _ in range(SESSIONS):
+            sessions.append(await create_session(client, await create_player(client), recipe_id))
+        joiners = [[await create_player(client) for _ in range(JOINS_PER_SESSION)] for _ in sessions]
+
+        async def join(player_id, code):
+            return await client.post("/session/join", json={"player_id": player_id, "lat": 50.0, "lng": 14.0,
+                                                            "code": code})
+
+        responses = await asyncio.gather(*(join(player_id, session["code"])
+                                           for session, players in zip(sessions, joiners) for player_id in players))
+        return sessions, responses
+
+    sessions, responses = run(body)
+    statuses = Counter(response.status_code for response in responses)
+    # a join only loses a version conflict to another join that took a flower, a session has fewer
+    # free flowers than join retries, so nobody is turned away as busy
+    assert set(statuses) <= {200, 400}, [r.text for r in responses if r.status_code not in (200, 400)]
+    assert all(r.json()["detail"] == "No flowers available" for r in responses if r.status_code == 400)
+
+    joined = 0
+    with SessionLocal() as db:
+        for info in sessions:
+            session = db.scalar(select(models.Session).where(models.Session.code == info["code"]))
+            required = sorted(flower.id for flower in session.recipe.required_flowers)
+            players = db.scalars(select(models.Player).where(models.Player.session_id == session.session_id)).all()
+            assigned = [player.assigned_flower for player in players]
+            # every required flower is held by exactly one player, the first player included
+            assert sorted(assigned) == required
+            assert session.flowers_available == []
+            joined += len(players) - 1
+    assert joined == statuses[200]
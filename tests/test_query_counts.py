@@ -0,0 +1,122 @@
+"""
+Statements per request, read from the X-DB-Queries header (db_metrics).
+The path's player is loaded once, with the collections the endpoint works on, finishing a recipe
+counts the potion for all friend pairs in one UPDATE and friend lists come from the friend graph,
+so these numbers only go up when an endpoint starts querying again.
+"""
+import itertools
+import uuid
+
+from sqlalchemy import event
+
+import game_catalog
+from conftest import create_player, create_session, recipe_ids
+from database import async_engine
+
+SESSION_PLAYERS = 8
+MANY_FRIENDS = 501
+
+
+def test_player_endpoints_statement_counts(run):
+    async def body(client):
+        player_id = await create_player(client)
+        await client.post(f"/players/{player_id}/money/change", params={"amount": 5000})
+        potion_id = (await recipe_ids(client))["Sleep Potion"]
+        allowed = game_catalog.catalog.decoration(1).allowed_position
+        position = (allowed & -allowed).bit_length() - 1
+
+        requests = [
+            ("get player", "GET", f"/players/{player_id}", {}, 1),
+            ("get missing player", "GET", "/players/00000000-0000-0000-0000-00000000000a", {}, 1),
+            ("set customer", "PUT", f"/players/{player_id}/customer/3", {}, 2),
+            ("change money", "POST", f"/players/{player_id}/money/change", {"params": {"amount": 1}}, 2),
+            ("inventory", "GET", f"/players/{player_id}/inventory", {}, 2),
+            ("inventory add new", "POST", f"/players/{player_id}/inventory/add/{potion_id}", {}, 3),
+            ("inventory add more", "POST", f"/players/{player_id}/inventory/add/{potion_id}", {}, 3),
+            ("inventory remove", "POST", f"/players/{player_id}/inventory/remove/{potion_id}", {}, 3),
+            ("decoration buy", "POST", f"/players/{player_id}/decorations/buy/1", {}, 4),
+            ("decorations", "GET", f"/players/{player_id}/decorations", {}, 2),
+            ("decoration place", "POST", f"/players/{player_id}/decorations/place/1", {"params": {"position": position}}, 3),
+            ("decorations used", "GET", f"/players/{player_id}/decorations/used", {}, 2),
+            ("decoration unplace", "POST", f"/players/{player_id}/decorations/unplace/1", {}, 3),
+        ]
+        counts, expected = {}, {}
+        for name, method, url, kwargs, statements in requests:
+            response = await client.request(method, url, **kwargs)
+            assert response.status_code == (404 if "missing" in name else 200), (name, response.text)
+            counts[name] = int(response.headers["X-DB-Queries"])
+            expected[name] = statements
+        return counts, expected
+
+    counts, expected = run(body)
+    assert counts == expected
+
+
+def test_finishing_collect_counts_all_friend_pairs_in_one_update(run):
+    friendship_updates = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("UPDATE player_friendships"):
+            friendship_updates.append(statement)
+
+    async def body(client):
+        flower_ids = [flower["id"] for flower in (await client.get("/flowers")).json()][:SESSION_PLAYERS]
+        name = f"Octet {uuid.uuid4().hex[:8]}"
+        response = await client.post("/recipes/add", json={"name": name, "required_flowers": flower_ids})
+        assert response.status_code == 200, response.text
+        recipe_id = (await recipe_ids(client))[name]
+
+        players = [await create_player(client) for _ in range(SESSION_PLAYERS)]
+        for first, second in itertools.combinations(players, 2):
+            assert (await client.post(f"/players/{first}/add-friend/{second}")).status_code == 200
+
+        initial = players[0]
+        session = await create_session(client, initial, recipe_id)
+        flowers = {initial: session["flower_id"]}
+        for player_id in players[1:]:
+            joined = await client.post("/session/join", json={"player_id": player_id, "lat": 50.0, "lng": 14.0,
+                                                              "code": session["code"]})
+            assert joined.status_code == 200, joined.text
+            flowers[player_id] = joined.json()["flower_id"]
+        assert (await client.post(f"/players/{initial}/session/start")).status_code == 200
+
+        for player_id in players[:-1]:
+            collected = await client.post(f"/players/{player_id}/session/collect_flower_old/{flowers[player_id]}")
+            assert collected.status_code == 200, collected.text
+        event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+        try:
+            finishing = await client.post(f"/players/{players[-1]}/session/collect_flower_old/{flowers[players[-1]]}")
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+        assert finishing.status_code == 200, finishing.text
+        assert finishing.json()["status"] == 2
+        friends = (await client.get(f"/players/{initial}/friends")).json()
+        return int(finishing.headers["X-DB-Queries"]), friends
+
+    statements, friends = run(body)
+    # 28 pairs of friends, one UPDATE for all of them
+    assert len(friendship_updates) == 1
+    assert statements == 11
+    assert len(friends) == SESSION_PLAYERS - 1
+    assert {friend["potions_together"] for friend in friends} == {1}
+
+
+def test_friends_statement_count_does_not_grow_with_the_friends(run):
+    async def body(client):
+        few, many = await create_player(client), await create_player(client)
+        friend_ids = [await create_player(client) for _ in range(MANY_FRIENDS)]
+        assert (await client.post(f"/players/{few}/add-friend/{friend_ids[0]}")).status_code == 200
+        for friend_id in friend_ids:
+            assert (await client.post(f"/players/{many}/add-friend/{friend_id}")).status_code == 200
+        counts, friends = {}, {}
+        for player_id in (few, many):
+            response = await client.get(f"/players/{player_id}/friends")
+            assert response.status_code == 200, response.text
+            counts[player_id] = int(response.headers["X-DB-Queries"])
+            friends[player_id] = response.json()
+        return counts[few], counts[many], friends[many]
+
+    few_statements, many_statements, friends = run(body)
+    assert len(friends) == MANY_FRIENDS
+    # served from the friend graph
+    assert few_statements == many_statements == 0
@@ -0,0 +1,70 @@
+"""
+EXPLAIN QUERY PLAN for every statement the hot endpoints send, on the seeded sqlite database:
+each lookup has to search an index (revision 0002), none may scan a whole table.
+"""
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+
+from conftest import DB_PATH, create_player, create_session, recipe_ids
+from database import async_engine
+
+pytestmark = pytest.mark.skipif(async_engine.dialect.name != "sqlite", reason="reads sqlite query plans")
+
+EXPECTED_INDEXES = {
+    "ix_players_player_id",
+    "ix_players_session_id",
+    "ix_inventory_items_player_potion",
+    "ix_decoraion_player_decoration",
+    "ix_player_friendships_pair",
+    "ix_trades_status_created_at",
+    "ix_sessions_session_id",
+}
+
+
+def test_hot_endpoints_search_indexes(run):
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.split(None, 1)[0] in ("SELECT", "UPDATE", "DELETE"):
+            statements.append((statement, parameters))
+
+    async def body(client):
+        seller, buyer = await create_player(client), await create_player(client)
+        recipes = await recipe_ids(client)
+        await client.post(f"/players/{seller}/money/change", params={"amount": 5000})
+        event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+        try:
+            await client.post(f"/players/{seller}/add-friend/{buyer}")
+            await client.post(f"/players/{seller}/inventory/add/{recipes['Sleep Potion']}")
+            await client.post(f"/players/{seller}/decorations/buy/1")
+            await client.post(f"/players/{seller}/decorations/place/1", params={"position": 0})
+            trade = await client.post("/trading/create", params={"seller_id": seller},
+                                      json={"item_id": recipes["Sleep Potion"], "item_amount": 1, "price": 5})
+            await client.get("/trading/board")
+            await client.post(f"/trading/{trade.json()['id']}/buy", params={"buyer_id": buyer})
+            session = await create_session(client, seller, recipes["Eternal Wealth"])
+            await client.post("/session/join", json={"player_id": buyer, "lat": 50.0, "lng": 14.0,
+                                                     "code": session["code"]})
+            await client.get(f"/players/{buyer}/session/info")
+            await client.post(f"/players/{seller}/session/start")
+            await client.post(f"/players/{buyer}/leaveSession")
+            await client.post(f"/players/{seller}/leaveSession")
+            await client.post(f"/players/{seller}/remove-friend/{buyer}")
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+    run(body)
+    assert statements
+
+    used_indexes, scans = set(), []
+    with sqlite3.connect(DB_PATH) as db:
+        for statement, parameters in statements:
+            for step in (row[3] for row in db.execute("EXPLAIN QUERY PLAN " + statement, parameters)):
+                if step.startswith("SCAN "):
+                    scans.append((step, " ".join(statement.split())))
+                if " INDEX " in step:
+                    used_indexes.add(step.split(" INDEX ", 1)[1].split()[0])
+    assert scans == []
+    assert EXPECTED_INDEXES <= used_indexes
@@ -0,0 +1,88 @@
+"""
+GET routes read from the replica, except for players who wrote a moment ago, and session_info goes
+back to the primary when the replica is behind a version announced in this process.
+The replica is a copy of the sqlite database that only changes when the test copies it again, so
+which database answered shows in the data.
+"""
+import asyncio
+import os
+import sqlite3
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+import database
+from conftest import DB_PATH, create_player, create_session, recipe_ids
+
+pytestmark = pytest.mark.skipif(database.async_engine.dialect.name != "sqlite", reason="copies the sqlite file")
+
+REPLICA_PATH = os.path.join(os.path.dirname(DB_PATH), "replica.db")
+STICKY_SECONDS = 0.3
+
+
+def copy_to_replica():
+    with sqlite3.connect(DB_PATH) as primary, sqlite3.connect(REPLICA_PATH) as replica:
+        primary.backup(replica)
+
+
+@pytest.fixture
+def replica(app_loop, monkeypatch):
+    """Route the GET requests to a copy of the database, as READ_DATABASE_URL would"""
+    copy_to_replica()
+    read_engine = create_async_engine(f"sqlite+aiosqlite:///{REPLICA_PATH}")
+    monkeypatch.setattr(database, "read_engine", read_engine)
+    monkeypatch.setattr(database, "ReadSessionLocal", async_sessionmaker(
+        read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False))
+    monkeypatch.setattr(database.read_your_writes, "seconds", STICKY_SECONDS)
+    event.listen(database.PrimarySession, "after_flush", database._mark_writers)
+    yield
+    event.remove(database.PrimarySession, "after_flush", database._mark_writers)
+    app_loop.run_until_complete(read_engine.dispose())
+
+
+def test_reads_after_a_write_go_to_the_primary_until_the_window_is_over(run, replica):
+    async def body(client):
+        player_id = await create_player(client)
+        copy_to_replica()
+        response = await client.post(f"/players/{player_id}/money/change", params={"amount": 50})
+        assert response.status_code == 200, response.text
+        written = response.json()
+
+        sticky = database.read_your_writes.sticky_reads
+        inside = (await client.get(f"/players/{player_id}")).json()
+        assert database.read_your_writes.sticky_reads == sticky + 1
+
+        await asyncio.sleep(STICKY_SECONDS + 0.1)
+        replica_reads = database.read_your_writes.replica_reads
+        after = (await client.get(f"/players/{player_id}")).json()
+        assert database.read_your_writes.replica_reads == replica_reads + 1
+        return written, inside, after
+
+    written, inside, after = run(body)
+    assert inside["money"] == written
+    # the copy was taken before the change
+    assert after["money"] == written - 50
+
+
+def test_session_info_reads_the_primary_when_the_replica_is_behind(run, replica):
+    async def body(client):
+        recipe_id = (await recipe_ids(client))["Eternal Wealth"]
+        player_id, joiner_id = await create_player(client), await create_player(client)
+        session = await create_session(client, player_id, recipe_id)
+        copy_to_replica()
+        response = await client.post("/session/join", json={"player_id": joiner_id, "lat": 50.0, "lng": 14.0,
+                                                            "code": session["code"]})
+        assert response.status_code == 200, response.text
+
+        await asyncio.sleep(STICKY_SECONDS + 0.1)
+        replica_reads = database.read_your_writes.replica_reads
+        info = (await client.get(f"/players/{player_id}/session/info")).json()
+        # routed to the replica, which still has the session without the joiner
+        assert database.read_your_writes.replica_reads == replica_reads + 1
+        return session, response.json(), info
+
+    session, joined, info = run(body)
+    assert session["version"] < joined["version"]
+    assert info["version"] == joined["version"]
+    assert len(info["players"]) == 2
@@ -0,0 +1,99 @@
+"""
+Join codes come from the in-memory allocator, sessions created and deleted in parallel must never
+share a code, and the code of a deleted session is not handed to the next new one.
+"""
+import asyncio
+import threading
+from collections import Counter
+
+import pytest
+from fastapi import HTTPException
+from sqlalchemy import select
+
+import code_allocator
+import models
+from conftest import create_player, recipe_ids
+from database import SessionLocal
+
+PLAYERS = 150
+ROUND = 30
+
+
+def test_parallel_session_creates_get_distinct_codes(run):
+    async def body(client):
+        recipe_id = (await recipe_ids(client))["Sleep Potion"]
+        first = [await create_player(client) for _ in range(PLAYERS)]
+        second = [await create_player(client) for _ in range(PLAYERS)]
+        await asyncio.gather(*(client.post(f"/players/{player_id}/grimoire/unlock/{recipe_id}")
+                               for player_id in first + second))
+
+        async def create(player_id):
+            return await client.post("/session/create", json={"player_id": player_id, "initial_lat": 50.0,
+                                                              "initial_lng": 14.0, "recipe_id": recipe_id})
+
+        created = await asyncio.gather(*(create(player_id) for player_id in first))
+        # the first sessions are deleted (their codes go back to the allocator) while new ones are created,
+        # in rounds, so the creates of a round come after the codes freed in the round before
+        left, recreated = [], []
+        for start in range(0, PLAYERS, ROUND):
+            results = await asyncio.gather(
+                *(client.post(f"/players/{player_id}/leaveSession") for player_id in first[start:start + ROUND]),
+                *(create(player_id) for player_id in second[start:start + ROUND]))
+            left += results[:ROUND]
+            recreated += results[ROUND:]
+        return created, left, recreated
+
+    created, left, recreated = run(body)
+    for response in created + left + recreated:
+        assert response.status_code == 200, response.text
+
+    first_codes = [response.json()["code"] for response in created]
+    second_codes = [response.json()["code"] for response in recreated]
+    assert len(set(first_codes)) == PLAYERS
+    assert len(set(second_codes)) == PLAYERS
+    assert not set(first_codes) & set(second_codes)
+
+    with SessionLocal() as db:
+        live = Counter(db.scalars(select(models.Session.code)))
+    assert set(second_codes) <= set(live)
+    assert not set(first_codes) & set(live) - set(second_codes)
+    assert max(live.values()) == 1
+
+
+def test_allocator_hands_out_each_code_once_across_threads():
+    allocator = code_allocator.CodeAllocator(length=3, seed=1)
+    allocator.load(["AAA", "ZZZ"])
+    per_thread = {}
+
+    def allocate(name):
+        codes = per_thread[name] = []
+        for i in range(3000):
+            code = allocator.allocate()
+            codes.append(code)
+            if i % 3 == 0:
+                # 24000 allocations of 17576 codes, so the walk wraps and hands released codes out again
+                allocator.release(codes.pop())
+
+    threads = [threading.Thread(target=allocate, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    held = [code for codes in per_thread.values() for code in codes]
+    assert len(held) == len(set(held))
+    assert not {"AAA", "ZZZ"} & set(held)
+    assert allocator.in_use() == len(held) + 2
+
+
+def test_allocator_reuses_released_codes_only_after_a_full_pass():
+    allocator = code_allocator.CodeAllocator(length=1, seed=1)
+    first = allocator.allocate()
+    allocator.release(first)
+    rest = [allocator.allocate() for _ in range(25)]
+    assert first not in rest
+    assert allocator.allocate() == first
+    # all 26 codes are taken
+    with pytest.raises(HTTPException) as error:
+        allocator.allocate()
+    assert error.value.status_code == 503
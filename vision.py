@@ -0,0 +1,289 @@
+"""
+Vision calls for flower identification.
+VISION_PROVIDER picks who answers: "openai", "stub" (the local vision_stub server, same API as
+OpenAI) or "fixed" (always VISION_FIXED_COLOR, used when no API key is set).
+Around the provider the client adds a semaphore that caps how many calls run at once, a deadline
+per provider call (waiting for a free slot does not count), a circuit breaker that fails fast while the provider is down and optionally a hedged
+second request when the first one is slower than usual. Waiting never blocks the event loop.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import defaultdict, deque
+from typing import List, Optional
+
+import numpy as np
+import openai
+
+import app_metrics
+
+MODEL = os.getenv("VISION_MODEL", "gpt-4.1-mini")
+MAX_CONCURRENCY = int(os.getenv("VISION_MAX_CONCURRENCY", "4"))
+TIMEOUT = float(os.getenv("VISION_TIMEOUT", "30"))  # seconds per provider call, the wait for a free slot excluded
+PROVIDER = os.getenv("VISION_PROVIDER", "openai" if os.getenv("OPENAI_API_KEY") else "fixed")
+STUB_URL = os.getenv("VISION_STUB_URL", "http://localhost:8001/v1")
+FIXED_COLOR = os.getenv("VISION_FIXED_COLOR", "red")
+BREAKER_FAILURES = int(os.getenv("VISION_BREAKER_FAILURES", "5"))  # failed calls in a row that open the breaker
+BREAKER_COOLDOWN = float(os.getenv("VISION_BREAKER_COOLDOWN", "30"))  # seconds before a trial call
+HEDGE_PERCENTILE = float(os.getenv("VISION_HEDGE_PERCENTILE", "0"))  # 0 disables hedged requests
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 500
+
+
+class VisionTimeout(Exception):
+    pass
+
+
+class VisionUnavailable(Exception):
+    pass
+
+
+class OpenAIProvider:
+    """OpenAI chat completions, also used for the stub server which speaks the same API"""
+
+    def __init__(self, name: str, api_key: Optional[str], base_url: Optional[str] = None, timeout: float = TIMEOUT):
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client: Optional[openai.AsyncOpenAI] = None
+
+    def _get_client(self) -> openai.AsyncOpenAI:
+        # one long-lived client, keeps its connections open
+        if self._client is None:
+            self._client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, timeout=self.timeout,
+                                              max_retries=0)
+        return self._client
+
+    async def complete(self, messages: List[dict], response_format: dict, max_tokens: int) -> str:
+        response = await self._get_client().chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            response_format=response_format,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+class FixedProvider:
+    """Answers every image with the same color, for running without an API key"""
+
+    name = "fixed"
+
+    async def complete(self, messages: List[dict], response_format: dict, max_tokens: int) -> str:
+        return json.dumps({"color_id": FIXED_COLOR, "error": ""})
+
+    async def close(self):
+        pass
+
+
+def create_provider(name: str = PROVIDER):
+    if name == "openai":
+        return OpenAIProvider("openai", os.getenv("OPENAI_API_KEY"))
+    if name == "stub":
+        return OpenAIProvider("stub", "stub", base_url=STUB_URL)
+    if name == "fixed":
+        print(f"Vision provider 'fixed', every flower is identified as {FIXED_COLOR}")
+        return FixedProvider()
+    raise ValueError(f"Unknown vision provider: {name}")
+
+
+def _counts_as_failure(error: Exception) -> bool:
+    """Provider trouble opens the breaker, a request the provider rejected does not"""
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return True
+
+
+class CircuitBreaker:
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.opened = 0
+        self.rejected = 0
+        self._trial_running = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_running:
+            # one trial call decides whether the provider is back
+            self._trial_running = True
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_running = False
+
+    def abandon(self):
+        """The call was cancelled before it told anything about the provider"""
+        self._trial_running = False
+
+    def failure(self):
+        self.consecutive_failures += 1
+        if self._trial_running or self.consecutive_failures >= self.failures:
+            if self.opened_at is None or self._trial_running:
+                self.opened += 1
+            self.opened_at = time.monotonic()
+        self._trial_running = False
+
+
+class VisionClient:
+    def __init__(self, provider=None, max_concurrency: int = MAX_CONCURRENCY, timeout: float = TIMEOUT,
+                 hedge_percentile: float = HEDGE_PERCENTILE):
+        self.provider = provider or create_provider()
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.breaker = CircuitBreaker()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+        self.max_concurrency = max_concurrency
+        self.waiting = 0
+        self.max_waiting = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.total_latency = 0.0
+
+    async def complete(self, messages: List[dict], response_format: dict, max_tokens: int = 300) -> str:
+        """Run a chat completion and return the message content"""
+        metrics = app_metrics.metrics
+        if not self.breaker.allow():
+            metrics.vision_errors.inc(self.provider.name, "unavailable")
+            raise VisionUnavailable(f"Vision provider {self.provider.name} is failing, try again later")
+        started = time.perf_counter()
+        try:
+            result = await self._complete(messages, response_format, max_tokens)
+        except VisionTimeout:
+            # only the provider's own time runs against the deadline, a long line of calls waiting
+            # for a slot says nothing about the provider and must not open the breaker
+            self.timeouts += 1
+            self.breaker.failure()
+            metrics.vision_errors.inc(self.provider.name, "timeout")
+            raise
+        except asyncio.CancelledError:
+            self.breaker.abandon()
+            raise
+        except Exception as e:
+            if _counts_as_failure(e):
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            metrics.vision_errors.inc(self.provider.name, "error")
+            raise
+        finally:
+            metrics.vision_calls.observe(time.perf_counter() - started, self.provider.name)
+        self.breaker.success()
+        return result
+
+    async def _complete(self, messages: List[dict], response_format: dict, max_tokens: int) -> str:
+        """First answer of the call and, if it is slow, a hedged second call"""
+        first = asyncio.create_task(self._attempt(messages, response_format, max_tokens))
+        pending = {first}
+        try:
+            hedge_after = self._hedge_delay()
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(pending, timeout=hedge_after)
+                if not done:
+                    self.hedges += 1
+                    pending.add(asyncio.create_task(self._attempt(messages, response_format, max_tokens)))
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, messages: List[dict], response_format: dict, max_tokens: int) -> str:
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self.provider.complete(messages, response_format, max_tokens),
+                                            timeout=self.timeout)
+            self._latencies[self.provider.name].append(time.perf_counter() - started)
+            return result
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            raise VisionTimeout(f"Vision call did not finish in {self.timeout} seconds")
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.calls += 1
+            self.total_latency += time.perf_counter() - started
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def _hedge_delay(self) -> Optional[float]:
+        """Latency percentile after which a second request is sent, None if hedging is off"""
+        samples = self._latencies[self.provider.name]
+        if self.hedge_percentile <= 0 or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(samples, self.hedge_percentile))
+
+    async def close(self):
+        await self.provider.close()
+
+    def stats(self) -> dict:
+        latency = {}
+        for name, samples in self._latencies.items():
+            latency[name] = {f"p{percentile}_seconds": float(np.percentile(samples, percentile)) if samples else None
+                             for percentile in (50, 95, 99)}
+        return {
+            "provider": self.provider.name,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "calls": self.calls,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "breaker_rejected": self.breaker.rejected,
+            "average_latency_seconds": self.total_latency / self.calls if self.calls else 0.0,
+            "latency": latency,
+        }
+
+
+client = VisionClient()
@@ -0,0 +1,110 @@
+"""
+Cache of flower identification results keyed by a perceptual hash of the image.
+Players often retry with the same or a nearly identical photo, those should not cost another
+vision call. Hashes within VISION_CACHE_DISTANCE bits count as the same photo. To find them
+without comparing against every entry, each hash is split into distance + 1 chunks: two hashes
+that differ in at most distance bits share at least one chunk exactly. The hash only sees
+brightness, so only entries with the same coarse mean color are considered.
+The cache is emptied whenever the flower catalog changes.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Hashable, Optional, Tuple
+
+import image_processing
+
+MAX_ENTRIES = int(os.getenv("VISION_CACHE_SIZE", "1024"))
+TTL = float(os.getenv("VISION_CACHE_TTL", "600"))  # seconds
+MAX_DISTANCE = int(os.getenv("VISION_CACHE_DISTANCE", "4"))  # bits
+HASH_BITS = image_processing.HASH_SIZE ** 2
+
+
+class IdentificationCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES, ttl: float = TTL, max_distance: int = MAX_DISTANCE):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        chunks = max_distance + 1
+        self._chunk_bits = -(-HASH_BITS // chunks)
+        self._chunk_count = chunks
+        self._entries = OrderedDict()  # (color_key, hash) -> (stored_at, result), oldest first
+        self._chunks = defaultdict(set)
+        self._catalog = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, image_hash: int, color_key: tuple, catalog: Hashable) -> Optional[Tuple[Optional[str], Optional[str]]]:
+        """Cached (color_id, error) for this or a similar image, None on a miss"""
+        with self._lock:
+            self._check_catalog(catalog)
+            key = self._find(image_hash, color_key)
+            if key is None:
+                self.misses += 1
+                return None
+            stored_at, result = self._entries[key]
+            if time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, image_hash: int, color_key: tuple, catalog: Hashable, color_id: Optional[str],
+            error: Optional[str] = None):
+        with self._lock:
+            self._check_catalog(catalog)
+            key = (color_key, image_hash)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), (color_id, error))
+            for chunk in self._split(image_hash):
+                self._chunks[chunk].add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chunks.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _check_catalog(self, catalog: Hashable):
+        if catalog != self._catalog:
+            self._entries.clear()
+            self._chunks.clear()
+            self._catalog = catalog
+
+    def _find(self, image_hash: int, color_key: tuple) -> Optional[tuple]:
+        if (color_key, image_hash) in self._entries:
+            return color_key, image_hash
+        best, best_distance = None, self.max_distance + 1
+        for chunk in self._split(image_hash):
+            for candidate in self._chunks.get(chunk, ()):
+                if candidate[0] != color_key:
+                    continue
+                distance = (candidate[1] ^ image_hash).bit_count()
+                if distance < best_distance:
+                    best, best_distance = candidate, distance
+        return best
+
+    def _split(self, image_hash: int):
+        mask = (1 << self._chunk_bits) - 1
+        return [(i, (image_hash >> (i * self._chunk_bits)) & mask) for i in range(self._chunk_count)]
+
+    def _remove(self, key: tuple):
+        self._entries.pop(key, None)
+        for chunk in self._split(key[1]):
+            keys = self._chunks.get(chunk)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._chunks[chunk]
+
+
+cache = IdentificationCache()
@@ -0,0 +1,42 @@
+"""
+Local stand-in for the OpenAI chat completions API, for tests and load runs without API costs.
+Run it with `uvicorn vision_stub:app --port 8001` and start the backend with VISION_PROVIDER=stub.
+Every request is answered with VISION_STUB_COLOR after VISION_STUB_DELAY seconds (plus up to
+VISION_STUB_JITTER), VISION_STUB_ERROR_RATE of the requests fail with a 503.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+COLOR = os.getenv("VISION_STUB_COLOR", "red")
+DELAY = float(os.getenv("VISION_STUB_DELAY", "0.5"))  # seconds
+JITTER = float(os.getenv("VISION_STUB_JITTER", "0.5"))  # seconds
+ERROR_RATE = float(os.getenv("VISION_STUB_ERROR_RATE", "0"))
+
+app = FastAPI(title="Vision stub")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await asyncio.sleep(DELAY + random.random() * JITTER)
+    if random.random() < ERROR_RATE:
+        return JSONResponse(status_code=503, content={"error": {"message": "Stub failure", "type": "server_error"}})
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "stub"),
+        "choices": [{
+            "index": 0,
+            "finish_reason": "stop",
+            "message": {"role": "assistant", "content": json.dumps({"color_id": COLOR, "error": ""})},
+        }],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+    }